@@ -1,18 +1,26 @@
-import json
-import time
+import sys
 import os.path
 import argparse
-import texttable
-import configparser
-from multiprocessing import Process
 
-import modbus
-from file_parser import *
-from pymodbus.client.sync import ModbusTcpClient
-from classes import Concentrator, Register, Section, MultiOrderedDict, Channel, settings
+# Commands import what they need when they run, so that --help and the display commands start fast
+
+
+def help_formatter(prog):
+    """
+    Function to create the help formatter wrapping to the width of the terminal. argparse creates one for every
+    added argument and would import shutil to get the width.
+    """
+    try:
+        width = int(os.environ.get('COLUMNS', 0)) or os.get_terminal_size(sys.stdout.fileno()).columns
+    except (AttributeError, OSError, ValueError):
+        width = 80
+
+    return argparse.HelpFormatter(prog, width=width - 2)
+
 
 parser = argparse.ArgumentParser(prog='arg_parser.py',
-        description='List the available commands when working with a MODBUS configuration.')
+        description='List the available commands when working with a MODBUS configuration.',
+        formatter_class=help_formatter)
 
 parser.add_argument('--verbose', '-v',
                     dest='level',
@@ -69,34 +77,383 @@ parser.add_argument('--display_sections',
                     type=str,
                     nargs='+')
 
+parser.add_argument('--query_history',
+                    dest='history',
+                    help='Display the stored reads of a device: <EUI64> [start] [end], times as "YYYY-MM-DD HH:MM:SS" UTC',
+                    type=str,
+                    nargs='+')
+
+parser.add_argument('--export_history',
+                    dest='export',
+                    help='Export the stored reads as columnar channel readings: <directory> [start] [end], times as "YYYY-MM-DD HH:MM:SS" UTC',
+                    type=str,
+                    nargs='+')
+
+parser.add_argument('--query_readings',
+                    dest='readings',
+                    help='Display the last channel values of a device, or their min/max/avg/rate over time buckets: <EUI64> [last|<bucket, e.g. 15m, 1h>] [start] [end]',
+                    type=str,
+                    nargs='+')
+
+parser.add_argument('--validate',
+                    dest='validate_files',
+                    help='Display the orphan and mismatched devices of a hosts publishers and a MODBUS gateway file',
+                    type=str,
+                    nargs=2)
+
+parser.add_argument('--stats',
+                    dest='stats',
+                    help='Display a summary of the timings and error counts exported by the synchronization',
+                    action='store_true')
+
+parser.add_argument('--daemon',
+                    dest='daemon',
+                    help='Synchronize the data in the background without displaying it, answering the other \
+                          commands from the live data on the rpc_socket',
+                    action='store_true')
+
+parser.add_argument('--sync',
+                    dest='sync',
+                    help='Synchronize the data from the MODBUS gateways after running the other commands, \
+                          the default when no command is given',
+                    action='store_true')
+
 args = parser.parse_args()
 
+# Live dashboard of the synchronization, started from __main__
+dashboard = None
+
+# Synchronization running as a daemon, the rows are not displayed
+headless = False
+
+
+def display(rows, integrity, tracker, scheduler, exec_index):
+    """
+    Method to show decoded rows, on the live dashboard if it is running or as ASCII tables. Rows which are not an
+    integrity snapshot only hold the channels which changed.
+    """
+    from dashboard import CLEAR, MOVE
+    from metrics import timer, RENDER_SECONDS
+    from file_parser import print_rows
+
+    if headless:
+        return
+
+    if dashboard:
+        status = f"Refresh #{exec_index} | stale devices {len(tracker.stale())} | missing {len(tracker.missing())}"
+
+        if integrity:
+            dashboard.update(rows, status)
+        else:
+            dashboard.patch(rows, status)
+
+    else:
+        with timer(RENDER_SECONDS.labels(output="table")):
+            if integrity:
+                print(CLEAR + MOVE.format(1, 1), end="")
+                print_rows(rows)
+                scheduler.print_stats()
+            elif rows:
+                print_rows(rows)
+
+
+def report(resp, hosts, registers, tracker, scheduler, exec_index, updated, history=None, publisher=None,
+           exporter=None, rollups=None, decoded=None, timestamp=None):
+    """
+    Method to show, store, publish and export the responses of a cycle. When reporting by exception only the
+    channels which changed are handled, except at the integrity snapshots; the rollups get every value read.
+    :param updated - EUI64 of the devices read during the cycle:
+    :param history - Store the reads are appended to:
+    :param publisher - Publisher the readings are sent upstream with:
+    :param exporter - ColumnarExporter the readings are exported with:
+    :param rollups - Rollups the values are aggregated in:
+    :param decoded - responses already decoded by the polling workers, decoded here if not specified:
+    :param timestamp - moment of the cycle in epoch nanoseconds, the current time if not specified:
+    """
+    import time
+    from classes import settings
+    from daemon import live
+    from file_parser import response_rows, response_changes, response_readings
+
+    if timestamp is None:
+        timestamp = time.time_ns()
+
+    # The commands served on the RPC socket answer from the last responses
+    live.update(resp, hosts, registers, tracker)
+
+    if settings.report_by_exception == 'true':
+        rows, integrity = response_changes(resp, hosts, registers, tracker, decoded)
+    else:
+        rows, integrity = response_rows(resp, hosts, registers, tracker, decoded), True
+
+    display(rows, integrity, tracker, scheduler, exec_index)
+
+    if history:
+        history.append_responses(resp, updated if integrity else set(row[0] for row in rows.values()), timestamp)
+
+    if publisher:
+        publisher.submit(response_readings(rows, resp, hosts, registers))
+
+    if exporter:
+        exporter.submit(rows)
+
+    if rollups:
+        rollups.submit(resp, hosts, registers, updated, decoded=decoded, timestamp=timestamp)
+
+
+def serve_metrics():
+    """
+    Method to expose the metrics of the synchronization over HTTP if a metrics port is configured.
+    """
+    from metrics import metrics
+    from classes import settings
+
+    if int(settings.metrics_port):
+        try:
+            metrics.serve(settings.metrics_address, settings.metrics_port)
+        except OSError as e:
+            print(f"Could not serve metrics on {settings.metrics_address}:{settings.metrics_port}: {e}")
+
 
 def synchronize_data():
     """
-    Method to run at a set interval of seconds to refresh the data from the MODBUS server.
+    Method to refresh the data from the MODBUS server, polling every device at the Data_Period and
+    Data_Phase of its concentrator.
     """
+    import modbus
+    from pool import pool
+    from classes import settings
+    from metrics import metrics, timer, CYCLE_SECONDS
+    from model import load_gateway, load_hosts
+    from scheduler import create_scheduler
+    from snapshot import snapshots
+    from staleness import StalenessTracker
+    from store import create_store
+    from publisher import create_publisher
+    from health import create_health
+    from file_parser import export_snapshots
+    from reload import create_reloader, apply_schedule, remap
+    from store import check_store
+    from export import create_exporter
+    from rollup import create_rollups
+
+    publisher = None
+    reloader = None
+    exporter = None
+    rollups = None
+
     try:
         exec_index = 0
-        while(True):
-            print(f"Executing refresh #{exec_index} for data synchronization")
-            map_modbus_gw(settings.in_gw)
-            map_host_publishers(settings.in_hosts)
-            
-            os.system('cls')
 
-            client = modbus.create_conn(settings.address, settings.port)
-            modbus.read_input_reg(client, settings.out_gateway)
-            resp = modbus.disconnect(client)
+        resp = {}
+
+        reloader = create_reloader([settings.in_gw], settings.in_hosts)
+
+        devices = [reg.EUI64 for reg in load_gateway(settings.in_gw).registers]
+        scheduler = create_scheduler(settings.in_hosts, devices, settings.interval, settings.schedule_policy)
+        tracker = StalenessTracker(load_hosts(settings.in_hosts), settings.interval)
+        history = create_store(load_gateway(settings.in_gw).registers)
+        publisher = create_publisher()
+        exporter = create_exporter()
+        rollups = create_rollups()
+        health = create_health(settings.address)
+        cycle_seconds = CYCLE_SECONDS.labels(poller="sync")
+
+        serve_metrics()
 
-            interpret_response_data(settings.output_file)
+        while(True):
+            due = scheduler.wait_due()
+
+            if reloader:
+                # Changes of the files were parsed in the background, the responses of unchanged registers are kept
+                reload = reloader.take()
+                if reload:
+                    resp = remap(resp, *reload.positions)
+                    apply_schedule(reload, scheduler, tracker, settings.interval)
+                    check_store(history, reload.registers)
+
+                tables, hosts = reloader.tables[0], reloader.hosts
+            else:
+                # Models are only parsed again if the files changed
+                tables = load_gateway(settings.in_gw)
+                hosts = load_hosts(settings.in_hosts)
+
+            # A failed cycle leaves the devices stale and the next one connects again after the pool backoff
+            updated = set()
+            try:
+                with timer(cycle_seconds), pool.connection(settings.address, settings.port, settings.unit) as client:
+                    resp = modbus.read_registers(client, tables.registers, settings.unit, due, resp,
+                                                 health=health, updated=updated)
+            except Exception as e:
+                print(f"Encountered error when reading {settings.address}:{settings.port}: {e}")
+
+            for eui64 in updated:
+                tracker.update(eui64)
+
+            report(resp, hosts, tables.registers, tracker, scheduler, exec_index, updated, history, publisher,
+                   exporter, rollups)
+
+            export_snapshots(tables, hosts, resp)
+            snapshots.submit(settings.metrics_file, metrics.snapshot())
 
-            time.sleep(int(settings.interval))
             exec_index += 1
 
     except Exception as e:
         print(f"Encountered error when syncing files: {e}")
 
+    finally:
+        if exporter:
+            exporter.close()
+        if rollups:
+            rollups.close()
+        if publisher:
+            publisher.close()
+        if reloader:
+            reloader.close()
+
+
+def synchronize_gateways():
+    """
+    Method to refresh the data from all configured MODBUS gateways concurrently, keeping one
+    connection open per gateway. With more than one worker the gateways are split between processes.
+    """
+    import asyncio
+    import async_poller
+    import sharding
+    from classes import settings
+    from metrics import metrics
+    from model import load_gateway, load_hosts
+    from scheduler import create_scheduler
+    from snapshot import snapshots
+    from staleness import StalenessTracker
+    from store import create_store
+    from publisher import create_publisher
+    from file_parser import export_snapshots
+    from reload import create_reloader
+    from store import check_store
+    from export import create_exporter
+    from rollup import create_rollups
+
+    exec_index = 0
+    publisher = None
+    reloader = None
+    exporter = None
+    rollups = None
+    gateways = None
+    poller = None
+
+    def show(resp):
+        nonlocal exec_index, registers
+
+        # The responses are indexed by position in the registers of all the gateways
+        if reloader:
+            tables = dict(zip([gateway['name'] for gateway in settings.gateways], reloader.tables))
+        else:
+            tables = {gateway['name']: load_gateway(gateway['in_gw']) for gateway in settings.gateways}
+
+        hosts = reloader.hosts if reloader else load_hosts(settings.in_hosts)
+
+        # The gateways switched to the reloaded registers before this cycle
+        if reloader and reloader.registers is not registers:
+            registers = reloader.registers
+            check_store(history, registers)
+
+        # The workers decoded the responses they read
+        if poller:
+            updated, decoded = poller.updated, poller.decoded
+        else:
+            updated, decoded = set().union(*(gateway.updated for gateway in gateways)), None
+
+        report(resp, hosts, registers, tracker, scheduler, exec_index, updated, history, publisher, exporter,
+               rollups, decoded)
+        export_snapshots(tables, hosts, resp)
+        snapshots.submit(settings.metrics_file, metrics.snapshot())
+
+        exec_index += 1
+
+    try:
+        tracker = StalenessTracker(load_hosts(settings.in_hosts), settings.interval)
+        publisher = create_publisher()
+        exporter = create_exporter()
+        rollups = create_rollups()
+
+        serve_metrics()
+
+        if int(settings.workers) > 1:
+            # The workers keep polling the files they started with
+            if settings.hot_reload == 'true':
+                raise ValueError("hot_reload is not supported with more than one worker, set workers = 1")
+
+            # Workers decode and store their own reads
+            poller = sharding.ShardedPoller(settings.gateways, settings.workers, settings.cycle_timeout)
+            registers = poller.registers
+            history = None
+
+            devices = set(reg.EUI64 for reg in registers)
+            scheduler = create_scheduler(settings.in_hosts, devices, settings.interval, settings.schedule_policy)
+
+            sharding.run(poller, scheduler, tracker, callback=show)
+
+        else:
+            gateways = async_poller.create_gateways()
+            reloader = create_reloader([gateway['in_gw'] for gateway in settings.gateways], settings.in_hosts)
+            registers = reloader.registers if reloader else [reg for gateway in gateways for reg in gateway.registers]
+            history = create_store(registers)
+
+            devices = set().union(*(gateway.devices for gateway in gateways))
+            scheduler = create_scheduler(settings.in_hosts, devices, settings.interval, settings.schedule_policy)
+
+            asyncio.run(async_poller.run(gateways, scheduler, tracker, callback=show, reloader=reloader))
+
+    except Exception as e:
+        print(f"Encountered error when syncing gateways: {e}")
+
+    finally:
+        if exporter:
+            exporter.close()
+        if rollups:
+            rollups.close()
+        if publisher:
+            publisher.close()
+        if reloader:
+            reloader.close()
+
+
+def synchronize(daemon=False):
+    """
+    Method to run the synchronization with the configured poller, showing it on the live dashboard if enabled.
+    :param daemon - run in the background without displaying the rows, serving the other commands on the RPC socket:
+    """
+    global dashboard, headless
+
+    from classes import settings
+    from daemon import start_server
+
+    # A daemon which cannot serve the commands would only read the gateways again
+    server = start_server(daemon)
+    if daemon and server is None:
+        return
+
+    headless = daemon
+
+    if settings.dashboard == 'true' and not daemon:
+        from dashboard import Dashboard
+
+        dashboard = Dashboard(["Device", "Value", "Unit", "Last Read", "Status"], [18, 12, 24, 20, 8],
+                              settings.refresh_rate)
+        dashboard.start()
+
+    try:
+        if settings.poller == 'async':
+            synchronize_gateways()
+        else:
+            synchronize_data()
+    finally:
+        if dashboard:
+            dashboard.stop()
+        if server:
+            server.stop()
+
 
 def main():
 
@@ -112,42 +469,157 @@ def main():
 
     # SECTIONS of a file
     if args.conf_file and os.path.exists(args.conf_file[0]):
+        from file_parser import print_all_sections
         print_all_sections(args.conf_file[0])
 
     # GATEWAY config
     if args.gateway_conf_file and os.path.exists(args.gateway_conf_file[0]):
+        from model import load_gateway
+        from file_parser import print_gw_table
+
         gateway = args.gateway_conf_file[0]
-        out_gw = map_modbus_gw(gateway)
-        print_gw_table(out_gw)
+        print_gw_table(load_gateway(gateway).registers)
 
     # HOSTS config
     if args.conf_file and os.path.exists(args.conf_file[0]):
+        from rpc import call
+        from file_parser import hosts_rows, print_hosts_table
 
         gateway = args.conf_file[1]
-        out_gw = map_modbus_gw(gateway)
-
         hosts = args.conf_file[0]
-        out_host = map_host_publishers(hosts)
 
-        print_hosts_table(out_host, out_gw)
+        # A running synchronization answers from its parsed models
+        rows = call("hosts_table", {"hosts": os.path.abspath(hosts), "gateway": os.path.abspath(gateway)})
+        if rows is None:
+            from model import load_gateway, load_hosts
+
+            rows = hosts_rows(load_hosts(hosts), load_gateway(gateway).registers)
+
+        print_hosts_table(rows)
 
     # INTERPRET data
     if args.output_file:
-        interpret_response_data(args.output_file[0])
+        from classes import settings
+        from rpc import call
+        from file_parser import interpret_response_data, load_response, print_rows
+
+        # The responses file is written by the synchronization, which answers from the last responses
+        rows = None
+        if os.path.abspath(args.output_file[0]) == os.path.abspath(settings.output_file):
+            rows = call("rows")
+
+        if rows is not None:
+            print_rows({(row[0], row[1]): row[2:] for row in rows})
+        else:
+            from model import load_gateway, load_hosts
+
+            interpret_response_data(load_response(args.output_file[0]), load_hosts(settings.in_hosts),
+                                    load_gateway(settings.in_gw).registers)
+
+    # EXPORT the history
+    if args.export:
+        from classes import settings
+        from model import load_gateway, load_hosts
+        from store import open_stores, parse_time
+        from export import create_exporter, export_history
+
+        start = parse_time(args.export[1]) if len(args.export) > 1 else 0
+        end = parse_time(args.export[2]) if len(args.export) > 2 else None
+
+        exporter = create_exporter(args.export[0])
+        exported = export_history(open_stores(settings.store_dir), load_hosts(settings.in_hosts),
+                                  load_gateway(settings.in_gw).registers, exporter, start, end)
+        exporter.close()
+
+        print(f"Exported {exported} readings to {args.export[0]}")
+
+    # QUERY the rollups of a device
+    if args.readings:
+        from classes import settings
+        from store import parse_time
+        from rollup import create_rollups, parse_duration
+        from file_parser import print_readings, print_last_values
+
+        rollups = create_rollups(settings.rollup_dir)
+        eui64 = args.readings[0]
+        bucket = args.readings[1] if len(args.readings) > 1 else 'last'
+
+        if bucket == 'last':
+            print_last_values(eui64, rollups.last(eui64))
+        else:
+            start = parse_time(args.readings[2]) if len(args.readings) > 2 else 0
+            end = parse_time(args.readings[3]) if len(args.readings) > 3 else None
+
+            print_readings(eui64, rollups.query(eui64, parse_duration(bucket), start, end))
+
+    # VALIDATE the join of the configs
+    if args.validate_files:
+        from model import load_gateway, load_hosts
+        from file_parser import print_validation
+
+        hosts, gateway = args.validate_files
+        print_validation(load_hosts(hosts), load_gateway(gateway).registers)
+
+    # HISTORY of a device
+    if args.history:
+        from classes import settings
+        from store import open_stores, parse_time
+        from file_parser import print_history
+
+        start = parse_time(args.history[1]) if len(args.history) > 1 else 0
+        end = parse_time(args.history[2]) if len(args.history) > 2 else None
+
+        print_history(open_stores(settings.store_dir), args.history[0], start, end)
+
+    # STATS of the synchronization
+    if args.stats:
+        import json
+        from classes import settings
+        from rpc import call
+        from metrics import print_stats
+
+        stats = call("stats")
+        if stats is not None:
+            print_stats(stats)
+        elif os.path.exists(settings.metrics_file):
+            with open(settings.metrics_file, "r") as f:
+                print_stats(json.load(f))
+        else:
+            print(f"No metrics exported yet to {settings.metrics_file}")
 
     if args.bool_value:
-        client = modbus.create_conn(address, port)
-        modbus.read_input_reg(client, settings.out_gateway)
-        resp = modbus.disconnect(client)
-        print(f"Response when closing MOBBUS connection: {resp}")
+        from classes import settings
+        from rpc import call
+        from snapshot import snapshots
 
+        # A running synchronization already holds the last responses, the gateway is not read again
+        resp = call("responses")
+        if resp is not None:
+            snapshots.submit(settings.output_file, resp)
+        else:
+            import modbus
+            from pool import pool
+            from model import load_gateway, load_hosts
+            from file_parser import export_snapshots
 
-if __name__ == '__main__':
-    p1 = Process(target=synchronize_data)
-    p1.start()
+            tables = load_gateway(settings.in_gw)
+            hosts = load_hosts(settings.in_hosts)
+
+            with pool.connection(address, port, settings.unit) as client:
+                resp = modbus.read_registers(client, tables.registers, settings.unit, gateway=address)
 
-    p2 = Process(target=main)
-    p2.start()
+            export_snapshots(tables, hosts, resp)
+
+            pool.close_all()
+
+        snapshots.flush()
+
+
+if __name__ == '__main__':
+    main()
 
-    p1.join()
-    p2.join()
+    # The synchronization only starts when asked for, or when no command is given
+    if args.daemon:
+        synchronize(daemon=True)
+    elif args.sync or len(sys.argv) == 1:
+        synchronize()
@@ -0,0 +1,406 @@
+import struct
+import asyncio
+from time import gmtime, strftime, perf_counter
+
+import modbus
+from classes import settings
+from model import load_gateway, TABLES
+from health import create_health
+from reload import remap, apply_schedule
+from metrics import READ_SECONDS, READ_ERRORS, READ_TIMEOUTS, READ_LATE, CYCLE_SECONDS
+
+# Function codes of the tables of single bits
+BIT_FUNCTIONS = set(function for function, bits, _ in TABLES.values() if bits)
+
+# MBAP header: transaction id, protocol id, length, unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+
+
+class AsyncModbusConnection():
+    """
+    Class holding a persistent asyncio TCP/IP connection to a MODBUS gateway. Requests are pipelined: each one is
+    sent with its own transaction id without waiting for the previous replies, and a receiver task hands every
+    reply to its request whatever the order they come back in. The callers bound the requests in flight, the
+    connection is reopened on the next request after it failed.
+    """
+    def __init__(self, address, port, unit=0, timeout=3, name=None):
+        self.address = address
+        self.port = int(port)
+        self.unit = int(unit)
+        self.timeout = float(timeout)
+
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.trans_id = 0
+        self.pending = {}
+        self.received_at = 0.0
+        # Created in the event loop of the first request, before Python 3.10 they bind to the loop they are created in
+        self.lock = None
+        self.late = READ_LATE.labels(gateway=name or address)
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        """
+        Method to open the TCP/IP connection to the gateway if it is not already open.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if not self.connected:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.address, self.port), self.timeout)
+                self.receiver = asyncio.create_task(self._receive(self.reader))
+
+    async def close(self):
+        """
+        Method to close the TCP/IP connection to the gateway, failing the requests still waiting for a reply.
+        """
+        if self.receiver is not None and self.receiver is not asyncio.current_task():
+            self.receiver.cancel()
+        self.receiver = None
+
+        self._fail(ConnectionError(f"Connection to {self.address}:{self.port} closed"))
+
+        if self.writer is not None:
+            writer = self.writer
+            self.reader = None
+            self.writer = None
+
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def _fail(self, error):
+        # Fail the requests waiting for a reply
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def _receive(self, reader):
+        # Hand every reply to the request with the same transaction id
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                trans_id, _, length, _ = MBAP_HEADER.unpack(await reader.readexactly(MBAP_HEADER.size))
+                body = await reader.readexactly(length - 1)
+                self.received_at = loop.time()
+
+                future = self.pending.pop(trans_id, None)
+                if future is None:
+                    # The request already timed out
+                    self.late.inc()
+                elif not future.done():
+                    future.set_result(body)
+
+        except (OSError, asyncio.IncompleteReadError) as e:
+            if reader is self.reader:
+                self._fail(e)
+                await self.close()
+
+    def _next_id(self):
+        # Next transaction id which is not waiting for a reply
+        while True:
+            self.trans_id = (self.trans_id + 1) & 0xFFFF
+            if self.trans_id not in self.pending:
+                return self.trans_id
+
+    async def read(self, function, address, count, timeout=None):
+        """
+        Method to read a block of registers or bits from the gateway.
+        :param function - MODBUS function code of the table, as in model.TABLES:
+        :param address - first register or bit to read:
+        :param count - number of registers or bits to read:
+        :param timeout - seconds to wait for the response, the timeout of the connection if not specified:
+        :return - list of register values, or of bits for the bit tables:
+        """
+        await self.connect()
+
+        loop = asyncio.get_running_loop()
+        writer = self.writer
+        trans_id = self._next_id()
+        future = self.pending[trans_id] = loop.create_future()
+        sent_at = loop.time()
+
+        try:
+            pdu = struct.pack(">BHH", function, address, count)
+            writer.write(MBAP_HEADER.pack(trans_id, 0, len(pdu) + 1, self.unit) + pdu)
+            await writer.drain()
+
+            body = await asyncio.wait_for(future, timeout or self.timeout)
+
+        except asyncio.TimeoutError:
+            self.pending.pop(trans_id, None)
+
+            # Only a silent gateway drops the connection, a single lost reply does not
+            if self.received_at < sent_at and self.writer is writer:
+                await self.close()
+            raise
+
+        except (OSError, asyncio.IncompleteReadError):
+            self.pending.pop(trans_id, None)
+
+            # The connection may already have been reopened by another request
+            if self.writer is writer:
+                await self.close()
+            raise
+
+        return parse_response(function, count, body)
+
+
+def parse_response(function, count, body):
+    """
+    Function to get the values of a read response PDU.
+    :param function - MODBUS function code of the request:
+    :param count - number of registers or bits requested:
+    :param body - response PDU:
+    :return - list of register values, or of bits for the bit tables:
+    :raise ValueError - for an exception response or a response which does not answer the request:
+    """
+    if len(body) < 2 or body[0] & 0x7F != function:
+        raise ValueError(f"Response {body[:1].hex()} to a request of function {function}")
+
+    if body[0] & 0x80:
+        raise ValueError(f"MODBUS exception code {body[1]} for function {function}")
+
+    # Bits are packed 8 to a byte, the first one in the least significant bit
+    byte_cnt = (count + 7) // 8 if function in BIT_FUNCTIONS else 2 * count
+    if body[1] != byte_cnt or len(body) != 2 + byte_cnt:
+        raise ValueError(f"Response of {len(body) - 2} bytes announcing {body[1]} to a request of {byte_cnt} bytes "
+                         f"for function {function}")
+
+    if function in BIT_FUNCTIONS:
+        return [(body[2 + (position >> 3)] >> (position & 7)) & 1 for position in range(count)]
+
+    return list(struct.unpack(f">{count}H", body[2:]))
+
+
+class Gateway():
+    """
+    Class representing a MODBUS gateway polled by the asynchronous poller, with the registers mapped from its
+    gateway configuration file and the persistent connection used to read them.
+    """
+    def __init__(self, name, address, port, in_gw, unit=0, timeout=3, max_concurrency=1):
+        self.name = name
+        self.registers = load_gateway(in_gw).registers
+        self.devices = set(mapping.EUI64 for mapping in self.registers)
+        self.plans = {}
+        self.responses = {}
+        self.updated = set()
+        # Requests in flight on the pipelined connection, 1 for gateways answering one request at a time
+        self.max_concurrency = int(max_concurrency)
+        self.semaphore = None
+        self.conn = AsyncModbusConnection(address, port, unit, timeout, name)
+        self.health = create_health(name, float(timeout))
+
+        self.read_seconds = READ_SECONDS.labels(gateway=name)
+        self.read_errors = READ_ERRORS.labels(gateway=name)
+        self.read_timeouts = READ_TIMEOUTS.labels(gateway=name)
+
+    async def read_block(self, block):
+        """
+        Method to read a single planned block with the adaptive timeout of the gateway, retried after a jittered
+        backoff and limited by the concurrency allowed for the gateway.
+        :param block - block as returned by modbus.plan_reads:
+        :return - (values, timed_out) with the list of (index, register, values) tuples, None if the read failed:
+        """
+        devices = set(mapping.EUI64 for _, mapping in block["registers"])
+        timed_out = False
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        for attempt in range(1 + self.health.retries):
+            if attempt:
+                await asyncio.sleep(self.health.backoff(attempt - 1))
+
+            async with self.semaphore:
+                start = perf_counter()
+                try:
+                    words = await self.conn.read(TABLES[block["table"]][0], block["start_addr"], block["word_cnt"],
+                                                 self.health.timeout())
+                # Failures are only counted, the dashboard is redrawn over the terminal
+                except asyncio.TimeoutError:
+                    self.read_timeouts.inc()
+                    timed_out = True
+                    continue
+                except (OSError, ValueError, asyncio.IncompleteReadError):
+                    self.read_errors.inc()
+                    timed_out = False
+                    continue
+                finally:
+                    self.read_seconds.observe(perf_counter() - start)
+
+            self.health.success(devices, perf_counter() - start)
+            return modbus.split_block(block, words), False
+
+        return None, timed_out
+
+    async def read_devices(self, block):
+        """
+        Method to read a planned block, reading its devices one by one if it failed so a single dead device does not
+        fail the others. The failures are recorded in the circuit breakers of the devices.
+        :param block - block as returned by modbus.plan_reads:
+        :return - list of (index, register, values) tuples of the devices read successfully:
+        """
+        values, timed_out = await self.read_block(block)
+        if values is not None:
+            return values
+
+        devices = set(mapping.EUI64 for _, mapping in block["registers"])
+        if len(devices) == 1:
+            self.health.failure(devices, timed_out)
+            return []
+
+        values = []
+        for sub in modbus.isolate(block, int(settings.read_gap)):
+            sub_values, timed_out = await self.read_block(sub)
+            if sub_values is None:
+                self.health.failure(set(mapping.EUI64 for _, mapping in sub["registers"]), timed_out)
+            else:
+                values.extend(sub_values)
+
+        return values
+
+    def reload(self, tables, moved, dropped):
+        """
+        Method to switch the gateway to the registers of its reloaded configuration file between two cycles, the
+        connection and the responses of the unchanged registers are kept.
+        :param tables - GatewayTables of the reloaded file:
+        :param moved - dict of new positions indexed by old position, as returned by reload.position_changes:
+        :param dropped - set of old positions, as returned by reload.position_changes:
+        """
+        self.registers = tables.registers
+        self.devices = set(mapping.EUI64 for mapping in self.registers)
+        self.plans = {}
+        self.responses = remap(self.responses, moved, dropped)
+
+    def plan(self, devices=None):
+        """
+        Method to get the blocks to read for a set of devices, plans are cached since the same
+        devices are usually due together.
+        :param devices - EUI64 of the devices to be read, all devices if not specified:
+        :return - list of blocks as returned by modbus.plan_reads:
+        """
+        key = None if devices is None else frozenset(self.devices.intersection(devices))
+
+        if key not in self.plans:
+            self.plans[key] = modbus.plan_reads(self.registers, int(settings.read_gap), devices=key)
+
+        return self.plans[key]
+
+    async def poll(self, devices=None):
+        """
+        Method to read the planned blocks of the gateway for the specified devices.
+        :param devices - EUI64 of the devices to be read, all devices if not specified:
+        :return responses - dict of the last response of every register indexed by its position in the config:
+        """
+        # Devices whose circuit breaker is open are skipped until their next probe
+        allowed = self.health.allowed(self.devices if devices is None else self.devices.intersection(devices))
+
+        results = await asyncio.gather(*(self.read_devices(block) for block in self.plan(allowed)))
+        datetime = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+
+        responses = self.responses
+        self.updated = set()
+
+        for values in results:
+            for index, mapping, x in values:
+                self.updated.add(mapping.EUI64)
+                responses[index] = {
+                    "table": mapping.table,
+                    "register": mapping.start_addr,
+                    "response": x,
+                    "device": mapping.EUI64,
+                    "last_read": datetime,
+                    "gateway": self.name
+                }
+
+        return dict(sorted(responses.items()))
+
+
+def create_gateways(gateways=None):
+    """
+    Function to create the gateways to be polled from the context settings.
+    :param gateways - list of gateway settings dicts, all configured gateways if not specified:
+    :return - list of Gateway objects:
+    """
+    if gateways is None:
+        gateways = settings.gateways
+
+    return [Gateway(**gateway) for gateway in gateways]
+
+
+async def poll_all(gateways, devices=None):
+    """
+    Function to read all gateways concurrently, the time of a cycle is given by the slowest gateway.
+    :param gateways - list of Gateway objects:
+    :param devices - EUI64 of the devices to be read, all devices if not specified:
+    :return json_data - responses of all gateways in the same structure as modbus.read_registers, indexed by the
+    position of the register in the registers of all gateways:
+    """
+    results = await asyncio.gather(*(gateway.poll(devices) for gateway in gateways))
+
+    # Merge the responses, offsetting the positions of every gateway by the registers of the previous ones
+    json_data = {}
+    offset = 0
+    for gateway, responses in zip(gateways, results):
+        for index, r in responses.items():
+            json_data[offset + index] = r
+
+        offset += len(gateway.registers)
+
+    return json_data
+
+
+async def run(gateways, scheduler, tracker=None, cycles=None, callback=None, reloader=None):
+    """
+    Function to poll the devices of the gateways when they are due, keeping the connections open between cycles.
+    :param gateways - list of Gateway objects:
+    :param scheduler - Scheduler with one job per device:
+    :param tracker - StalenessTracker updated with the devices read successfully:
+    :param cycles - number of cycles to run, forever if not specified:
+    :param callback - function called with the responses after every cycle:
+    :param reloader - ConfigReloader of the gateway files in the order of the gateways, changes of the files are
+    applied between two cycles:
+    """
+    exec_index = 0
+    cycle_seconds = CYCLE_SECONDS.labels(poller="async")
+
+    try:
+        while cycles is None or exec_index < cycles:
+            await asyncio.sleep(scheduler.delay())
+            devices = scheduler.pop_due()
+
+            reload = reloader.take() if reloader else None
+            if reload:
+                for gateway, tables, positions in zip(gateways, reload.tables, reload.gateway_positions):
+                    if tables.registers is not gateway.registers:
+                        gateway.reload(tables, *positions)
+
+                apply_schedule(reload, scheduler, tracker, settings.interval)
+
+            start = perf_counter()
+            json_data = await poll_all(gateways, devices)
+            cycle_seconds.observe(perf_counter() - start)
+
+            if tracker:
+                for gateway in gateways:
+                    for eui64 in gateway.updated:
+                        tracker.update(eui64)
+
+            if callback:
+                callback(json_data)
+
+            exec_index += 1
+
+    finally:
+        await asyncio.gather(*(gateway.conn.close() for gateway in gateways))
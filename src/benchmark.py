@@ -0,0 +1,346 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+import contextlib
+
+import model
+import async_poller
+import file_parser
+from classes import settings
+from simulator import synthesize, create_simulator
+
+
+def percentile(values, fraction):
+    """
+    Function to get a percentile of a list of values, the nearest value ranked below it.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summary(seconds):
+    """
+    Function to summarize a list of durations in seconds.
+    """
+    return {
+        "count": len(seconds),
+        "mean": sum(seconds) / len(seconds) if seconds else None,
+        "p50": percentile(seconds, 0.50),
+        "p99": percentile(seconds, 0.99),
+        "max": max(seconds) if seconds else None
+    }
+
+
+@contextlib.contextmanager
+def measure(result):
+    """
+    Context manager recording in result the duration and the peak of memory allocated by the block.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        yield result
+    finally:
+        result["seconds"] = time.perf_counter() - start
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+
+def bench_parse(path_gw, path_hosts):
+    """
+    Function to measure a cold parse of the configuration files into the model.
+    """
+    result = {}
+
+    # Start from an empty cache to measure a cold parse
+    model._cache.clear()
+
+    with measure(result):
+        tables = model.load_gateway(path_gw)
+        devices = model.load_hosts(path_hosts)
+
+    return result, tables, devices
+
+
+def bench_map(path_gw, path_hosts):
+    """
+    Function to measure the mapping of the configuration files to JSON.
+    """
+    result = {}
+
+    with measure(result):
+        file_parser.map_modbus_gw(path_gw)
+        file_parser.map_host_publishers(path_hosts)
+
+    return result
+
+
+def bench_poll(simulator, address, port, path_gw, cycles, timeout=3, max_concurrency=4):
+    """
+    Function to measure the cycles of the asynchronous poller and the latency of every request.
+    """
+    gateways = async_poller.create_gateways([{'name': 'simulator', 'address': address, 'port': port,
+                                              'in_gw': path_gw, 'timeout': timeout,
+                                              'max_concurrency': max_concurrency}])
+    latencies = []
+    cycle_times = []
+
+    # Time every request of the gateway connection
+    for gateway in gateways:
+        read = gateway.conn.read
+
+        async def timed_read(function, address, count, timeout=None, read=read):
+            start = time.perf_counter()
+            try:
+                return await read(function, address, count, timeout)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        gateway.conn.read = timed_read
+
+    async def run():
+        resp = {}
+        for _ in range(cycles):
+            start = time.perf_counter()
+            resp = await async_poller.poll_all(gateways)
+            cycle_times.append(time.perf_counter() - start)
+
+        for gateway in gateways:
+            await gateway.conn.close()
+
+        return resp
+
+    result = {}
+    requests = simulator.requests
+
+    with measure(result):
+        resp = asyncio.run(run())
+
+    result["cycle"] = summary(cycle_times)
+    result["latency"] = summary(latencies)
+    result["requests_per_second"] = (simulator.requests - requests) / result["seconds"]
+    result["responses"] = len(resp)
+
+    return result, resp
+
+
+def bench_read_registers(address, port, registers, cycles):
+    """
+    Function to measure the cycles of the synchronous client, skipped when pymodbus is not available.
+    """
+    try:
+        import modbus
+        client = modbus.create_conn(address, port)
+    except ImportError as e:
+        return {"skipped": f"{e}"}
+
+    cycle_times = []
+    result = {}
+
+    with measure(result):
+        for _ in range(cycles):
+            start = time.perf_counter()
+            modbus.read_registers(client, registers, settings.unit)
+            cycle_times.append(time.perf_counter() - start)
+
+    modbus.disconnect(client)
+    result["cycle"] = summary(cycle_times)
+
+    return result
+
+
+def bench_interpret(resp, devices, registers, cycles):
+    """
+    Function to measure the decoding of the responses into the table of channel values.
+    """
+    cycle_times = []
+    result = {}
+
+    with measure(result), contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(cycles):
+            start = time.perf_counter()
+            file_parser.interpret_response_data(resp, devices, registers)
+            cycle_times.append(time.perf_counter() - start)
+
+    result["cycle"] = summary(cycle_times)
+
+    return result
+
+
+def run_benchmark(devices, channels, cycles, latency=0.0, jitter=0.0, loss=0.0, exceptions=0.0, port=15020,
+                  timeout=3, max_concurrency=4):
+    """
+    Function to measure the mapping, polling and interpretation of a synthesized configuration served by the
+    simulator.
+    :return results - dict of the measures of every stage:
+    """
+    directory = tempfile.mkdtemp(prefix="modbus-bench-")
+    path_gw, path_hosts = synthesize(directory, devices, channels)
+
+    # Keep the exported files out of the working directory, the context is read first so it does not override them
+    settings.read_context()
+    settings.out_gateway = os.path.join(directory, "map_modbus_gw.json")
+    settings.out_hosts = os.path.join(directory, "map_host_publishers.json")
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "devices": devices,
+            "channels": channels,
+            "cycles": cycles,
+            "latency": latency,
+            "jitter": jitter,
+            "loss": loss,
+            "exceptions": exceptions,
+            "max_concurrency": max_concurrency
+        },
+        "stages": {}
+    }
+    stages = results["stages"]
+
+    stages["parse"], tables, hosts = bench_parse(path_gw, path_hosts)
+    stages["map"] = bench_map(path_gw, path_hosts)
+    registers = tables.registers
+
+    # Serve the simulator from its own thread so the synchronous client can be measured too
+    simulator = create_simulator(path_gw, path_hosts, latency=latency, jitter=jitter, loss=loss,
+                                 exceptions=exceptions, seed=0)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(simulator.serve("127.0.0.1", port))
+        ready.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    ready.wait()
+
+    try:
+        stages["poll"], resp = bench_poll(simulator, "127.0.0.1", port, path_gw, cycles, timeout,
+                                                max_concurrency)
+        stages["read_registers"] = bench_read_registers("127.0.0.1", port, registers, cycles)
+        stages["interpret"] = bench_interpret(resp, hosts, registers, cycles)
+    finally:
+        asyncio.run_coroutine_threadsafe(simulator.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return results
+
+
+# Invocations of arg_parser.py timed by the startup benchmark, as called from cron and health checks
+STARTUP_COMMANDS = (["--help"], ["--display_gateway_conf", "../conf/modbus_gw.ini"], ["--stats"])
+
+
+def bench_startup(commands=STARTUP_COMMANDS, runs=20):
+    """
+    Function to measure the wall time of CLI invocations, each one in a new interpreter like when called
+    from a script, next to the time of an interpreter doing nothing.
+    :param commands - list of argument lists of arg_parser.py:
+    :param runs - number of invocations of every command:
+    :return results - dict of duration summaries indexed by command:
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    invocations = {"python": [sys.executable, "-c", "pass"]}
+    invocations.update((" ".join(command), [sys.executable, "arg_parser.py", *command]) for command in commands)
+
+    results = {}
+    for name, invocation in invocations.items():
+        seconds = []
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(invocation, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+            seconds.append(time.perf_counter() - start)
+
+        results[name] = summary(seconds)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Function to find the stages which got slower than the baseline by more than the tolerance.
+    :return regressions - list of messages:
+    """
+    regressions = []
+
+    for stage, measures in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage, {})
+
+        for name in ("seconds", "peak_bytes"):
+            if measures.get(name) is not None and before.get(name):
+                change = measures[name] / before[name] - 1
+                if change > tolerance:
+                    regressions.append(f"{stage} {name}: {before[name]:.6g} -> {measures[name]:.6g} (+{change:.0%})")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark.py',
+            description='Measure the polling cycle against the local MODBUS simulator.')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--exceptions', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=15020)
+    parser.add_argument('--timeout', type=float, default=3)
+    parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight on the gateway')
+    parser.add_argument('--output', default='../out/benchmark.json', help='File the results are saved to')
+    parser.add_argument('--compare', help='Results of a previous run, exits with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against --compare')
+    parser.add_argument('--startup', action='store_true', help='Only measure the startup time of the CLI')
+    parser.add_argument('--budget', type=float, default=0.05,
+                        help='Seconds the median startup of every command must stay under with --startup')
+    options = parser.parse_args()
+
+    if options.startup:
+        startup = bench_startup(runs=options.cycles)
+        print(json.dumps(startup, indent=4))
+
+        over = [name for name, result in startup.items() if name != "python" and result["p50"] > options.budget]
+        for name in over:
+            print(f"Over budget: {name} {startup[name]['p50'] * 1000:.1f} ms > {options.budget * 1000:.1f} ms")
+
+        sys.exit(1 if over else 0)
+
+    results = run_benchmark(options.devices, options.channels, options.cycles, options.latency, options.jitter,
+                            options.loss, options.exceptions, options.port,
+                            options.timeout, options.concurrency)
+
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print(json.dumps(results["stages"], indent=4))
+
+    if options.compare:
+        with open(options.compare, "r") as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+
+        for regression in regressions:
+            print(f"Regression: {regression}")
+
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,126 @@
+import json
+import struct
+import asyncio
+import argparse
+
+from publisher import CONNECT, CONNACK, PUBLISH, PUBACK, PINGREQ, PINGRESP, DISCONNECT, _packet
+
+
+class StandInBroker():
+    """
+    Class accepting MQTT 3.1.1 clients on a local port in place of a real broker, acknowledging their messages
+    and keeping count of what was published. It only understands what the publisher sends and routes nothing.
+    """
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+        self.messages = 0
+        self.readings = 0
+        self.server = None
+        self.connections = set()
+
+    async def handle(self, reader, writer):
+        self.connections.add(asyncio.current_task())
+
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+
+                length = 0
+                shift = 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+
+                body = await reader.readexactly(length)
+                kind = header & 0xF0
+
+                if kind == CONNECT:
+                    writer.write(_packet(CONNACK, b"\x00\x00"))
+                elif kind == PUBLISH:
+                    self.received(header, body, writer)
+                elif kind == PINGREQ:
+                    writer.write(_packet(PINGRESP, b""))
+                elif kind == DISCONNECT:
+                    break
+
+                await writer.drain()
+
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+        finally:
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    def received(self, header, body, writer):
+        """
+        Method to count a published message and acknowledge it if it was sent at QoS 1.
+        """
+        size = struct.unpack(">H", body[:2])[0]
+        topic = body[2:2 + size].decode()
+        offset = 2 + size
+
+        if header & 0x06:
+            writer.write(_packet(PUBACK, body[offset:offset + 2]))
+            offset += 2
+
+        payload = body[offset:]
+        self.messages += 1
+
+        try:
+            readings = json.loads(payload)
+            self.readings += len(readings)
+        except ValueError:
+            readings = None
+
+        if self.verbose:
+            print(f"{topic}: {payload.decode(errors='replace')}")
+        else:
+            print(f"{topic}: {len(readings) if readings is not None else len(payload)} readings, "
+                  f"{self.messages} messages and {self.readings} readings received")
+
+    async def serve(self, address="127.0.0.1", port=1883):
+        """
+        Method to start accepting clients.
+        :return - asyncio server:
+        """
+        self.server = await asyncio.start_server(self.handle, address, port)
+        return self.server
+
+    async def close(self):
+        """
+        Method to stop serving and drop the client connections.
+        """
+        if self.server is not None:
+            self.server.close()
+
+        for connection in list(self.connections):
+            connection.cancel()
+
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+
+async def _serve_forever(broker, address, port):
+    server = await broker.serve(address, port)
+    print(f"Stand-in broker listening on {address}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='broker.py',
+            description='Accept the readings published by the synchronization in place of an MQTT broker.')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--verbose', action='store_true', help='Print the payload of every message')
+    options = parser.parse_args()
+
+    try:
+        asyncio.run(_serve_forever(StandInBroker(options.verbose), options.address, options.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,124 @@
+import time
+import math
+from array import array
+
+
+def first_slots(index):
+    """
+    Function to get the slot of the first channel of every register position, the channels of all the registers
+    being laid one after the other.
+    :param index - JoinIndex of the gateway and hosts publishers models:
+    :return first - array of slots:
+    """
+    first = array('l')
+    slot = 0
+
+    for channels in index.channels:
+        first.append(slot)
+        slot += len(channels)
+
+    return first
+
+
+class ChangeDetector():
+    """
+    Class reporting by exception the channel values decoded from the responses. The last reported value of every
+    channel is kept in a flat array, a new value is only reported when it moved past the deadband of its channel,
+    and every channel is reported again at each integrity snapshot.
+    """
+    def __init__(self, index, integrity_period=60, clock=time.monotonic):
+        self.index = index
+        self.integrity_period = float(integrity_period)
+        self.clock = clock
+
+        # First slot of the channels of every register position
+        self.first = first_slots(index)
+        absolute = []
+        percent = []
+
+        for channels in index.channels:
+            for ch in channels:
+                absolute.append(0.0 if ch.deadband_percent else ch.deadband)
+                percent.append(ch.deadband / 100 if ch.deadband_percent else 0.0)
+
+        self.absolute = array('d', absolute)
+        self.percent = array('d', percent)
+        self.previous = array('d', [math.nan]) * len(absolute)
+
+        # The first detection is a snapshot of everything
+        self.next_integrity = clock()
+        self.integrity = False
+
+    def detect(self, decoded):
+        """
+        Method to find the channels whose value changed by more than their deadband since it was last reported.
+        :param decoded - dict of (position, values) indexed by response, as returned by Decoder.decode:
+        :return changed - dict of the reported values indexed by (response, channel number):
+        """
+        now = self.clock()
+        self.integrity = now >= self.next_integrity
+        if self.integrity:
+            self.next_integrity = now + self.integrity_period
+
+        previous = self.previous
+        absolute = self.absolute
+        percent = self.percent
+        integrity = self.integrity
+        changed = {}
+
+        for key, (position, values) in decoded.items():
+            slot = self.first[position]
+
+            for ch_number, value in enumerate(values):
+                last = previous[slot]
+
+                # Never reported values compare as NaN and are always reported
+                if integrity or not abs(value - last) <= absolute[slot] + percent[slot] * abs(last):
+                    previous[slot] = value
+                    changed[(key, ch_number)] = value
+
+                slot += 1
+
+        return changed
+
+
+# Detector of the loaded index with the index itself, so its identity stays valid
+_detector = None
+
+
+def get_detector(index, integrity_period=60):
+    """
+    Function to get the change detector of a join index, a new one reporting everything being created when the
+    index changed.
+    :param index - JoinIndex of the gateway and hosts publishers models:
+    :param integrity_period - seconds between two snapshots of every channel:
+    :return - ChangeDetector object:
+    """
+    global _detector
+
+    if _detector is None or _detector[0] is not index:
+        _detector = (index, ChangeDetector(index, integrity_period))
+
+    return _detector[1]
+
+
+def migrate(old_index, index, detector, runs):
+    """
+    Function to replace the detector of an index which was reloaded, the channels which did not change keep
+    their last reported values so they are not reported again.
+    :param old_index - JoinIndex the runs were computed from:
+    :param index - JoinIndex of the new models:
+    :param detector - ChangeDetector of the new index:
+    :param runs - list of (slot, old slot, count) ranges of channels to keep:
+    """
+    global _detector
+
+    if _detector is not None and _detector[0] is old_index:
+        old = _detector[1]
+
+        for slot, old_slot, count in runs:
+            detector.previous[slot:slot + count] = old.previous[old_slot:old_slot + count]
+
+        detector.next_integrity = old.next_integrity
+
+    _detector = (index, detector)
@@ -1,191 +1,20 @@
-import configparser
-import texttable
-import os
-from collections import OrderedDict
-from pprint import pprint
-
-
-class MultiOrderedDict(OrderedDict):
-
-    def __setitem__(self, key, value):
-
-        if isinstance(value, list) and key in self:
-            self[key].extend(value)
-        else:
-            super(MultiOrderedDict, self).__setitem__(key, value)
-
-
-class Section(configparser.ConfigParser):
-    """
-    Class for a section of a .conf/.ini file, a section defined as the starting [section] until
-    the next [section] beginning and all it's values.
-    """
-    def __init__(self, filename, key):
-        self.key = key
-
-        # Instantiante ConfigParser
-        conf = configparser.RawConfigParser(
-            dict_type=MultiOrderedDict, strict=False)
-        conf.read([filename])
-
-        self.config = conf
-
-
-class Concentrator(Section):
-    """
-    Class representing a concentrator from the configuration files 'concentrator= ...', and it's attributes.
-    """
-    def __init__(self, filename, section):
-        super().__init__(filename, section)
-        self.read_configuration()
-
-    def read_configuration(self):
-        """
-        Method which reads the value of the concentrator from the specified section of the configuration file,
-        extracting the comma sepaarated values and assigning them to the proper class attribute.
-        """
-        values = self.config[self.key]['CONCENTRATOR'].split(',')
-
-        self.all_attributes = values
-        self.CO_TSAP_ID = values[0]
-        self.CO_ID = values[1]
-        self.Data_Period = values[2]
-        self.Data_Phase = values[3]
-        self.Data_StaleLimit = values[4]
-        self.Data_version = values[5]
-        self.interfaceType = values[6]
-
-    def print_configuration(self):
-        """
-        Method to print a Concentrator object attributes as ASCII table.
-        """
-        # Create list to be passed to texttable and to STDOUT
-        concentrator_data = self.all_attributes
-        concentrator_data.append(self.key)
-
-        # Create texttable
-        table = texttable.Texttable()
-        table.set_cols_align(["c", "c", "c", "c", "c", "c", "c", "c"])
-        table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m"])
-        table.add_rows([["CO_TSAP_ID", "CO_ID", "Data_Period", "Data_Phase", "Data_StaleLimit", "Data_version", "interfaceType", "KEY"],
-                        concentrator_data])
-        print(table.draw())
-
-
-class Channel(Section):
-    """
-    Class representing all channels from the configuration files 'channel= ...', class which will iterate over
-    all channels from the specified sections.
-    """
-    def __init__(self, filename, section):
-        super().__init__(filename, section)
-        self.read_configuration()
-
-    def read_configuration(self):
-        """
-        Function which reads the value of the concentrator from the specified section of the configuration file,
-        extracting the comma sepaarated values and assigning them to the proper class attribute. Using a for loop
-        all the possible channel values will be iterated over from the defined section.
-        :return self.channels- a list of dictionaries for each channel:
-        """
-        self.channels = []
-
-        # Get all rows with 'channel=' and split by newline
-        all_channels = self.config.get(self.key, 'CHANNEL')
-        channels_data = all_channels.split('\n')
-
-        # Iterate over all channels and create a list of dicts
-        for index in range(0, len(channels_data)):
-
-            # Differentiate attributes by comma
-            attributes = channels_data[index].split(',')
-            
-            attributes_dict = {
-                "TSAP_ID": attributes[0],
-                "ObjID": attributes[1],
-                "AttrID": attributes[2],
-                "Index1": attributes[3],
-                "Index2": attributes[4],
-                "format": attributes[5],
-                "name": attributes[6],
-                "unit": attributes[7],
-                "withStatus": attributes[-1]
-            }
-
-            self.channels.append(attributes_dict)
-
-    def print_configuration(self):
-        """
-        Method to print a Channel object attributes as ASCII table.
-        """
-        # Create list to be passed to texttable and to STDOUT
-        channel_data = self.all_attributes
-        channel_data.append(self.key)
-        channel_data.append(self.channel)
-
-        # Create texttable
-        table = texttable.Texttable()
-        table.set_cols_align(["c", "c", "c", "c", "c", "c", "c", "c"])
-        table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m"])
-        table.add_rows([["TSAP_ID", "ObjID", "AttrID", "Index1", "Index2", "Status", "KEY", "CHANNEL"],
-                        channel_data])
-        print(table.draw())
-
-
-class Register(Section):
-    """
-    Class representing all register values from the configuration files 'register= ...', class which will iterate over
-    all the types registers from the specified file.
-    """
-    def __init__(self, filename, section="INPUT_REGISTERS"):
-        super().__init__(filename, section)
-        self.read_configuration()
-
-    def read_configuration(self):
-        """
-        Function which reads the value of the register from the specified section of the configuration file,
-        extracting the comma separated values and assigning them to the proper class attribute. Using a for loop
-        all the possible register values will be iterated over from the defined section.
-        :return self.channels- a list of dictionaries for each register:
-        """
-
-        # Grab all 'registers=' and separate them based on newline
-        all_registers = self.config.get(self.key, 'REGISTER')
-        registers_data = all_registers.split('\n')
-
-        self.registers = []
-
-        # Iterate over available registers
-        for index in range(0, len(registers_data)):
-
-            # Differentiate attributes by comma
-            attributes = registers_data[index].split(',')
-            
-            registers_dict = {
-                'start_addr': attributes[0],
-                'word_cnt': attributes[1],
-                'EUI64': attributes[2],
-                'TSAPID': attributes[3],
-                'ObjId': attributes[4],
-                'AttrId': attributes[5],
-                'Idx1': attributes[6],
-                'Idx2': attributes[7],
-                'MethId': attributes[8],
-                'status': attributes[-1]
-            }
-
-            self.registers.append(registers_dict)
-
-
 class Context():
     """
     Class to read the configuration file for the application to create an object
-    used for passing in between py modules for utilising those values in certain functions
+    used for passing in between py modules for utilising those values in certain functions.
+    The file is only read when the first value is used, so commands which do not need it start faster.
     """
-    def __init__(self):
+    def __getattr__(self, name):
+        # Only called for attributes which are not set yet
+        if name.startswith('__') or 'in_gw' in self.__dict__:
+            raise AttributeError(name)
+
         self.read_context()
+        return getattr(self, name)
 
     def read_context(self):
+        import configparser
+
         # Read configuration file for application and set attributes
         conf = configparser.RawConfigParser(strict=False)
         conf.read(['context.ini'])
@@ -198,6 +27,77 @@ class Context():
         self.output_file = conf['working_context']['resp_file']
         self.address = conf['working_context']['address']
         self.port = conf['working_context']['port']
+        self.read_gap = conf['working_context'].get('read_gap', '0')
+        self.poller = conf['working_context'].get('poller', 'sync')
+        self.workers = conf['working_context'].get('workers', '1')
+        self.cycle_timeout = conf['working_context'].get('cycle_timeout', '5')
+        self.schedule_policy = conf['working_context'].get('schedule_policy', 'skip')
+        self.unit = conf['working_context'].get('unit', '0')
+        self.idle_timeout = conf['working_context'].get('idle_timeout', '60')
+        self.min_timeout = conf['working_context'].get('min_timeout', '0.05')
+        self.max_timeout = conf['working_context'].get('max_timeout', '3')
+        self.retries = conf['working_context'].get('retries', '1')
+        self.retry_backoff = conf['working_context'].get('retry_backoff', '0.05')
+        self.breaker_threshold = conf['working_context'].get('breaker_threshold', '3')
+        self.probe_interval = conf['working_context'].get('probe_interval', '30')
+        self.max_probe_interval = conf['working_context'].get('max_probe_interval', '600')
+        self.export_snapshots = conf['working_context'].get('export_snapshots', 'true')
+        self.byte_order = conf['working_context'].get('byte_order', 'big')
+        self.dashboard = conf['working_context'].get('dashboard', 'true')
+        self.refresh_rate = conf['working_context'].get('refresh_rate', '4')
+        self.store = conf['working_context'].get('store', 'false')
+        self.store_dir = conf['working_context'].get('store_dir', '../out/store')
+        self.segment_size = conf['working_context'].get('segment_size', '16777216')
+        self.retention = conf['working_context'].get('retention', '604800')
+        self.word_order = conf['working_context'].get('word_order', 'big')
+        self.report_by_exception = conf['working_context'].get('report_by_exception', 'false')
+        self.integrity_period = conf['working_context'].get('integrity_period', '60')
+        self.publish = conf['working_context'].get('publish', 'false')
+        self.mqtt_address = conf['working_context'].get('mqtt_address', '127.0.0.1')
+        self.mqtt_port = conf['working_context'].get('mqtt_port', '1883')
+        self.mqtt_client_id = conf['working_context'].get('mqtt_client_id', 'modbus-iot-cli')
+        self.mqtt_topic = conf['working_context'].get('mqtt_topic', 'modbus/readings')
+        self.publish_batch = conf['working_context'].get('publish_batch', '500')
+        self.publish_queue = conf['working_context'].get('publish_queue', '64')
+        self.publish_policy = conf['working_context'].get('publish_policy', 'drop_oldest')
+        self.publish_timeout = conf['working_context'].get('publish_timeout', '1')
+        self.spill_dir = conf['working_context'].get('spill_dir', '../out/spill')
+        self.spill_limit = conf['working_context'].get('spill_limit', '67108864')
+        self.metrics_address = conf['working_context'].get('metrics_address', '127.0.0.1')
+        self.metrics_port = conf['working_context'].get('metrics_port', '0')
+        self.metrics_file = conf['working_context'].get('metrics_file', '../out/metrics.json')
+        self.export = conf['working_context'].get('export', 'false')
+        self.export_dir = conf['working_context'].get('export_dir', '../out/export')
+        self.export_format = conf['working_context'].get('export_format', 'parquet')
+        self.export_partition = conf['working_context'].get('export_partition', 'day')
+        self.export_row_group = conf['working_context'].get('export_row_group', '65536')
+        self.rollups = conf['working_context'].get('rollups', 'false')
+        self.rollup_dir = conf['working_context'].get('rollup_dir', '../out/rollups')
+        self.rollup_resolutions = conf['working_context'].get('rollup_resolutions', '1m,1h')
+        self.rollup_flush = conf['working_context'].get('rollup_flush', '5')
+        self.hot_reload = conf['working_context'].get('hot_reload', 'false')
+        self.reload_interval = conf['working_context'].get('reload_interval', '1')
+        self.rpc = conf['working_context'].get('rpc', 'false')
+        self.rpc_socket = conf['working_context'].get('rpc_socket', '../out/modbus-iot-cli.sock')
+
+        # Gateways polled by the asynchronous poller, defaults to the working context gateway
+        self.gateways = []
+        for section in conf.sections():
+            if section.startswith('gateway:'):
+                self.gateways.append({
+                    'name': section.split(':', 1)[1],
+                    'address': conf[section]['address'],
+                    'port': conf[section].get('port', '502'),
+                    'in_gw': conf[section].get('in_gw', self.in_gw),
+                    'unit': conf[section].get('unit', '0'),
+                    'timeout': conf[section].get('timeout', '3'),
+                    'max_concurrency': conf[section].get('max_concurrency', '1')
+                })
+
+        if not self.gateways:
+            self.gateways.append({'name': self.address, 'address': self.address, 'port': self.port,
+                                  'in_gw': self.in_gw, 'unit': self.unit, 'timeout': self.max_timeout,
+                                  'max_concurrency': '1'})
 
 # Instantiate Context object
 settings = Context()
\ No newline at end of file
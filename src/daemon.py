@@ -0,0 +1,136 @@
+import os
+import threading
+import socketserver
+
+from classes import settings
+from rpc import REQUEST, REPLY, ERROR, call, send, receive
+
+
+class LiveState():
+    """
+    Class holding what the polling loop last reported: the responses with the models and the staleness tracker
+    they are interpreted with. The references are replaced at once every cycle, never changed in place.
+    """
+    def __init__(self):
+        self.resp = None
+        self.hosts = None
+        self.registers = None
+        self.tracker = None
+
+    def update(self, resp, hosts, registers, tracker):
+        self.resp, self.hosts, self.registers, self.tracker = resp, hosts, registers, tracker
+
+
+class RpcHandler(socketserver.BaseRequestHandler):
+    """
+    Class answering the requests of a CLI connection, one request after the other until it closes.
+    """
+    def handle(self):
+        while True:
+            try:
+                kind, request = receive(self.request)
+            except (ConnectionError, OSError, ValueError):
+                return
+
+            try:
+                if kind != REQUEST:
+                    raise ValueError(f"Unexpected message kind {kind}")
+
+                method = getattr(self.server, "rpc_" + request["method"], None)
+                if method is None:
+                    raise ValueError(f"Unknown method {request['method']!r}")
+
+                send(self.request, REPLY, method(**request.get("params", {})))
+            except Exception as e:
+                send(self.request, ERROR, f"{type(e).__name__}: {e}")
+
+
+class RpcServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Class serving the state of the running synchronization on a Unix socket, so the CLI commands answer from the
+    warm models and the last responses instead of parsing the files and reading the gateways again. Every message
+    is a frame of its kind and length followed by a JSON body.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.thread = None
+
+        # A socket left by a synchronization which did not stop cleanly is replaced
+        if os.path.exists(path):
+            if call("ping", path=path) is not None:
+                raise RuntimeError(f"Another synchronization is serving {path}")
+            os.unlink(path)
+
+        super().__init__(path, RpcHandler)
+        os.chmod(path, 0o600)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="rpc-server", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _live(self):
+        state = self.state
+        if state.resp is None:
+            raise RuntimeError("Nothing was read yet")
+
+        return state.resp, state.hosts, state.registers, state.tracker
+
+    def rpc_ping(self):
+        return {"pid": os.getpid()}
+
+    def rpc_responses(self):
+        resp, _, _, _ = self._live()
+        return resp
+
+    def rpc_rows(self):
+        from file_parser import response_rows
+
+        resp, hosts, registers, tracker = self._live()
+        rows = response_rows(resp, hosts, registers, tracker)
+
+        return [[majorkey, ch_number, *row] for (majorkey, ch_number), row in rows.items()]
+
+    def rpc_stats(self):
+        from metrics import metrics
+
+        return metrics.snapshot()
+
+    def rpc_hosts_table(self, hosts, gateway):
+        from model import load_gateway, load_hosts
+        from file_parser import hosts_rows
+
+        # The models of the synchronized files are cached, other files are parsed once and cached too
+        return hosts_rows(load_hosts(hosts), load_gateway(gateway).registers)
+
+
+# State of the synchronization running in this process
+live = LiveState()
+
+
+def start_server(force=False):
+    """
+    Function to serve the state of the synchronization on the configured socket.
+    :param force - serve even if rpc is disabled in the context, as the daemon does:
+    :return - RpcServer object, None if serving is disabled or failed:
+    """
+    if settings.rpc != 'true' and not force:
+        return None
+
+    try:
+        server = RpcServer(settings.rpc_socket, live)
+    except (OSError, RuntimeError) as e:
+        print(f"Could not serve requests on {settings.rpc_socket}: {e}")
+        return None
+
+    server.start()
+    return server
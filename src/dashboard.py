@@ -0,0 +1,248 @@
+import sys
+import time
+import shutil
+import threading
+
+from metrics import RENDER_SECONDS
+
+# ANSI escape sequences
+CLEAR = "\x1b[2J"
+MOVE = "\x1b[{};{}H"
+HIDE_CURSOR = "\x1b[?25l"
+SHOW_CURSOR = "\x1b[?25h"
+REVERSE = "\x1b[7m"
+RESET = "\x1b[0m"
+
+
+def _cell(value):
+    # Floats are shown with a fixed precision so small changes do not resize the cell
+    if isinstance(value, float):
+        return f"{value:.4g}"
+
+    return str(value)
+
+
+class Dashboard():
+    """
+    Class for a live terminal view of the readings. It keeps the model of the rows and of what is on screen, and
+    only repaints the cells whose text changed. Rendering runs on its own thread at most refresh_rate times per
+    second, so the polling loop only pays for updating the model.
+    """
+    def __init__(self, headers, widths, refresh_rate=4, out=sys.stdout):
+        self.headers = headers
+        self.widths = widths
+        self.interval = 1.0 / float(refresh_rate)
+        self.out = out
+
+        self.rows = {}
+        self.order = []
+        self.status = ""
+
+        # Cells on screen indexed by (line, column), view settings and what they were when last drawn
+        self.screen = {}
+        self.offset = 0
+        self.filter = ""
+        self.layout = None
+
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.keys = None
+        # Terminal settings to restore once the keys are no longer read
+        self.attributes = None
+
+        self.render_seconds = RENDER_SECONDS.labels(output="dashboard")
+
+    def update(self, rows, status=""):
+        """
+        Method to replace the rows shown, only the changed cells will be repainted.
+        :param rows - dict of rows (lists of cell values) indexed by a stable key:
+        :param status - text of the status line:
+        """
+        with self.lock:
+            self.order = list(rows)
+            self.rows = {key: [_cell(value) for value in row] for key, row in rows.items()}
+            self.status = status
+
+        self.dirty.set()
+
+    def patch(self, rows, status=""):
+        """
+        Method to change some of the rows shown, the other rows are kept as they are.
+        :param rows - dict of changed rows (lists of cell values) indexed by a stable key:
+        :param status - text of the status line:
+        """
+        with self.lock:
+            for key, row in rows.items():
+                if key not in self.rows:
+                    self.order.append(key)
+                self.rows[key] = [_cell(value) for value in row]
+
+            self.status = status
+
+        self.dirty.set()
+
+    def scroll(self, lines):
+        """
+        Method to scroll the rows, negative values scroll up.
+        """
+        with self.lock:
+            self.offset = max(0, self.offset + lines)
+
+        self.dirty.set()
+
+    def set_filter(self, text):
+        """
+        Method to only show the rows containing the text in one of their cells.
+        """
+        with self.lock:
+            self.filter = text
+            self.offset = 0
+
+        self.dirty.set()
+
+    def _visible(self, height):
+        # Rows matching the filter and the slice of them which fits on screen
+        keys = self.order
+        if self.filter:
+            keys = [key for key in keys if any(self.filter in cell for cell in self.rows[key])]
+
+        self.offset = min(self.offset, max(0, len(keys) - height))
+        return keys, keys[self.offset:self.offset + height]
+
+    def render(self):
+        """
+        Method to write to the terminal the cells which changed since the previous render.
+        """
+        start = time.perf_counter()
+        size = shutil.get_terminal_size()
+        height = max(1, size.lines - 3)
+
+        with self.lock:
+            keys, visible = self._visible(height)
+            layout = (size, self.offset, self.filter, len(visible))
+
+            output = []
+
+            # Redraw everything when the view changed
+            if layout != self.layout:
+                self.layout = layout
+                self.screen = {}
+                output.append(CLEAR)
+                self._paint(output, 1, self.headers, REVERSE)
+
+            for line, key in enumerate(visible, start=2):
+                self._paint(output, line, self.rows[key])
+
+            status = f"{self.status} | rows {self.offset + 1}-{self.offset + len(visible)} of {len(keys)}"
+            if self.filter:
+                status += f" | filter '{self.filter}'"
+            self._paint(output, height + 3, [status.ljust(size.columns - 1)], widths=[size.columns - 1])
+
+        if output:
+            self.out.write("".join(output))
+            self.out.flush()
+
+        self.render_seconds.observe(time.perf_counter() - start)
+
+    def _paint(self, output, line, cells, style="", widths=None):
+        column = 1
+
+        for position, (cell, width) in enumerate(zip(cells, widths or self.widths)):
+            text = cell[:width].ljust(width)
+
+            if self.screen.get((line, position)) != text:
+                self.screen[(line, position)] = text
+                output.append(MOVE.format(line, column) + style + text + (RESET if style else ""))
+
+            column += width + 1
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.dirty.wait(self.interval):
+                self.dirty.clear()
+                self.render()
+
+            # Keep at most one render per interval whatever the rate of updates
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Method to start rendering on a background thread, and reading the keys when attached to a terminal.
+        """
+        self.out.write(HIDE_CURSOR)
+        self.thread = threading.Thread(target=self._run, name="dashboard", daemon=True)
+        self.thread.start()
+
+        if sys.stdin.isatty():
+            try:
+                import tty
+                import termios
+            except ImportError:
+                return
+
+            fd = sys.stdin.fileno()
+            self.attributes = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+
+            self.keys = threading.Thread(target=self._read_keys, args=(fd,), name="dashboard-keys", daemon=True)
+            self.keys.start()
+
+    def stop(self):
+        """
+        Method to stop rendering and reading the keys, and restore the terminal.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.keys is not None:
+            self.keys.join()
+
+        if self.attributes is not None:
+            import termios
+
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, self.attributes)
+            self.attributes = None
+
+        self.out.write(SHOW_CURSOR + MOVE.format(shutil.get_terminal_size().lines, 1) + "\n")
+        self.out.flush()
+
+    def _read_keys(self, fd):
+        """
+        Method reading single key presses: j/k scroll a line, n/p a page, / starts a filter ended by Enter
+        and Esc clears the filter. Keys are waited for at most one refresh interval, so it ends with stop().
+        :param fd - descriptor of the terminal, already in cbreak mode:
+        """
+        import os
+        import select
+
+        typing = None
+
+        while not self.stopped.is_set():
+            if not select.select([fd], [], [], self.interval)[0]:
+                continue
+
+            key = os.read(fd, 1).decode(errors="ignore")
+            page = max(1, shutil.get_terminal_size().lines - 3)
+
+            if typing is not None:
+                if key in ("\n", "\r"):
+                    self.set_filter(typing)
+                    typing = None
+                elif key == "\x7f":
+                    typing = typing[:-1]
+                else:
+                    typing += key
+            elif key == "j":
+                self.scroll(1)
+            elif key == "k":
+                self.scroll(-1)
+            elif key == "n":
+                self.scroll(page)
+            elif key == "p":
+                self.scroll(-page)
+            elif key == "/":
+                typing = ""
+            elif key == "\x1b":
+                self.set_filter("")
@@ -0,0 +1,152 @@
+import struct
+from operator import itemgetter
+
+# Size in words and big endian struct code of every channel format, 8 bit values sit in the low byte of a register
+FORMATS = {
+    'int8': (1, 'xb'),
+    'uint8': (1, 'xB'),
+    'int16': (1, 'h'),
+    'uint16': (1, 'H'),
+    'int32': (2, 'i'),
+    'uint32': (2, 'I'),
+    'float': (2, 'f')
+}
+
+# Format used for channels with an unknown format
+DEFAULT_FORMAT = 'uint16'
+
+
+def _byte_order(first_word, size, byte_order, word_order):
+    """
+    Function to get the position in the read buffer of every byte of a value, ordered most significant first.
+    :param first_word - position of the first word of the value in the buffer:
+    :param size - number of words of the value:
+    :param byte_order - order of the bytes inside a word, 'big' or 'little':
+    :param word_order - order of the words of a multi word value, 'big' or 'little':
+    :return - list of byte positions:
+    """
+    words = range(first_word, first_word + size)
+    if word_order == 'little':
+        words = reversed(words)
+
+    positions = []
+    for word in words:
+        if byte_order == 'little':
+            positions.extend((2 * word + 1, 2 * word))
+        else:
+            positions.extend((2 * word, 2 * word + 1))
+
+    return positions
+
+
+class Decoder():
+    """
+    Class decoding the responses of a gateway into the typed values of the channels mapped on each register.
+    The decode plan is computed once from the join index: all registers are laid out in a single buffer, the
+    bytes are reordered with one precomputed permutation and all the channels are unpacked with a single
+    struct call.
+    """
+    def __init__(self, index, byte_order='big', word_order='big'):
+        formats = ['>']
+        permutation = []
+
+        self.index = index
+        self.starts = []
+        self.word_cnts = []
+        self.slices = []
+
+        offset = 0
+        values_cnt = 0
+
+        for reg, layout in zip(index.registers, index.layouts):
+            used = 0
+            for ch, first_word, size, code in layout:
+                formats.append(code)
+                permutation.extend(_byte_order(offset + first_word, size, byte_order, word_order))
+                used = first_word + size
+
+            # Skip the words which are not mapped on a channel
+            if used < reg.word_cnt:
+                formats.append(f"{2 * (reg.word_cnt - used)}x")
+                permutation.extend(range(2 * (offset + used), 2 * (offset + reg.word_cnt)))
+
+            self.starts.append(offset)
+            self.word_cnts.append(reg.word_cnt)
+            self.slices.append((values_cnt, values_cnt + len(layout)))
+
+            offset += reg.word_cnt
+            values_cnt += len(layout)
+
+        self.words = offset
+        self.struct = struct.Struct(''.join(formats))
+        self.pack = struct.Struct(f">{offset}H").pack
+
+        # No reordering is needed for big endian values
+        if permutation == list(range(2 * offset)):
+            self.permute = None
+        else:
+            self.permute = itemgetter(*permutation)
+
+    def decode(self, resp):
+        """
+        Method to decode the responses read from the gateway.
+        :param resp - dict of responses as returned by modbus.read_registers:
+        :return decoded - dict indexed as resp, with the register position and the channel values of every response:
+        """
+        words = [0] * self.words
+        found = {}
+
+        # Copy the response words at their place in the buffer
+        for key, r in resp.items():
+            position = self.index.position(key, r)
+
+            if position is not None and len(r["response"]) == self.word_cnts[position]:
+                start = self.starts[position]
+                words[start:start + len(r["response"])] = r["response"]
+                found[key] = position
+
+        buffer = self.pack(*words)
+        if self.permute is not None:
+            buffer = bytes(self.permute(buffer))
+
+        values = self.struct.unpack(buffer)
+
+        decoded = {}
+        for key, position in found.items():
+            first, last = self.slices[position]
+            decoded[key] = (position, values[first:last])
+
+        return decoded
+
+
+# Decoder of the loaded index with the index itself, so its identity stays valid
+_decoder = None
+
+
+def get_decoder(index, byte_order='big', word_order='big'):
+    """
+    Function to get the decoder of a join index, creating it only when the index changed.
+    :param index - JoinIndex of the gateway and hosts publishers models:
+    :param byte_order - order of the bytes inside a word, 'big' or 'little':
+    :param word_order - order of the words of a multi word value, 'big' or 'little':
+    :return - Decoder object:
+    """
+    global _decoder
+
+    if _decoder is None or _decoder[0] is not index or _decoder[1] != (byte_order, word_order):
+        _decoder = (index, (byte_order, word_order), Decoder(index, byte_order, word_order))
+
+    return _decoder[2]
+
+
+def set_decoder(index, byte_order, word_order, decoder):
+    """
+    Function to replace the decoder of a join index with one built in advance, e.g. while reloading the models.
+    :param index - JoinIndex of the gateway and hosts publishers models:
+    :param byte_order - order of the bytes inside a word, 'big' or 'little':
+    :param word_order - order of the words of a multi word value, 'big' or 'little':
+    :param decoder - Decoder of the index:
+    """
+    global _decoder
+
+    _decoder = (index, (byte_order, word_order), decoder)
@@ -0,0 +1,359 @@
+import os
+import csv
+import time
+from array import array
+from collections import OrderedDict
+
+from classes import settings
+
+# Columns of the exported readings, in file order
+COLUMNS = ('device', 'channel', 'timestamp', 'value', 'status')
+
+PARQUET = "parquet"
+CSV = "csv"
+
+
+def _open_files():
+    """
+    Function to get how many partition files an export keeps open, a quarter of the file descriptors allowed to
+    the process up to 512.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 32
+
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 512
+
+    return max(32, min(512, soft // 4))
+
+
+def _arrow():
+    """
+    Function to get pyarrow and its Parquet module, which are optional.
+    :return - (pyarrow, pyarrow.parquet), None if pyarrow is not installed:
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+
+    return pyarrow, pyarrow.parquet
+
+
+class ColumnBatch():
+    """
+    Class holding readings column by column until they are written as a row group.
+    """
+    __slots__ = ('device', 'channel', 'timestamp', 'value', 'status')
+
+    def __init__(self):
+        self.device = []
+        self.channel = array('l')
+        self.timestamp = array('q')
+        self.value = array('d')
+        self.status = []
+
+    def __len__(self):
+        return len(self.timestamp)
+
+
+class CsvPart():
+    """
+    Class appending batches to the CSV file of a partition, the header being written when the file is created.
+    Timestamps are written as UTC times like in the responses.
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "part-0.csv")
+        new = not os.path.exists(self.path)
+
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        self.times = {}
+
+        if new:
+            self.writer.writerow(COLUMNS)
+
+    def _time(self, timestamp):
+        # Readings of a cycle share their timestamp, so each one is only formatted once
+        text = self.times.get(timestamp)
+        if text is None:
+            if len(self.times) > 4096:
+                self.times.clear()
+            text = self.times[timestamp] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp // 10**9))
+
+        return text
+
+    def write(self, batch):
+        self.writer.writerows(zip(batch.device, batch.channel, map(self._time, batch.timestamp), batch.value,
+                                  batch.status))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPart():
+    """
+    Class writing batches to a Parquet file of a partition, one row group per batch. A Parquet file cannot be
+    appended to once closed, so every writer opens the next part file of the partition. The device column is left
+    out of the files of device partitions, where it is the name of the directory, and timestamps are stored in
+    microseconds, the resolution most analytics tools read.
+    """
+    def __init__(self, directory, arrow, with_device=True):
+        self.pa, pq = arrow
+        self.with_device = with_device
+
+        number = sum(1 for name in os.listdir(directory) if name.endswith(".parquet"))
+        self.path = os.path.join(directory, f"part-{number:05d}.parquet")
+
+        fields = [
+            ('device', self.pa.dictionary(self.pa.int32(), self.pa.string())),
+            ('channel', self.pa.int32()),
+            ('timestamp', self.pa.timestamp('us', tz='UTC')),
+            ('value', self.pa.float64()),
+            ('status', self.pa.dictionary(self.pa.int32(), self.pa.string()))
+        ]
+        self.schema = self.pa.schema(fields if with_device else fields[1:])
+        self.writer = pq.ParquetWriter(self.path, self.schema, compression='zstd')
+
+    def write(self, batch):
+        pa = self.pa
+        microseconds = self.schema.field('timestamp').type
+        columns = [
+            pa.array(batch.channel, pa.int32()),
+            pa.array(batch.timestamp, pa.timestamp('ns', tz='UTC')).cast(microseconds, safe=False),
+            pa.array(batch.value, pa.float64()),
+            pa.array(batch.status, pa.string()).dictionary_encode()
+        ]
+        if self.with_device:
+            columns.insert(0, pa.array(batch.device, pa.string()).dictionary_encode())
+
+        table = pa.Table.from_arrays(columns, schema=self.schema)
+
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+class ColumnarExporter():
+    """
+    Class exporting readings in columnar form, partitioned by day and/or device in directories named
+    'day=<YYYY-MM-DD>' and 'device=<EUI64>' so analytics tools read the partitions as columns. Readings are
+    buffered per partition and written as a row group when row_group of them are waiting. Once max_rows are
+    waiting in total, every buffer of at least min_rows is written in one pass, and smaller ones only while more
+    than half of max_rows are still waiting. Files stay open up to max_open, so the row groups of a partition go
+    to the same Parquet file instead of a new part every time it is written.
+    """
+    def __init__(self, path, fmt=PARQUET, partition=("day",), row_group=65536, max_rows=None, max_open=None,
+                 min_rows=None):
+        self.path = path
+        self.partition = tuple(partition)
+        self.row_group = int(row_group)
+        self.max_rows = int(max_rows) if max_rows else 16 * self.row_group
+        self.max_open = int(max_open) if max_open else _open_files()
+        self.min_rows = int(min_rows) if min_rows else max(1, self.row_group // 16)
+
+        unknown = set(self.partition) - {"day", "device"}
+        if unknown:
+            raise ValueError(f"Cannot partition by {', '.join(sorted(unknown))}, expected day and/or device")
+
+        self.arrow = _arrow() if fmt == PARQUET else None
+        if fmt == PARQUET and self.arrow is None:
+            print("pyarrow is not installed, exporting to chunked CSV files instead of Parquet")
+        self.format = PARQUET if self.arrow else CSV
+
+        self.buffers = {}
+        self.buffered = 0
+        self.parts = OrderedDict()
+        self.keys = {}
+        self.times = {}
+        self.exported = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def _key(self, device, timestamp):
+        # Directory of the partition of a reading, relative to the export path
+        day = timestamp // (86400 * 10**9)
+        key = self.keys.get((device, day))
+        if key is not None:
+            return key
+
+        if len(self.keys) > 65536:
+            self.keys.clear()
+
+        names = []
+        for column in self.partition:
+            if column == "day":
+                names.append("day=" + time.strftime("%Y-%m-%d", time.gmtime(day * 86400)))
+            else:
+                names.append("device=" + device)
+
+        key = self.keys[(device, day)] = os.path.join(*names) if names else ""
+        return key
+
+    def add(self, device, channel, timestamp, value, status):
+        """
+        Method to add a reading to the export.
+        :param device - EUI64 of the device:
+        :param channel - number of the channel in the device, starting at 1:
+        :param timestamp - moment of the read in epoch nanoseconds:
+        :param value - value of the channel:
+        :param status - status of the device, e.g. 'Fresh':
+        """
+        key = self._key(device, timestamp)
+
+        batch = self.buffers.get(key)
+        if batch is None:
+            batch = self.buffers[key] = ColumnBatch()
+
+        batch.device.append(device)
+        batch.channel.append(channel)
+        batch.timestamp.append(timestamp)
+        batch.value.append(value)
+        batch.status.append(status)
+        self.buffered += 1
+
+        if len(batch) >= self.row_group:
+            self._flush(key)
+        elif self.buffered >= self.max_rows:
+            self._relieve()
+
+    def submit(self, rows):
+        """
+        Method to add the decoded rows of a cycle to the export.
+        :param rows - dict of [device, value, unit, last read, status] rows indexed by (response, channel number), as
+        returned by file_parser.response_rows or response_changes:
+        """
+        from store import parse_time
+
+        for (_, ch_number), (device, value, _, last_read, status) in rows.items():
+            timestamp = self.times.get(last_read)
+            if timestamp is None:
+                if len(self.times) > 4096:
+                    self.times.clear()
+                timestamp = self.times[last_read] = parse_time(last_read)
+
+            self.add(device, ch_number + 1, timestamp, value, status)
+
+    def _part(self, key):
+        # Open file of a partition, the least recently used one is closed above max_open
+        part = self.parts.get(key)
+        if part is not None:
+            self.parts.move_to_end(key)
+            return part
+
+        if len(self.parts) >= self.max_open:
+            _, oldest = self.parts.popitem(last=False)
+            oldest.close()
+
+        directory = os.path.join(self.path, key)
+        os.makedirs(directory, exist_ok=True)
+
+        if self.arrow:
+            part = ParquetPart(directory, self.arrow, "device" not in self.partition)
+        else:
+            part = CsvPart(directory)
+
+        self.parts[key] = part
+        return part
+
+    def _relieve(self):
+        # Write every buffer of at least min_rows, then the largest others while more than half of max_rows wait
+        for key in sorted(self.buffers, key=lambda k: len(self.buffers[k]), reverse=True):
+            if len(self.buffers[key]) < self.min_rows and self.buffered <= self.max_rows // 2:
+                break
+            self._flush(key)
+
+    def _flush(self, key):
+        batch = self.buffers.pop(key)
+        self.buffered -= len(batch)
+        self.exported += len(batch)
+
+        self._part(key).write(batch)
+
+    def flush(self):
+        """
+        Method to write all the buffered readings.
+        """
+        for key in list(self.buffers):
+            self._flush(key)
+
+    def close(self):
+        """
+        Method to write the buffered readings and close the files of the export.
+        """
+        self.flush()
+
+        while self.parts:
+            _, part = self.parts.popitem()
+            part.close()
+
+
+def export_history(stores, devices, registers, exporter, start=0, end=None):
+    """
+    Function to export the reads kept in the history stores, decoded into channel readings with the configured
+    models. Stored reads were successful, so their readings are exported as 'Fresh'.
+    :param stores - list of Store objects:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects:
+    :param exporter - ColumnarExporter object:
+    :param start - first moment in epoch nanoseconds:
+    :param end - last moment in epoch nanoseconds, no limit if not specified:
+    :return - number of exported readings:
+    """
+    from identity import get_index
+    from decode import get_decoder
+
+    index = get_index(registers, devices)
+    decoder = get_decoder(index, settings.byte_order, settings.word_order)
+    exported = exporter.exported + exporter.buffered
+
+    for store in stores:
+        # The reads of a cycle share their timestamp and are decoded together
+        cycle = {}
+        cycle_time = None
+
+        for timestamp, eui64, table, register, words in store.records(start, end):
+            position = index.lookup.get((table, eui64, register))
+            if position is None:
+                continue
+
+            if timestamp != cycle_time or position in cycle:
+                _export_cycle(exporter, decoder, index, cycle, cycle_time)
+                cycle = {}
+                cycle_time = timestamp
+
+            cycle[position] = {"table": table, "device": eui64, "register": register, "response": words}
+
+        _export_cycle(exporter, decoder, index, cycle, cycle_time)
+
+    exporter.flush()
+
+    return exporter.exported - exported
+
+
+def _export_cycle(exporter, decoder, index, cycle, timestamp):
+    for position, values in decoder.decode(cycle).values():
+        device = index.eui64s[position]
+
+        for ch_number, value in enumerate(values, 1):
+            exporter.add(device, ch_number, timestamp, value, "Fresh")
+
+
+def create_exporter(path=None):
+    """
+    Function to create the columnar exporter configured in the context.
+    :param path - directory of the export, the configured export_dir if not specified:
+    :return - ColumnarExporter object, None if the export is disabled and no path is specified:
+    """
+    if path is None and settings.export != 'true':
+        return None
+
+    partition = [column.strip() for column in settings.export_partition.split(',') if column.strip() != 'none']
+
+    return ColumnarExporter(path or settings.export_dir, settings.export_format, partition,
+                            settings.export_row_group)
@@ -1,48 +1,54 @@
-import configparser
-from classes import Concentrator, Register, Section, MultiOrderedDict, Channel, settings
-import texttable
-import random
+from classes import settings
+from model import load_hosts, load_gateway, GatewayTables
 import json
 
-# Statuses used for data availability
-status = ["Fresh", "Stale"]
+# Modules only needed by some of the commands, texttable included, are imported by the functions using them, to
+# keep the startup fast
 
 
-def map_host_publishers(filename):
+def hosts_to_json(devices):
     """
-    Function to map the publishers configuration file and output all data in a JSON file
-    :param filename - file to be parsed and mapped:
-    :return - path to output file:
+    Function to convert the hosts publishers model to the mapped JSON structure.
+    :param devices - dict of Device objects indexed by EUI64:
+    :return json_data - mapped data:
     """
-    config = configparser.RawConfigParser(dict_type=MultiOrderedDict, strict=False)
-    config.read(filename)
-
     json_data = {}
 
-    for section in config.sections():
+    for eui64, device in devices.items():
         json_section = {}
 
-        # Create read objects as dictionaries
-        concentrator_obj = Concentrator(filename, section).__dict__
-        channel_obj = Channel(filename, section).__dict__
-
-        # Remove unecessary keys
-        concentrator_obj.pop('config', None)
-        concentrator_obj.pop('key', None)
-        channel_obj.pop('config', None)
-
         # Create concentrator section
+        concentrator_obj = device.concentrator.as_dict()
+        concentrator_obj['all_attributes'] = list(concentrator_obj.values())
         json_section['concentrator'] = concentrator_obj
 
-        # Remove colon from section name
-        section = ''.join(section.split(':'))
+        json_section[eui64] = {'channels': [ch.as_dict() for ch in device.channels]}
+        json_data[eui64] = json_section
+
+    return json_data
+
+
+def gateway_to_json(tables):
+    """
+    Function to convert the MODBUS gateway model to the mapped JSON structure.
+    :param tables - dict of RegisterRecord lists indexed by section:
+    :return json_data - mapped data:
+    """
+    return {section_key: {'registers': [reg.as_dict() for reg in registers]}
+            for section_key, registers in tables.items()}
 
-        json_section[section] = channel_obj
-        json_data[section] = json_section
+
+def map_host_publishers(filename):
+    """
+    Function to map the publishers configuration file and output all data in a JSON file
+    :param filename - file to be parsed and mapped:
+    :return - path to output file:
+    """
+    from metrics import timer, MAP_SECONDS
 
     # Write mapped data to a JSON file
-    with open(settings.out_hosts, 'w+') as json_file:
-        json.dump(json_data, json_file, indent=4, sort_keys=True)
+    with timer(MAP_SECONDS.labels(file="hosts")), open(settings.out_hosts, 'w+') as json_file:
+        json.dump(hosts_to_json(load_hosts(filename)), json_file, indent=4, sort_keys=True)
 
     return settings.out_hosts
 
@@ -54,29 +60,59 @@ def map_modbus_gw(filename):
     :param filename - path to gateway file:
     :return - path to output file:
     """
-    config = configparser.RawConfigParser(dict_type=MultiOrderedDict, strict=False)
-    config.read(filename)
+    from metrics import timer, MAP_SECONDS
 
-    json_data = {}
+    # Write mapped data to a JSON file
+    with timer(MAP_SECONDS.labels(file="gateway")), open(settings.out_gateway, 'w+') as json_file:
+        json.dump(gateway_to_json(load_gateway(filename)), json_file, indent=4, sort_keys=True)
 
-    for section in config.sections():
-        
-        # Create dict from object
-        register_obj = Register(filename, section).__dict__
+    return settings.out_gateway
 
-        section_key = register_obj.get('key', 'DEFAULT')
 
-        # Remove uncessary attributes
-        register_obj.pop('config', None)
-        register_obj.pop('key', None)
+# Models last exported to every snapshot file, the JSON of a model is only built again once it was reloaded
+_exported = {}
 
-        json_data[section_key] = register_obj
 
-    # Write mapped data to a JSON file
-    with open(settings.out_gateway, 'w+') as json_file:
-        json.dump(json_data, json_file, indent=4, sort_keys=True)
+def _model_changed(path, models):
+    # The models are compared by identity, the cached models of unchanged files being the same objects
+    previous = _exported.get(path)
+    if previous is not None and len(previous) == len(models) and all(old is new for old, new in zip(previous, models)):
+        return False
+
+    _exported[path] = models
+    return True
 
-    return settings.out_gateway
+
+def export_snapshots(tables, devices, resp):
+    """
+    Function to export in the background the mapped configuration and the responses as JSON files. The mapped
+    configuration is only converted when the models changed, and each file is only written when its content did.
+    :param tables - gateway model, or dict of the gateway models indexed by gateway name in the order of the
+    positions of the responses:
+    :param devices - hosts publishers model:
+    :param resp - responses of the last read:
+    """
+    if settings.export_snapshots != 'true':
+        return
+
+    from snapshot import snapshots
+
+    gateways = {None: tables} if isinstance(tables, GatewayTables) else tables
+
+    if _model_changed(settings.out_gateway, tuple(gateways.values())):
+        if len(gateways) == 1:
+            mapped = gateway_to_json(next(iter(gateways.values())))
+        else:
+            mapped = {name: gateway_to_json(gateway) for name, gateway in gateways.items()}
+
+        snapshots.submit(settings.out_gateway, mapped, sort_keys=True)
+
+    if _model_changed(settings.out_hosts, (devices,)):
+        snapshots.submit(settings.out_hosts, hosts_to_json(devices), sort_keys=True)
+
+    # Keep the previous responses until something was read
+    if resp:
+        snapshots.submit(settings.output_file, resp)
 
 
 def print_all_sections(filename):
@@ -85,17 +121,15 @@ def print_all_sections(filename):
     :param filename - configuration file:
     :return:
     """
+    import texttable
+    from stream_parser import section_names
+
     # Create table
     table = texttable.Texttable()
 
-    # Initiate file parser
-    conf = configparser.RawConfigParser(
-        dict_type=MultiOrderedDict, strict=False)
-    conf.read([filename])
-
-    # Print all sections available in the file
+    # Print all sections available in the file, streamed without keeping their entries
     available_sections = [[]]
-    for each_section in conf.sections():
+    for each_section in section_names(filename):
         available_sections.append([each_section])
 
     table.add_rows(available_sections)
@@ -106,42 +140,72 @@ def print_all_sections(filename):
     print(table.draw())
 
 
-def print_gw_table(filename):
+def print_gw_table(registers):
     """
-    Method to display as an ASCII table the MODBUS gateway configuration file specified.
+    Method to display as an ASCII table the registers of a MODBUS gateway configuration.
+    :param registers - list of RegisterRecord objects:
     """
-
-    with open(filename, "r") as f:
-        data = json.load(f)
+    import texttable
 
     # Create texttable
     table = texttable.Texttable()
-    table.set_cols_align(["c", "c", "c", "c", "c", "c", "c", "c", "c", "c"])
-    table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m", "m", "m"])
-    table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m", "m", "m"])
+    table.set_cols_align(["c", "c", "c", "c", "c", "c", "c", "c", "c", "c", "c"])
+    table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m", "m", "m", "m"])
+    table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m", "m", "m", "m"])
 
-    for mapping in data["INPUT_REGISTERS"]["registers"]:
+    for mapping in registers:
 
-        register_attributes = list(mapping.values())
+        # Bit tables count bits instead of words
+        register_attributes = [mapping.table, mapping.AttrId, mapping.EUI64, mapping.Idx1, mapping.Idx2,
+                               mapping.MethId, mapping.ObjId, mapping.TSAPID, mapping.start_addr, mapping.status,
+                               mapping.bits or mapping.word_cnt]
 
-        table.add_rows([["AttrId", "EUI64", "Idx1", "Idx2", "MethId", "ObjId", "TSAPID", "start_addr", "status", "word_cnt"],
+        table.add_rows([["table", "AttrId", "EUI64", "Idx1", "Idx2", "MethId", "ObjId", "TSAPID", "start_addr",
+                         "status", "word_cnt"],
                         register_attributes])
 
     print(table.draw())
 
 
-def print_hosts_table(filename_hosts, filename_gw):
+def hosts_rows(devices, registers):
     """
-    Method to display as an ASCII table the HOSTS PUBLISHERS specified file data based on the MODBUS 
-    gateway configuration file specified too.
+    Function to join the HOSTS PUBLISHERS data of the devices mapped in the MODBUS gateway configuration.
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects:
+    :return rows - list of [EUI64, channel number, AttrID, Index1, Index2, ObjID, TSAP_ID, format, name, unit,
+    withStatus] rows, one per channel, registers without a device are left out as --validate reports them:
     """
+    from identity import get_index
 
-    # Load mapped configuration for gateway and .conf file
-    with open(filename_gw, "r") as f:
-        gw_data = json.load(f)
+    index = get_index(registers, devices)
+    rows = []
 
-    with open(filename_hosts, "r") as f2:
-        hosts_data = json.load(f2)
+    # Iterate over mapped gateway data, joined to the devices by canonical EUI64
+    for eui64, device in zip(index.eui64s, index.devices):
+        if device is None:
+            continue
+
+        ch_number = 1
+
+        # Iterate over channels of each device
+        for ch in device.channels:
+
+            # Grab channel attributes
+            rows.append([eui64, ch_number, ch.AttrID, ch.Index1, ch.Index2, ch.ObjID, ch.TSAP_ID, ch.format, ch.name,
+                         ch.unit, ch.withStatus])
+
+            ch_number += 1
+
+    return rows
+
+
+def print_hosts_table(rows):
+    """
+    Method to display as an ASCII table the HOSTS PUBLISHERS data of the devices mapped in the MODBUS
+    gateway configuration.
+    :param rows - list of rows as returned by hosts_rows:
+    """
+    import texttable
 
     # Create texttable
     table = texttable.Texttable()
@@ -149,85 +213,277 @@ def print_hosts_table(filename_hosts, filename_gw):
     table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m", "m", "m", "m", "m"])
     table.set_cols_dtype(['t', 'i', 'i', 'i', 'i', 'i', 'i', 't', 't', 't', 'i'])
 
-    # Iterate over mapped gateway data
-    for reg in gw_data["INPUT_REGISTERS"]["registers"]:
-        
-        # Get device ID and count mapped channels
-        eui64 = reg.get('EUI64', None)
-        ch_number = 1
+    for ch in rows:
+        table.add_rows([["EUI64", "Channel no.", "AttrID", "Index1", "Index2", "ObjId", "TSAPID",
+                         "Format", "Name", "Unit", "withStatus"], ch])
 
-        # Iterate over channels of each device
-        for ch in hosts_data[eui64][eui64]['channels']:
+    print(table.draw())
 
-            # Grab channel attributes and start creating list for table
-            ch = list(ch.values())
 
-            ch.insert(0, eui64) 
-            ch.insert(1, ch_number)
+def load_response(filename_resp):
+    """
+    Function to load responses exported to a JSON file.
+    :param filename_resp - response file:
+    :return - dict of responses:
+    """
+    with open(filename_resp, "r") as f:
+        return {int(trans_id): r for trans_id, r in json.load(f).items()}
 
-            ch_number += 1
 
-            table.add_rows([["EUI64", "Channel no.", "AttrID", "Index1", "Index2", "ObjId", "TSAPID",
-                             "Format", "Name", "Unit", "withStatus"], ch])
+def _decode(resp, devices, registers, decoded=None):
+    # Join index of the models and the channel values of every response, unless they were decoded by the workers
+    from decode import get_decoder
+    from identity import get_index
+    from metrics import timer, DECODE_SECONDS
 
-    print(table.draw())
+    index = get_index(registers, devices)
+    if decoded is not None:
+        return index, decoded
+
+    with timer(DECODE_SECONDS.labels()):
+        decoded = get_decoder(index, settings.byte_order, settings.word_order).decode(resp)
+
+    return index, decoded
+
+
+def _rows(resp, index, tracker, channels):
+    # Rows of the decoded channels, given as (response, register position, channel number, value)
+    from staleness import status_from_time
+
+    rows = {}
+
+    for majorkey, position, ch_number, sensor_value in channels:
+
+        # Get device ID and last time the values were read
+        device = index.eui64s[position]
+        last_read = resp[majorkey]['last_read']
+
+        if tracker:
+            curr_status = tracker.status(device)
+        else:
+            curr_status = status_from_time(last_read, index.devices[position].concentrator, settings.interval)
 
+        rows[(majorkey, ch_number)] = [device, sensor_value, index.channels[position][ch_number].unit, last_read,
+                                       curr_status]
 
-def interpret_response_data(filename_resp):
+    return rows
+
+
+def response_rows(resp, devices, registers, tracker=None, decoded=None):
     """
-    Function to load the mapped JSON files(the configuration data) which suggest how we can interpret the result
-    when reading data from the MODBUS slave.
-    :param :
-    :return :
+    Function to decode the responses read from the MODBUS slave into one row per channel, with the values of
+    the channels of the hosts publishers model.
+    :param resp - dict of responses as returned by modbus.read_registers:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects the responses were read from:
+    :param tracker - StalenessTracker of the polling loop, the status is computed from the read time if not specified:
+    :param decoded - responses already decoded, as returned by Decoder.decode, e.g. by the polling workers:
+    :return rows - dict of [device, value, unit, last read, status] rows indexed by (response, channel number):
     """
+    index, decoded = _decode(resp, devices, registers, decoded)
 
-    # Load all JSON files with mapped data
-    with open(filename_resp, "r") as f:
-        resp = json.load(f)
+    # Walk the decoded responses, the device and channels come from the position of the register
+    return _rows(resp, index, tracker, ((majorkey, position, ch_number, sensor_value)
+                                        for majorkey, (position, values) in decoded.items()
+                                        for ch_number, sensor_value in enumerate(values)))
+
+
+def response_changes(resp, devices, registers, tracker=None, decoded=None):
+    """
+    Function to decode the responses read from the MODBUS slave into rows for the channels which changed by more
+    than their deadband since they were last reported, or for every channel at an integrity snapshot.
+    :param resp - dict of responses as returned by modbus.read_registers:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects the responses were read from:
+    :param tracker - StalenessTracker of the polling loop, the status is computed from the read time if not specified:
+    :param decoded - responses already decoded, as returned by Decoder.decode, e.g. by the polling workers:
+    :return (rows, integrity) - rows indexed as in response_rows, True if they are an integrity snapshot:
+    """
+    from changes import get_detector
+
+    index, decoded = _decode(resp, devices, registers, decoded)
+    detector = get_detector(index, settings.integrity_period)
+
+    changed = detector.detect(decoded)
+
+    rows = _rows(resp, index, tracker, ((majorkey, decoded[majorkey][0], ch_number, sensor_value)
+                                        for (majorkey, ch_number), sensor_value in changed.items()))
+
+    return rows, detector.integrity
+
+
+def response_readings(rows, resp, devices, registers):
+    """
+    Function to convert decoded rows into the readings published upstream, keyed by the CO_TSAP_ID and CO_ID of the
+    concentrator and the TSAP_ID, ObjID, AttrID, Index1 and Index2 of the channel.
+    :param rows - dict of rows as returned by response_rows or response_changes:
+    :param resp - dict of responses the rows were decoded from:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects the responses were read from:
+    :return readings - list of reading dicts:
+    """
+    from identity import get_index
+
+    index = get_index(registers, devices)
+    readings = []
+
+    for (majorkey, ch_number), (device, value, unit, last_read, status) in rows.items():
+        position = index.position(majorkey, resp[majorkey])
+        concentrator = index.devices[position].concentrator
+        ch = index.channels[position][ch_number]
+
+        readings.append({
+            "key": f"{concentrator.CO_TSAP_ID}/{concentrator.CO_ID}/{ch.TSAP_ID}/{ch.ObjID}/{ch.AttrID}/"
+                   f"{ch.Index1}/{ch.Index2}",
+            "device": device,
+            "value": value,
+            "unit": unit,
+            "last_read": last_read,
+            "status": status
+        })
 
-    with open(settings.out_hosts, "r") as f_hosts:
-        hosts_data = json.load(f_hosts)
+    return readings
 
-    with open(settings.out_gateway, "r") as f_gw:
-        gw_data = json.load(f_gw)
 
-     # Create texttable
+def _format_value(value):
+    # Decoded values keep their type, floats with their significant digits whatever their magnitude
+    return format(value, 'g') if isinstance(value, float) else str(value)
+
+
+def print_rows(rows):
+    """
+    Method to display as an ASCII table rows of decoded channels.
+    :param rows - dict of rows as returned by response_rows:
+    """
+    import texttable
+
+    # Create texttable
     table = texttable.Texttable()
     table.set_cols_align(["c", "c", "c", "c", "c"])
     table.set_cols_valign(["m", "m", "m", "m", "m"])
-    table.set_cols_dtype(['t', 'i', 'i', 'i', 'i'])
+    table.set_cols_dtype(['t', _format_value, 't', 't', 't'])
+    # Wide enough for an EUI64 and a 'YYYY-MM-DD HH:MM:SS' read time on a single line
+    table.set_cols_width([16, 12, 12, 19, 7])
 
-    # Iterate over a dict of dicts
-    for majorkey, subdict in resp.items():
-        data_list = []
-        
-        # Get device ID and last time the values were read
-        device = subdict['device']
-        last_read = subdict['last_read']
-        index = 0
-        
-        # Iterate over mapped channels of each device
-        for ch in hosts_data[device][device]['channels']:
-            
-            # Start creating the necessary lists to output as ASCII table
-            if index < len(subdict['response']):
-                data_list = []
-
-                data_list.append(device)
-
-                measurement_unit = ch.get('unit', None)   
-                sensor_value = subdict['response'][index]
-                
-                data_list.append(sensor_value)
-                data_list.append(measurement_unit)
-                data_list.append(last_read)
-
-                curr_status = random.choice(status)
-                data_list.append(curr_status) # status
-
-                index += 1
-
-                table.add_rows([["Device", "Value", "Unit of Measurement", "Last Read", "Status"],
-                                data_list])
+    for data_list in rows.values():
+        table.add_rows([["Device", "Value", "Unit of Measurement", "Last Read", "Status"],
+                        data_list])
+
+    print(table.draw())
+
+
+def interpret_response_data(resp, devices, registers, tracker=None):
+    """
+    Function to display the responses read from the MODBUS slave, decoded into the values of the channels
+    of the hosts publishers model.
+    :param resp - dict of responses as returned by modbus.read_registers:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects the responses were read from:
+    :param tracker - StalenessTracker of the polling loop, the status is computed from the read time if not specified:
+    """
+    print_rows(response_rows(resp, devices, registers, tracker))
+
+
+def print_history(stores, eui64, start=0, end=None):
+    """
+    Method to display as an ASCII table the reads of a device stored in the history stores.
+    :param stores - list of Store objects:
+    :param eui64 - device:
+    :param start - first moment in epoch nanoseconds:
+    :param end - last moment in epoch nanoseconds, no limit if not specified:
+    """
+    import texttable
+    from store import format_time
+
+    table = texttable.Texttable()
+    table.set_cols_align(["c", "c", "c", "c", "c"])
+    table.set_cols_valign(["m", "m", "m", "m", "m"])
+    table.set_cols_dtype(['t', 't', 't', 'i', 't'])
+
+    rows = [["Time", "Device", "Table", "Register", "Response"]]
+    reads = sorted(read for store in stores for read in store.query(eui64, start, end))
+    for timestamp, table_name, register, words in reads:
+        rows.append([format_time(timestamp), eui64, table_name, register, str(words)])
+
+    table.add_rows(rows)
+    print(table.draw())
+
+
+def print_readings(eui64, rows):
+    """
+    Method to display as an ASCII table the aggregates of the channels of a device over time buckets.
+    :param eui64 - device:
+    :param rows - list of aggregate dicts as returned by Rollups.query:
+    """
+    import texttable
+    from store import format_time
+
+    table = texttable.Texttable()
+    table.set_cols_align(["c", "c", "c", "c", "c", "c", "c"])
+    table.set_cols_valign(["m", "m", "m", "m", "m", "m", "m"])
+    table.set_cols_dtype(['t', 'i', 'i', 'f', 'f', 'f', 't'])
+
+    table_rows = [["Bucket", "Channel no.", "Count", "Min", "Max", "Avg", "Rate/s"]]
+    for row in rows:
+        rate = "-" if row["rate"] is None else f"{row['rate']:.6g}"
+        table_rows.append([format_time(row["bucket"]), row["channel"], row["count"], row["min"], row["max"],
+                           row["avg"], rate])
+
+    table.add_rows(table_rows)
+    print(f"Readings of {eui64}")
+    print(table.draw())
+
+
+def print_last_values(eui64, values):
+    """
+    Method to display as an ASCII table the last value of every channel of a device.
+    :param eui64 - device:
+    :param values - dict of (moment, value) indexed by channel number, as returned by Rollups.last:
+    """
+    import texttable
+    from store import format_time
+
+    table = texttable.Texttable()
+    table.set_cols_align(["c", "c", "c", "c"])
+    table.set_cols_valign(["m", "m", "m", "m"])
+    table.set_cols_dtype(['t', 'i', 'f', 't'])
+
+    rows = [["Device", "Channel no.", "Value", "Last read"]]
+    for ch_number, (timestamp, value) in values.items():
+        rows.append([eui64, ch_number, value, format_time(timestamp)])
+
+    table.add_rows(rows)
+    print(table.draw())
+
+
+def print_validation(devices, registers):
+    """
+    Method to display as an ASCII table the problems found when joining the gateway registers with the
+    hosts publishers devices.
+    :param devices - dict of Device objects indexed by EUI64:
+    :param registers - list of RegisterRecord objects:
+    """
+    import texttable
+    from identity import get_index
+
+    index = get_index(registers, devices)
+
+    table = texttable.Texttable()
+    table.set_cols_align(["c", "c", "l"])
+    table.set_cols_valign(["m", "m", "m"])
+    table.set_cols_dtype(['t', 't', 't'])
+
+    rows = [["Problem", "EUI64", "Details"]]
+
+    for position in index.orphan_registers:
+        reg = registers[position]
+        rows.append(["Orphan register", reg.EUI64, f"register {reg.start_addr} has no device in the hosts file"])
+
+    for device in index.orphan_devices:
+        rows.append(["Orphan device", device.EUI64, f"section [{device.section}] is not mapped on a register"])
+
+    for position, message in index.mismatches:
+        rows.append(["Mismatch", registers[position].EUI64, message])
 
+    table.add_rows(rows)
     print(table.draw())
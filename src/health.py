@@ -0,0 +1,197 @@
+import time
+import random
+
+from classes import settings
+from metrics import READ_RETRIES, BREAKER_TRIPS
+
+# States of a circuit breaker
+CLOSED = "closed"        # the device is polled normally
+OPEN = "open"            # the device is skipped until its next probe
+HALF_OPEN = "half_open"  # a single probe read is allowed
+
+
+class RttEstimator():
+    """
+    Class estimating the timeout of a target from the round trip times of its reads, as a smoothed mean plus four
+    times the smoothed deviation (RFC 6298), kept between a lower and an upper bound.
+    """
+    def __init__(self, min_timeout=0.05, max_timeout=3.0, alpha=0.125, beta=0.25):
+        self.min_timeout = float(min_timeout)
+        self.max_timeout = float(max_timeout)
+        self.alpha = alpha
+        self.beta = beta
+
+        self.srtt = None
+        self.rttvar = None
+
+    def observe(self, rtt):
+        """
+        Method to update the estimate with the round trip time of a successful read.
+        :param rtt - seconds between the request and the response:
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+    def timeout(self):
+        """
+        Method to get the current timeout, the upper bound until a round trip time was observed.
+        """
+        if self.srtt is None:
+            return self.max_timeout
+
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        """
+        Method to double the timeout after a read timed out, as the estimate is too low for the current conditions.
+        """
+        if self.srtt is not None:
+            self.srtt = min(self.max_timeout, self.srtt * 2)
+
+
+class CircuitBreaker():
+    """
+    Class stopping the polling of a device after a number of consecutive failures. The device is then probed
+    with a single read at an interval which doubles after every failed probe, and polled again after a successful
+    one.
+    """
+    def __init__(self, threshold=3, probe_interval=30, max_probe_interval=600):
+        self.threshold = int(threshold)
+        self.probe_interval = float(probe_interval)
+        self.max_probe_interval = float(max_probe_interval)
+
+        self.state = CLOSED
+        self.failures = 0
+        self.interval = self.probe_interval
+        self.probe_at = 0.0
+
+    def allow(self, now):
+        """
+        Method to check if the device may be read, turning an open breaker half open once its probe is due.
+        :param now - monotonic time in seconds:
+        """
+        if self.state == OPEN and now >= self.probe_at:
+            self.state = HALF_OPEN
+
+        return self.state != OPEN
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.interval = self.probe_interval
+
+    def failure(self, now):
+        """
+        Method to record a failed read of the device.
+        :param now - monotonic time in seconds:
+        :return - True if the breaker opened:
+        """
+        self.failures += 1
+
+        if self.state == HALF_OPEN:
+            self.interval = min(self.interval * 2, self.max_probe_interval)
+        elif self.failures < self.threshold:
+            return False
+
+        tripped = self.state == CLOSED
+        self.state = OPEN
+        self.probe_at = now + self.interval
+
+        return tripped
+
+
+class GatewayHealth():
+    """
+    Class holding the adaptive timeout of a gateway, the retry policy of its reads and the circuit breakers of
+    its devices.
+    """
+    def __init__(self, name, min_timeout=0.05, max_timeout=3.0, retries=1, retry_backoff=0.05, threshold=3,
+                 probe_interval=30, max_probe_interval=600, clock=time.monotonic):
+        self.name = name
+        self.rtt = RttEstimator(min_timeout, max_timeout)
+        self.retries = int(retries)
+        self.retry_backoff = float(retry_backoff)
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.clock = clock
+
+        self.breakers = {}
+        self.read_retries = READ_RETRIES.labels(gateway=name)
+        self.breaker_trips = BREAKER_TRIPS.labels(gateway=name)
+
+    def timeout(self):
+        return self.rtt.timeout()
+
+    def backoff(self, attempt):
+        """
+        Method to get the delay before retrying a failed read, doubled for every attempt with a random jitter so
+        that retries of several targets do not line up.
+        :param attempt - number of the retry, starting at 0:
+        """
+        self.read_retries.inc()
+        return self.retry_backoff * 2 ** attempt * (0.5 + random.random() / 2)
+
+    def allowed(self, devices):
+        """
+        Method to filter out the devices whose breaker is open.
+        :param devices - EUI64 of the devices to be read:
+        :return - set of the devices which may be read now:
+        """
+        now = self.clock()
+        return set(eui64 for eui64 in devices if eui64 not in self.breakers or self.breakers[eui64].allow(now))
+
+    def open(self):
+        """
+        Method to get the devices which are currently not polled.
+        """
+        return sorted(eui64 for eui64, breaker in self.breakers.items() if breaker.state == OPEN)
+
+    def success(self, devices, rtt):
+        """
+        Method to record a successful read of a block of devices.
+        :param devices - EUI64 of the devices in the block:
+        :param rtt - round trip time of the read in seconds:
+        """
+        self.rtt.observe(rtt)
+
+        for eui64 in devices:
+            if eui64 in self.breakers:
+                self.breakers[eui64].success()
+
+    def failure(self, devices, timed_out=False):
+        """
+        Method to record a failed read of a block of devices.
+        :param devices - EUI64 of the devices in the block:
+        :param timed_out - True if the read failed because no response came in time:
+        """
+        if timed_out:
+            self.rtt.backoff()
+
+        now = self.clock()
+        for eui64 in devices:
+            breaker = self.breakers.get(eui64)
+            if breaker is None:
+                breaker = self.breakers[eui64] = CircuitBreaker(self.threshold, self.probe_interval,
+                                                                self.max_probe_interval)
+
+            if breaker.failure(now):
+                self.breaker_trips.inc()
+                print(f"Stopped polling {eui64} on {self.name} after {breaker.failures} failed reads, "
+                      f"probing it every {breaker.interval:.0f}s")
+
+
+def create_health(name, max_timeout=None):
+    """
+    Function to create the health of a gateway from the context settings.
+    :param name - name of the gateway:
+    :param max_timeout - upper bound of the read timeout, the one of the context settings if not specified:
+    :return - GatewayHealth object:
+    """
+    return GatewayHealth(name, settings.min_timeout, max_timeout or settings.max_timeout, settings.retries,
+                         settings.retry_backoff, settings.breaker_threshold, settings.probe_interval,
+                         settings.max_probe_interval)
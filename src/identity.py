@@ -0,0 +1,121 @@
+from array import array
+
+from decode import FORMATS, DEFAULT_FORMAT
+
+
+def eui64_key(eui64):
+    """
+    Function to get the canonical 64 bit integer of an EUI64 written either as '1020000000000061' in the gateway
+    file or as '1020:0000:0000:0061' in the hosts publishers file.
+    """
+    return int(eui64.replace(':', ''), 16)
+
+
+class JoinIndex():
+    """
+    Class joining the registers of the gateway with the devices of the hosts publishers, built once per model.
+    Everything is stored by register position, so interpreting a response is an array walk: the device, the
+    channels covered by the register and their layout in the register words.
+    """
+    def __init__(self, registers, devices):
+        hosts = {eui64_key(device.section): device for device in devices.values()}
+
+        self.registers = registers
+        self.keys = array('Q')
+        self.eui64s = []
+        self.devices = []
+        self.channels = []
+        self.layouts = []
+
+        # Fallback for responses not indexed by register position, indexed by (table, EUI64, start_addr)
+        self.lookup = {}
+
+        self.orphan_registers = []
+        self.mismatches = []
+
+        mapped = set()
+
+        for position, reg in enumerate(registers):
+            key = eui64_key(reg.EUI64)
+            device = hosts.get(key)
+
+            self.keys.append(key)
+            self.eui64s.append(reg.EUI64)
+            self.devices.append(device)
+            self.lookup[(reg.table, reg.EUI64, reg.start_addr)] = position
+
+            if device is None:
+                self.orphan_registers.append(position)
+                self.channels.append([])
+                self.layouts.append([])
+                continue
+
+            mapped.add(key)
+
+            # Lay the channels one after the other until the register words are used
+            layout = []
+            used = 0
+            for ch in device.channels:
+                size, code = FORMATS.get(ch.format, FORMATS[DEFAULT_FORMAT])
+                if used + size > reg.word_cnt:
+                    break
+
+                layout.append((ch, used, size, code))
+                used += size
+
+            self.channels.append([ch for ch, _, _, _ in layout])
+            self.layouts.append(layout)
+
+            if len(layout) < len(device.channels):
+                self.mismatches.append((position, f"{len(device.channels) - len(layout)} channels of "
+                                                  f"{reg.EUI64} do not fit in {reg.word_cnt} words"))
+            elif used < reg.word_cnt:
+                self.mismatches.append((position, f"{reg.word_cnt - used} words of {reg.EUI64} at register "
+                                                  f"{reg.start_addr} are not mapped on a channel"))
+
+        self.orphan_devices = [device for key, device in hosts.items() if key not in mapped]
+
+    def position(self, key, r):
+        """
+        Method to get the register position of a response, responses are indexed by position when read from
+        these registers.
+        :param key - key of the response:
+        :param r - response:
+        :return - position of the register, None if the response does not belong to these registers:
+        """
+        if isinstance(key, int) and key < len(self.eui64s) and self.eui64s[key] == r["device"]:
+            return key
+
+        # Responses saved before the table was recorded were all read from the input registers
+        return self.lookup.get((r.get("table", "INPUT_REGISTERS"), r["device"], r["register"]))
+
+
+# Index of the loaded models with the models themselves, so their identity stays valid
+_index = None
+
+
+def get_index(registers, devices):
+    """
+    Function to get the join index of the models, creating it only when the models changed.
+    :param registers - list of RegisterRecord objects:
+    :param devices - dict of Device objects indexed by EUI64:
+    :return - JoinIndex object:
+    """
+    global _index
+
+    if _index is None or _index[0] is not registers or _index[1] is not devices:
+        _index = (registers, devices, JoinIndex(registers, devices))
+
+    return _index[2]
+
+
+def set_index(registers, devices, index):
+    """
+    Function to replace the join index of the models with one built in advance, e.g. while reloading them.
+    :param registers - list of RegisterRecord objects:
+    :param devices - dict of Device objects indexed by EUI64:
+    :param index - JoinIndex of the models:
+    """
+    global _index
+
+    _index = (registers, devices, index)
@@ -0,0 +1,314 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the duration buckets, from a fast local read up to a timed out request
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class CounterSeries():
+    """
+    Class holding the value of a counter for one set of labels.
+    """
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HistogramSeries():
+    """
+    Class holding the observations of a histogram for one set of labels, counted in fixed buckets so that
+    observing a value does not allocate anything.
+    """
+    __slots__ = ("labels", "bounds", "counts", "sum", "count")
+
+    def __init__(self, labels, bounds):
+        self.labels = labels
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Method to count a value in the first bucket whose upper bound is not below it.
+        :param value - observed value, e.g. a duration in seconds:
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """
+        Method to estimate a quantile as the upper bound of the bucket it falls in.
+        :param fraction - quantile between 0 and 1:
+        :return - upper bound of the bucket, None if nothing was observed:
+        """
+        if not self.count:
+            return None
+
+        rank = fraction * self.count
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+
+class Metric():
+    """
+    Class representing a named metric and its series, one per set of label values. Series are created on first
+    use and should be kept by the caller on hot paths.
+    """
+    def __init__(self, name, help, kind, buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        """
+        Method to get the series of a set of label values.
+        :return - CounterSeries or HistogramSeries object:
+        """
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+
+        if series is None:
+            with self.lock:
+                series = self.series.get(key)
+                if series is None:
+                    if self.kind == "counter":
+                        series = CounterSeries(key)
+                    else:
+                        series = HistogramSeries(key, self.buckets)
+                    self.series[key] = series
+
+        return series
+
+
+class Registry():
+    """
+    Class holding all the metrics of the process, rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.server = None
+
+    def _metric(self, name, help, kind, buckets=None):
+        if name not in self.metrics:
+            self.metrics[name] = Metric(name, help, kind, buckets)
+
+        return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._metric(name, help, "counter")
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        return self._metric(name, help, "histogram", tuple(buckets))
+
+    def render(self):
+        """
+        Method to render all metrics in the Prometheus text exposition format.
+        :return - text of the metrics:
+        """
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+            for series in list(metric.series.values()):
+                labels = [f'{name}="{value}"' for name, value in series.labels]
+                selector = "{" + ",".join(labels) + "}" if labels else ""
+
+                if metric.kind == "counter":
+                    lines.append(f"{metric.name}{selector} {series.value}")
+                    continue
+
+                # Buckets are exposed cumulative
+                total = 0
+                for bound, count in zip(series.bounds + (float("inf"),), list(series.counts)):
+                    total += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket = ",".join(labels + [f'le="{le}"'])
+                    lines.append(f"{metric.name}_bucket{{{bucket}}} {total}")
+
+                lines.append(f"{metric.name}_sum{selector} {series.sum}")
+                lines.append(f"{metric.name}_count{selector} {series.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Method to get the current value of all metrics as a JSON serializable dict.
+        :return - dict of metrics indexed by name:
+        """
+        data = {}
+
+        for metric in self.metrics.values():
+            series_data = []
+
+            for series in list(metric.series.values()):
+                entry = {"labels": dict(series.labels)}
+
+                if metric.kind == "counter":
+                    entry["value"] = series.value
+                else:
+                    entry.update(count=series.count, sum=series.sum, p50=series.quantile(0.5),
+                                 p99=series.quantile(0.99))
+
+                series_data.append(entry)
+
+            data[metric.name] = {"type": metric.kind, "help": metric.help, "series": series_data}
+
+        return data
+
+    def clear(self):
+        """
+        Method to drop the series of all metrics, e.g. in a worker forked with the metrics of its parent.
+        """
+        for metric in self.metrics.values():
+            with metric.lock:
+                metric.series = {}
+
+    def state(self):
+        """
+        Method to get the raw value of all metrics, to be merged in the registry of another process.
+        :return - list of (name, help, kind, buckets, series) tuples, the series as (labels, value) for counters and
+        (labels, counts, sum, count) for histograms:
+        """
+        state = []
+
+        for metric in self.metrics.values():
+            if metric.kind == "counter":
+                series = [(s.labels, s.value) for s in list(metric.series.values())]
+            else:
+                series = [(s.labels, list(s.counts), s.sum, s.count) for s in list(metric.series.values())]
+
+            if series:
+                state.append((metric.name, metric.help, metric.kind, metric.buckets, series))
+
+        return state
+
+    def merge(self, state, **labels):
+        """
+        Method to take over the metrics of another process, e.g. a polling worker, its series are replaced by
+        their last values.
+        :param state - metrics as returned by Registry.state:
+        :param labels - labels added to the series to tell the process apart, e.g. shard='0':
+        """
+        for name, help, kind, buckets, series in state:
+            metric = self._metric(name, help, kind, buckets)
+
+            for series_labels, *values in series:
+                target = metric.labels(**dict(series_labels), **labels)
+
+                if kind == "counter":
+                    target.value = values[0]
+                else:
+                    target.counts[:] = values[0]
+                    target.sum, target.count = values[1], values[2]
+
+    def serve(self, address="127.0.0.1", port=9108):
+        """
+        Method to expose the metrics over HTTP on /metrics from a background thread.
+        :param address - address to listen on:
+        :param port - port to listen on:
+        :return - HTTP server object:
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, int(port)), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self.server
+
+
+@contextmanager
+def timer(series):
+    """
+    Context manager observing in a histogram series the duration of the block.
+    :param series - HistogramSeries object:
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        series.observe(time.perf_counter() - start)
+
+
+def print_stats(snapshot):
+    """
+    Method to print as an ASCII table a snapshot of the metrics.
+    :param snapshot - dict of metrics as returned by Registry.snapshot:
+    """
+    import texttable
+
+    table = texttable.Texttable()
+    table.set_cols_align(["l", "l", "c", "c", "c", "c"])
+    table.set_cols_valign(["m", "m", "m", "m", "m", "m"])
+    table.set_cols_dtype(['t', 't', 'i', 't', 't', 't'])
+
+    rows = [["Metric", "Labels", "Count", "Mean", "p50", "p99"]]
+
+    for name, metric in snapshot.items():
+        for series in metric["series"]:
+            labels = ", ".join(f"{key}={value}" for key, value in series["labels"].items())
+
+            if metric["type"] == "counter":
+                rows.append([name, labels, series["value"], "", "", ""])
+            else:
+                mean = series["sum"] / series["count"] if series["count"] else 0.0
+                rows.append([name, labels, series["count"], f"{mean:.6f}", f"<= {series['p50']}",
+                             f"<= {series['p99']}"])
+
+    table.add_rows(rows)
+    print(table.draw())
+
+
+# Metrics of the process
+metrics = Registry()
+
+CONNECT_SECONDS = metrics.histogram("modbus_connect_seconds", "Duration of the connections to the MODBUS gateways")
+READ_SECONDS = metrics.histogram("modbus_read_seconds", "Duration of the read requests of all four MODBUS tables")
+READ_ERRORS = metrics.counter("modbus_read_errors_total", "Failed read requests, timeouts excluded")
+READ_TIMEOUTS = metrics.counter("modbus_read_timeouts_total", "Read requests which timed out")
+READ_LATE = metrics.counter("modbus_late_responses_total", "Responses received after their request timed out")
+READ_RETRIES = metrics.counter("modbus_read_retries_total", "Read requests sent again after a failure")
+BREAKER_TRIPS = metrics.counter("modbus_breaker_trips_total", "Devices no longer polled after consecutive failures")
+MAP_SECONDS = metrics.histogram("map_seconds", "Duration of mapping a configuration file to JSON")
+DECODE_SECONDS = metrics.histogram("decode_seconds", "Duration of decoding the responses into channel values")
+RENDER_SECONDS = metrics.histogram("render_seconds", "Duration of displaying the responses")
+CYCLE_SECONDS = metrics.histogram("cycle_seconds", "Duration of the polling cycles")
+CYCLE_OVERRUNS = metrics.counter("cycle_overruns_total", "Cycles started after the next deadline of a due device")
+PUBLISH_SECONDS = metrics.histogram("publish_seconds", "Duration of publishing a batch of readings to the broker")
+PUBLISHED = metrics.counter("published_readings_total", "Readings acknowledged by the broker")
+SPILLED = metrics.counter("spilled_readings_total", "Readings written to the disk buffer")
+DROPPED = metrics.counter("dropped_readings_total", "Readings dropped by the queue policy or the disk buffer limit")
@@ -1,8 +1,20 @@
 from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
 from classes import settings
-from time import gmtime, strftime
-import os
-import json
+from model import TABLES
+from metrics import timer, CONNECT_SECONDS, READ_SECONDS, READ_ERRORS, READ_TIMEOUTS
+from time import gmtime, strftime, perf_counter, sleep
+
+# Maximum number of registers that can be read in a single MODBUS request
+MAX_READ_WORDS = 125
+
+# Client method reading every table
+READ_METHODS = {
+    'INPUT_REGISTERS': 'read_input_registers',
+    'HOLDING_REGISTERS': 'read_holding_registers',
+    'COILS': 'read_coils',
+    'DISCRETE_INPUTS': 'read_discrete_inputs'
+}
 
 
 def create_conn(address='127.0.0.1', port='502'):
@@ -14,7 +26,9 @@ def create_conn(address='127.0.0.1', port='502'):
     """
 
     client = ModbusTcpClient(address, port=port)
-    client.connect()
+
+    with timer(CONNECT_SECONDS.labels(gateway=address)):
+        client.connect()
 
     return client
 
@@ -37,46 +51,251 @@ def disconnect(conn):
     return resp
 
 
-def read_input_reg(conn, filename_gw):
+def plan_reads(registers, max_gap=0, max_words=MAX_READ_WORDS, devices=None):
+    """
+    Function to group the mapped registers of all the tables into as few block reads as possible. Registers are
+    sorted by table and start address and merged with the previous block of their table when the hole between
+    them is at most max_gap words and the resulting block still fits in a single MODBUS request. In the bit
+    tables addresses count bits, a word of gap is worth 16 bits and a request reads up to 2000 bits.
+    :param registers - list of RegisterRecord objects from the gateway model:
+    :param max_gap - number of unused words tolerated between two ranges to still merge them:
+    :param max_words - maximum number of words a single request may read:
+    :param devices - EUI64 of the devices to be read, all registers if not specified:
+    :return blocks - list of dicts with the block 'table', 'start_addr', 'word_cnt' (bits in the bit tables) and
+    the (index, register) pairs in it:
+    """
+    blocks = []
+    order = list(TABLES)
+
+    # Keep the original position of each register so responses can be ordered as in the config
+    ordered = sorted((item for item in enumerate(registers) if devices is None or item[1].EUI64 in devices),
+                     key=lambda item: (order.index(item[1].table), item[1].start_addr))
+
+    for index, mapping in ordered:
+        _, bits, max_count = TABLES[mapping.table]
+        start_addr = mapping.start_addr
+        end_addr = start_addr + (mapping.bits if bits else mapping.word_cnt)
+
+        # Try to extend the last block of the same table with the current register
+        if blocks and blocks[-1]["table"] == mapping.table:
+            block = blocks[-1]
+            block_end = block["start_addr"] + block["word_cnt"]
+            merged_end = max(block_end, end_addr)
+
+            gap = 16 * max_gap if bits else max_gap
+            limit = max_count if bits else max_words
+
+            if start_addr - block_end <= gap and merged_end - block["start_addr"] <= limit:
+                block["word_cnt"] = merged_end - block["start_addr"]
+                block["registers"].append((index, mapping))
+                continue
+
+        blocks.append({
+            "table": mapping.table,
+            "start_addr": start_addr,
+            "word_cnt": end_addr - start_addr,
+            "registers": [(index, mapping)]
+        })
+
+    return blocks
+
+
+def pack_bits(bits):
     """
+    Function to pack bits into 16 bit words, the first bit in the least significant bit of the first word.
+    :param bits - list of bits:
+    :return words - list of ints:
     """
+    words = [0] * ((len(bits) + 15) // 16)
+
+    for position, bit in enumerate(bits):
+        if bit:
+            words[position >> 4] |= 1 << (position & 15)
+
+    return words
+
+
+def split_block(block, words):
+    """
+    Function to split the words read for a block back into the values of every register mapped in it.
+    :param block - block as returned by plan_reads:
+    :param words - list of register values read for the whole block, or of bits for the bit tables:
+    :return - list of (index, register, values) tuples, the bits of every register packed into words:
+    """
+    values = []
+
+    for index, mapping in block["registers"]:
+        offset = mapping.start_addr - block["start_addr"]
+
+        if mapping.bits:
+            values.append((index, mapping, pack_bits(words[offset:offset + mapping.bits])))
+        else:
+            values.append((index, mapping, words[offset:offset + mapping.word_cnt]))
+
+    return values
+
+
+def isolate(block, max_gap=0):
+    """
+    Function to split a block into the blocks of each device mapped in it, so that a device which does not
+    respond can be told apart from the others.
+    :param block - block as returned by plan_reads:
+    :param max_gap - number of unused words tolerated between two ranges to still merge them:
+    :return blocks - list of blocks with the same structure as returned by plan_reads:
+    """
+    blocks = []
+    registers = [mapping for _, mapping in block["registers"]]
+
+    for eui64 in sorted(set(mapping.EUI64 for mapping in registers)):
+        for sub in plan_reads(registers, max_gap, devices={eui64}):
+            # Positions in the block back to positions in the config
+            sub["registers"] = [(block["registers"][i][0], mapping) for i, mapping in sub["registers"]]
+            blocks.append(sub)
+
+    return blocks
+
+
+def is_timeout(error):
+    """
+    Function to check if a read failed because the gateway did not respond in time.
+    :param error - exception raised or error response returned by the client:
+    """
+    return isinstance(error, (ModbusIOException, TimeoutError))
+
+
+def count_error(gateway, error):
+    """
+    Method to count a failed read in the metrics of a gateway.
+    :param gateway - name of the gateway:
+    :param error - exception raised or error response returned by the client:
+    """
+    if is_timeout(error):
+        READ_TIMEOUTS.labels(gateway=gateway).inc()
+    else:
+        READ_ERRORS.labels(gateway=gateway).inc()
+
+
+def read_block(conn, block, unit=0, gateway=None, health=None):
+    """
+    Function to read a planned block. With the health of the gateway the read uses its adaptive timeout and is
+    retried after a jittered backoff, otherwise any exception of the client is raised.
+    :param conn - connection to the MODBUS slave:
+    :param block - block as returned by plan_reads:
+    :param unit - MODBUS unit id of the slave:
+    :param gateway - name of the gateway in the metrics, the address of the working context if not specified:
+    :param health - GatewayHealth of the gateway:
+    :return - (values, error) with the words or bits read, None if every attempt failed, and the error of the
+    last attempt:
+    """
+    gateway = gateway or settings.address
+    read_seconds = READ_SECONDS.labels(gateway=gateway)
+    attempts = 1 + (health.retries if health else 0)
+    error = None
+
+    for attempt in range(attempts):
+        if attempt:
+            sleep(health.backoff(attempt - 1))
+
+        if health:
+            # The client waits for a response for its timeout
+            conn.timeout = health.timeout()
+
+        start = perf_counter()
+        try:
+            read = getattr(conn, READ_METHODS[block["table"]])
+            reg = read(block["start_addr"], block["word_cnt"], unit=int(unit))
+        except Exception as e:
+            count_error(gateway, e)
+            if health is None:
+                raise
+            error = e
+            continue
+        finally:
+            read_seconds.observe(perf_counter() - start)
+
+        if reg.isError():
+            count_error(gateway, reg)
+            error = reg
+            continue
+
+        if health:
+            health.success(set(mapping.EUI64 for _, mapping in block["registers"]), perf_counter() - start)
+
+        # Bits are read back padded to whole bytes
+        if TABLES[block["table"]][1]:
+            return reg.bits[:block["word_cnt"]], None
+
+        return reg.registers, None
+
+    return None, error
+
+
+def read_registers(conn, registers, unit=0, devices=None, previous=None, gateway=None, health=None, updated=None):
+    """
+    Function to read the registers of all the tables from the gateway model in a single pass, coalescing
+    adjacent registers of every table into block reads.
+    :param conn - connection to the MODBUS slave:
+    :param registers - list of RegisterRecord objects, e.g. the registers of GatewayTables:
+    :param unit - MODBUS unit id of the slave:
+    :param devices - EUI64 of the devices to be read, all devices if not specified:
+    :param previous - responses of the last read, kept for the devices which are not read now:
+    :param gateway - name of the gateway in the metrics, the address of the working context if not specified:
+    :param health - GatewayHealth of the gateway, failed reads are skipped instead of raised when specified and
+    the devices whose circuit breaker is open are not read:
+    :param updated - set filled with the EUI64 of the devices read successfully:
+    :return json_data - dict of responses indexed by the position of the register in the config:
+    """
+    json_data = dict(previous or {})
+    max_gap = int(settings.read_gap)
+
+    if health:
+        health_devices = devices if devices is not None else set(mapping.EUI64 for mapping in registers)
+        devices = health.allowed(health_devices)
+
+    blocks = plan_reads(registers, max_gap, devices=devices)
 
-    # Read the mapped gateway configuration
-    with open(settings.out_gateway, "r") as f_gw:
-        data = json.load(f_gw)
+    gateway = gateway or settings.address
 
-    trans_id = 0  # transaction id when reading registers
-    json_data = {}
+    for block in blocks:
+        results = []
 
-    for mapping in data["INPUT_REGISTERS"]["registers"]:
+        # read the whole block and record the moment in time
+        words, error = read_block(conn, block, unit, gateway, health)
+        if words is not None:
+            results.append((block, words))
 
-        # get the register addr and how many regs to read
-        start_addr = int(mapping.get("start_addr", None))
-        word_count = int(mapping.get("word_cnt", None))
+        elif health:
+            block_devices = set(mapping.EUI64 for _, mapping in block["registers"])
 
-        # device ID
-        eui64 = mapping.get("EUI64", None)
+            if len(block_devices) == 1:
+                health.failure(block_devices, is_timeout(error))
+            else:
+                # Read the devices one by one so a single dead device does not fail the others
+                for sub in isolate(block, max_gap):
+                    words, error = read_block(conn, sub, unit, gateway, health)
+                    if words is not None:
+                        results.append((sub, words))
+                    else:
+                        health.failure(set(mapping.EUI64 for _, mapping in sub["registers"]), is_timeout(error))
 
-        # read from the registers and record the moment in time
-        reg = conn.read_input_registers(start_addr, word_count)
         datetime = strftime("%Y-%m-%d %H:%M:%S", gmtime())
 
-        x = reg.registers
-        
-        # create a response and save the data
-        r = {
-            "register": start_addr,
-             "response": x,
-             "device": eui64,
-             "last_read": datetime
-            }
+        for read, words in results:
+            for position, mapping, x in split_block(read, words):
 
-        json_data[trans_id] = r
+                # create a response and save the data
+                r = {
+                    "table": mapping.table,
+                    "register": mapping.start_addr,
+                     "response": x,
+                     "device": mapping.EUI64,
+                     "last_read": datetime
+                    }
 
-        trans_id += 1
+                json_data[position] = r
 
-    # write data in response file
-    with open(settings.output_file, "w") as json_file:
-        json.dump(json_data, json_file, indent=4)
+                if updated is not None:
+                    updated.add(mapping.EUI64)
 
-    return json_data
+    # keep the responses in the order of the gateway config
+    return dict(sorted(json_data.items()))
@@ -0,0 +1,267 @@
+import os
+import hashlib
+
+from stream_parser import ConfigError, read_entries, read_sections
+
+# Parsed configuration files, indexed by path: (stat signature, content hash, model)
+_cache = {}
+
+# Tables of a gateway file, in the order their registers are positioned: MODBUS function code reading the table,
+# True for the tables of single bits and the most values a single request may read
+TABLES = {
+    'INPUT_REGISTERS': (0x04, False, 125),
+    'HOLDING_REGISTERS': (0x03, False, 125),
+    'COILS': (0x01, True, 2000),
+    'DISCRETE_INPUTS': (0x02, True, 2000)
+}
+
+
+def _text(value):
+    # Text attributes are written between quotes in the configuration files
+    return value.strip().strip("'\"")
+
+
+class ConcentratorRecord():
+    """
+    Class holding the typed attributes of a 'CONCENTRATOR=' line.
+    """
+    __slots__ = ('CO_TSAP_ID', 'CO_ID', 'Data_Period', 'Data_Phase', 'Data_StaleLimit', 'Data_version',
+                 'interfaceType')
+
+    def __init__(self, line):
+        values = [int(value) for value in line.split(',')]
+
+        (self.CO_TSAP_ID, self.CO_ID, self.Data_Period, self.Data_Phase, self.Data_StaleLimit,
+         self.Data_version, self.interfaceType) = values[:7]
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class ChannelRecord():
+    """
+    Class holding the typed attributes of a 'CHANNEL=' line. The optional deadband after withStatus is the change
+    needed before a new value is reported, absolute ('0.5') or in percent of the last reported value ('2%').
+    """
+    __slots__ = ('TSAP_ID', 'ObjID', 'AttrID', 'Index1', 'Index2', 'format', 'name', 'unit', 'withStatus',
+                 'deadband', 'deadband_percent')
+
+    def __init__(self, line):
+        values = line.split(',')
+
+        self.TSAP_ID = int(values[0])
+        self.ObjID = int(values[1])
+        self.AttrID = int(values[2])
+        self.Index1 = int(values[3])
+        self.Index2 = int(values[4])
+        self.format = _text(values[5])
+        self.name = _text(values[6])
+        self.unit = _text(values[7])
+        self.withStatus = int(values[8])
+
+        deadband = _text(values[9]) if len(values) > 9 else ''
+        self.deadband_percent = deadband.endswith('%')
+        self.deadband = float(deadband.rstrip('%') or 0)
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class RegisterRecord():
+    """
+    Class holding the typed attributes of a 'REGISTER=' line. In the COILS and DISCRETE_INPUTS tables the count is
+    a number of bits, read back packed 16 to a word with the first bit in the least significant one, so word_cnt
+    is the size of the packed value in every table.
+    """
+    __slots__ = ('table', 'start_addr', 'word_cnt', 'bits', 'EUI64', 'TSAPID', 'ObjId', 'AttrId', 'Idx1', 'Idx2',
+                 'MethId', 'status')
+
+    def __init__(self, line, table='INPUT_REGISTERS'):
+        values = [value.strip() for value in line.split(',')]
+
+        self.table = table
+        self.start_addr = int(values[0])
+
+        if TABLES[table][1]:
+            self.bits = int(values[1])
+            self.word_cnt = (self.bits + 15) // 16
+        else:
+            self.bits = 0
+            self.word_cnt = int(values[1])
+
+        self.EUI64 = values[2]
+        self.TSAPID = int(values[3])
+        self.ObjId = int(values[4])
+        self.AttrId = int(values[5])
+        self.Idx1 = int(values[6])
+        self.Idx2 = int(values[7])
+        self.MethId = int(values[8])
+        self.status = int(values[-1])
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class Device():
+    """
+    Class holding the concentrator and the channels of a device from the hosts publishers file.
+    """
+    __slots__ = ('EUI64', 'section', 'concentrator', 'channels')
+
+    def __init__(self, section, concentrator, channels):
+        self.EUI64 = ''.join(section.split(':'))
+        self.section = section
+        self.concentrator = concentrator
+        self.channels = channels
+
+
+class GatewayTables(dict):
+    """
+    Class holding the RegisterRecord lists of a gateway file indexed by section, together with the registers of
+    all the tables in a single list. Input registers come first, so a register keeps its position when tables are
+    added to a gateway file which only had input registers.
+    """
+    def __init__(self, tables):
+        super().__init__(tables)
+        self.registers = [reg for table in TABLES for reg in tables.get(table, [])]
+
+
+def _same_device(a, b):
+    return (a.section == b.section and a.concentrator.as_dict() == b.concentrator.as_dict()
+            and [ch.as_dict() for ch in a.channels] == [ch.as_dict() for ch in b.channels])
+
+
+def _record(filename, lineno, cls, *args):
+    # Typed record of a line, with the line reported if its values are invalid
+    try:
+        return cls(*args)
+    except (ValueError, IndexError) as e:
+        raise ConfigError(filename, lineno, f"Invalid {cls.__name__}: {e}") from None
+
+
+def _parse_hosts(filename, previous=None):
+    """
+    Function to build the devices of a hosts publishers file, streaming it one section at a time.
+    :param filename - hosts publishers configuration file:
+    :param previous - devices of the last version of the file, the unchanged ones are kept as they were:
+    :return devices - dict of Device objects indexed by EUI64:
+    """
+    devices = {}
+    first_lines = {}
+
+    for lineno, section, entries in read_sections(filename):
+        if section in first_lines:
+            raise ConfigError(filename, lineno, f"Duplicate section [{section}], first defined at line "
+                                                f"{first_lines[section]}")
+        first_lines[section] = lineno
+
+        concentrator = None
+        channels = []
+
+        for entry_lineno, key, value in entries:
+            if key == 'CONCENTRATOR':
+                if concentrator is not None:
+                    raise ConfigError(filename, entry_lineno, f"Second CONCENTRATOR in [{section}]")
+                concentrator = _record(filename, entry_lineno, ConcentratorRecord, value)
+
+            elif key == 'CHANNEL':
+                channels.append(_record(filename, entry_lineno, ChannelRecord, value))
+
+        if concentrator is None or not channels:
+            raise ConfigError(filename, lineno, f"[{section}] needs a CONCENTRATOR and at least one CHANNEL")
+
+        device = Device(section, concentrator, channels)
+
+        # Unchanged devices keep their identity, so what was derived from them stays valid
+        if previous and device.EUI64 in previous and _same_device(previous[device.EUI64], device):
+            device = previous[device.EUI64]
+
+        devices[device.EUI64] = device
+
+    return devices
+
+
+def _parse_gateway(filename, previous=None):
+    """
+    Function to build the registers of a MODBUS gateway file, streaming it one line at a time.
+    :param filename - gateway configuration file:
+    :param previous - tables of the last version of the file, the unchanged registers are kept as they were:
+    :return tables - GatewayTables with the RegisterRecord lists indexed by section, e.g. 'INPUT_REGISTERS':
+    """
+    known = {}
+    if previous:
+        known = {(reg.table, reg.EUI64, reg.start_addr): reg for reg in previous.registers}
+
+    tables = {}
+    for lineno, section, key, value in read_entries(filename):
+        if key is None:
+            if section not in TABLES:
+                raise ConfigError(filename, lineno, f"Unknown table [{section}], expected one of "
+                                                    f"{', '.join(TABLES)}")
+            tables.setdefault(section, [])
+            continue
+
+        if key != 'REGISTER':
+            continue
+
+        reg = _record(filename, lineno, RegisterRecord, value, section)
+
+        # Unchanged registers keep their identity, so what was derived from them stays valid
+        old = known.pop((reg.table, reg.EUI64, reg.start_addr), None)
+        if old is not None and old.as_dict() == reg.as_dict():
+            reg = old
+
+        tables[section].append(reg)
+
+    return GatewayTables(tables)
+
+
+def _load(filename, parse):
+    """
+    Function to return the compiled model of a configuration file, parsing it only when its modification time
+    or size changed and its content hash is different from the cached one. The file is hashed and parsed in
+    chunks, it is never held in memory as a whole.
+    :param filename - configuration file:
+    :param parse - function building the model from the configuration file and the previous model:
+    :return - compiled model:
+    """
+    stat = os.stat(filename)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _cache.get(filename)
+    if cached and cached[0] == signature:
+        return cached[2]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    digest = digest.digest()
+
+    # The file was touched but not changed
+    if cached and cached[1] == digest:
+        _cache[filename] = (signature, digest, cached[2])
+        return cached[2]
+
+    model = parse(filename, cached[2] if cached else None)
+    _cache[filename] = (signature, digest, model)
+
+    return model
+
+
+def load_hosts(filename):
+    """
+    Function to get the compiled model of a hosts publishers file.
+    :param filename - hosts publishers configuration file:
+    :return - dict of Device objects indexed by EUI64:
+    """
+    return _load(filename, _parse_hosts)
+
+
+def load_gateway(filename):
+    """
+    Function to get the compiled model of a MODBUS gateway file.
+    :param filename - gateway configuration file:
+    :return - GatewayTables with the RegisterRecord lists indexed by section:
+    """
+    return _load(filename, _parse_gateway)
@@ -0,0 +1,150 @@
+import time
+import select
+import socket
+import threading
+from contextlib import contextmanager
+
+import modbus
+from classes import settings
+
+
+def socket_alive(sock):
+    """
+    Function to check without blocking that a connected socket is still usable. A socket is readable between two
+    requests only when the peer closed it, reset it or sent bytes nobody asked for, e.g. the response of a request
+    which timed out, which would be read as the response of the next request.
+    :param sock - connected socket:
+    :return - True if nothing is waiting on the socket:
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        # Closed sockets have no file descriptor
+        return False
+
+    return not readable
+
+
+class PooledConnection():
+    """
+    Class holding a MODBUS client kept open by the pool, together with the bookkeeping needed for
+    idle eviction and reconnect backoff.
+    """
+    def __init__(self, address, port, unit):
+        self.address = address
+        self.port = int(port)
+        self.unit = int(unit)
+
+        self.client = None
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def is_healthy(self):
+        """
+        Method to check if the underlying socket is still open and was not closed by the gateway, the client only
+        checks that it has a socket.
+        """
+        return self.client is not None and self.client.is_socket_open() and socket_alive(self.client.socket)
+
+    def open(self, backoff, max_backoff):
+        """
+        Method to (re)open the connection, refusing to try again before the backoff of the previous
+        failure has passed.
+        :param backoff - delay in seconds after the first failure, doubled for each following failure:
+        :param max_backoff - upper limit for the delay between attempts:
+        """
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise ConnectionError(f"Waiting {self.retry_at - now:.1f}s before reconnecting to "
+                                  f"{self.address}:{self.port}")
+
+        self.close()
+        self.client = modbus.create_conn(self.address, self.port)
+
+        if not self.client.is_socket_open():
+            self.client = None
+            self.failures += 1
+            self.retry_at = now + min(backoff * 2 ** (self.failures - 1), max_backoff)
+            raise ConnectionError(f"Could not connect to {self.address}:{self.port}")
+
+        # Let the OS detect dead peers on idle connections
+        self.client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def close(self):
+        """
+        Method to close the underlying client if it is open.
+        """
+        if self.client is not None:
+            modbus.disconnect(self.client)
+            self.client = None
+
+
+class ConnectionPool():
+    """
+    Class keeping MODBUS connections open between uses, keyed by (address, port, unit id). Borrowed connections
+    are health checked, reconnected with exponential backoff and closed once idle for too long.
+    """
+    def __init__(self, idle_timeout=60, backoff=1, max_backoff=60):
+        self.idle_timeout = float(idle_timeout)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, address, port, unit=0):
+        """
+        Method to borrow an open client for the specified gateway, the client is returned to the pool when the
+        block ends or dropped if the block raised an error.
+        :param address - IP address of the gateway:
+        :param port - port for TCP/IP connection:
+        :param unit - MODBUS unit id:
+        :return client - connection to the MODBUS slave:
+        """
+        key = (address, int(port), int(unit))
+
+        with self.lock:
+            self.evict_idle()
+            conn = self.connections.get(key)
+            if conn is None:
+                conn = self.connections[key] = PooledConnection(address, port, unit)
+
+        if not conn.is_healthy():
+            conn.open(self.backoff, self.max_backoff)
+
+        try:
+            yield conn.client
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            conn.last_used = time.monotonic()
+
+    def evict_idle(self):
+        """
+        Method to close the connections which have not been used for longer than the idle timeout.
+        """
+        now = time.monotonic()
+
+        for key, conn in list(self.connections.items()):
+            if now - conn.last_used > self.idle_timeout:
+                conn.close()
+                del self.connections[key]
+
+    def close_all(self):
+        """
+        Method to close all the connections of the pool.
+        """
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+
+
+# Connection pool shared by the commands of a process
+pool = ConnectionPool(settings.idle_timeout)
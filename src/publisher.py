@@ -0,0 +1,377 @@
+import os
+import json
+import time
+import socket
+import struct
+import itertools
+import threading
+from collections import deque
+
+from classes import settings
+from metrics import PUBLISH_SECONDS, PUBLISHED, DROPPED, SPILLED
+
+# MQTT 3.1.1 control packet types, shifted into the high nibble of the fixed header
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+# Policies for batches submitted while the queue is full
+BLOCK = "block"              # wait for room up to the queue timeout, then spill the batch to disk
+DROP_OLDEST = "drop_oldest"  # drop the oldest queued batch and never wait
+
+
+def _string(text):
+    # UTF-8 string prefixed by its length
+    data = text.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def _packet(header, body):
+    # Fixed header with the remaining length encoded 7 bits at a time
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+
+    return bytes([header]) + bytes(encoded) + body
+
+
+class MqttClient():
+    """
+    Class holding a blocking connection to an MQTT broker, publishing at QoS 1. The messages of a batch are all
+    sent before waiting for their acknowledgements, so a batch costs one round trip.
+    """
+    def __init__(self, address, port=1883, client_id="modbus-iot-cli", keepalive=60, timeout=5):
+        self.address = address
+        self.port = int(port)
+        self.client_id = client_id
+        self.keepalive = int(keepalive)
+        self.timeout = float(timeout)
+
+        self.sock = None
+        self.packet_id = 0
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self):
+        """
+        Method to open the connection and start a clean MQTT session.
+        """
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+        try:
+            body = _string("MQTT") + bytes([4, 0x02]) + struct.pack(">H", self.keepalive) + _string(self.client_id)
+            self.sock.sendall(_packet(CONNECT, body))
+
+            header, body = self._read()
+            if header & 0xF0 != CONNACK or body[1] != 0:
+                raise ConnectionError(f"Broker {self.address}:{self.port} refused the connection")
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Method to disconnect from the broker.
+        """
+        if self.sock is not None:
+            try:
+                self.sock.sendall(_packet(DISCONNECT, b""))
+            except OSError:
+                pass
+
+            self.sock.close()
+            self.sock = None
+
+    def _recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(f"Broker {self.address}:{self.port} closed the connection")
+            data += chunk
+
+        return data
+
+    def _read(self):
+        # Read a control packet, returns its fixed header byte and its body
+        header = self._recv(1)[0]
+
+        length = 0
+        shift = 0
+        while True:
+            byte = self._recv(1)[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+
+        return header, self._recv(length)
+
+    def publish(self, messages):
+        """
+        Method to publish messages at QoS 1 and wait until the broker acknowledged all of them.
+        :param messages - list of (topic, payload bytes) tuples:
+        """
+        pending = set()
+        packets = []
+
+        for topic, payload in messages:
+            self.packet_id = self.packet_id % 0xFFFF + 1
+            pending.add(self.packet_id)
+            packets.append(_packet(PUBLISH | 0x02, _string(topic) + struct.pack(">H", self.packet_id) + payload))
+
+        self.sock.sendall(b"".join(packets))
+
+        while pending:
+            header, body = self._read()
+            if header & 0xF0 == PUBACK:
+                pending.discard(struct.unpack(">H", body[:2])[0])
+
+    def ping(self):
+        """
+        Method to keep the connection alive while nothing is published.
+        """
+        self.sock.sendall(_packet(PINGREQ, b""))
+
+        header, _ = self._read()
+        if header & 0xF0 != PINGRESP:
+            raise ConnectionError(f"Unexpected packet {header:#x} instead of PINGRESP")
+
+
+class Publisher():
+    """
+    Class publishing the readings of every cycle to an MQTT broker from a background thread, so the polling loop
+    never waits for the network. Batches go through a bounded queue and are spilled to disk while the broker is
+    unreachable, to be sent first once it is back.
+    """
+    def __init__(self, client, topic="modbus", queue_size=64, policy=DROP_OLDEST, queue_timeout=1.0,
+                 spill_dir=None, spill_limit=64 * 1024 * 1024, batch_size=500, backoff=1, max_backoff=60):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"Unknown queue policy: {policy}")
+
+        self.client = client
+        self.topic = topic
+        self.queue_size = int(queue_size)
+        self.policy = policy
+        self.queue_timeout = float(queue_timeout)
+        self.spill_dir = spill_dir
+        self.spill_limit = int(spill_limit)
+        self.batch_size = int(batch_size)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+
+        self.batches = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        self.spill_seq = itertools.count()
+        # Spill files are written and trimmed by the polling thread and replayed by the sender
+        self.spill_lock = threading.Lock()
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def submit(self, readings):
+        """
+        Method to queue the readings of a cycle to be published as one batch.
+        :param readings - list of JSON serializable readings:
+        """
+        if not readings:
+            return
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work, name="publisher", daemon=True)
+            self.thread.start()
+
+        with self.condition:
+            queued = True
+
+            if len(self.batches) >= self.queue_size:
+                if self.policy == DROP_OLDEST:
+                    DROPPED.labels().inc(len(self.batches.popleft()))
+                else:
+                    # Wait for the sender, the batch is kept on disk if it does not catch up in time
+                    queued = self.condition.wait_for(lambda: len(self.batches) < self.queue_size,
+                                                     self.queue_timeout)
+
+            if queued:
+                self.batches.append(readings)
+                self.condition.notify_all()
+
+        if not queued:
+            self._spill([readings])
+
+    def close(self, timeout=5):
+        """
+        Method to stop the sender, the batches it could not publish in time are spilled to disk.
+        :param timeout - seconds given to the sender to publish the queued batches:
+        """
+        if self.thread is not None:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.batches, timeout)
+                self.stopped = True
+                self.condition.notify_all()
+
+            self.thread.join(timeout)
+
+        with self.condition:
+            pending = list(self.batches)
+            self.batches.clear()
+
+        self._spill(pending)
+        self.client.close()
+
+    def _spill(self, batches):
+        # Write batches to the spill directory, removing the oldest files above the size limit
+        if not self.spill_dir:
+            for readings in batches:
+                DROPPED.labels().inc(len(readings))
+            return
+
+        with self.spill_lock:
+            for readings in batches:
+                path = os.path.join(self.spill_dir, f"spill-{time.time_ns():020d}-{next(self.spill_seq):06d}.json")
+
+                with open(f"{path}.tmp", "w") as f:
+                    json.dump(readings, f)
+                os.replace(f"{path}.tmp", path)
+
+                SPILLED.labels().inc(len(readings))
+
+            self._trim()
+
+    def _trim(self):
+        # Remove the oldest spill files above the size limit, called with the spill lock held. A file the sender
+        # replayed meanwhile is already gone
+        files = []
+        for path in self._spilled():
+            try:
+                files.append((path, os.path.getsize(path)))
+            except FileNotFoundError:
+                pass
+
+        total = sum(size for _, size in files)
+        for path, size in files:
+            if total <= self.spill_limit:
+                break
+
+            try:
+                with open(path, "r") as f:
+                    DROPPED.labels().inc(len(json.load(f)))
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total -= size
+
+    def _spilled(self):
+        # Spill files, oldest first
+        if not self.spill_dir:
+            return []
+
+        return [os.path.join(self.spill_dir, name) for name in sorted(os.listdir(self.spill_dir))
+                if name.startswith("spill-") and name.endswith(".json")]
+
+    def _send(self, readings):
+        # Publish a batch, split into messages of at most batch_size readings
+        start = time.perf_counter()
+        self.client.publish([(self.topic, json.dumps(readings[i:i + self.batch_size]).encode())
+                             for i in range(0, len(readings), self.batch_size)])
+        PUBLISH_SECONDS.labels().observe(time.perf_counter() - start)
+        PUBLISHED.labels().inc(len(readings))
+
+    def _take(self):
+        # Remove and return the queued batches
+        with self.condition:
+            batches = list(self.batches)
+            self.batches.clear()
+            self.condition.notify_all()
+
+        return batches
+
+    def _work(self):
+        failures = 0
+        last_sent = time.monotonic()
+
+        while True:
+            with self.condition:
+                # Spilled batches are retried right after the backoff of a failure
+                if not failures:
+                    self.condition.wait_for(lambda: self.batches or self.stopped, self.client.keepalive / 2)
+                if self.stopped:
+                    return
+
+                readings = self.batches[0] if self.batches else None
+
+            try:
+                if not self.client.connected:
+                    self.client.connect()
+
+                # Batches kept on disk while the broker was unreachable go first
+                for path in self._spilled():
+                    try:
+                        with open(path, "r") as f:
+                            spilled = json.load(f)
+                    except FileNotFoundError:
+                        # Dropped above the spill limit since it was listed
+                        continue
+
+                    self._send(spilled)
+
+                    with self.spill_lock:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+
+                if readings is not None:
+                    self._send(readings)
+                elif time.monotonic() - last_sent >= self.client.keepalive / 2:
+                    self.client.ping()
+
+                last_sent = time.monotonic()
+                failures = 0
+
+                with self.condition:
+                    if readings is not None and self.batches and self.batches[0] is readings:
+                        self.batches.popleft()
+                    self.condition.notify_all()
+
+            except (OSError, ValueError) as e:
+                self.client.close()
+                failures += 1
+                print(f"Could not publish to {self.client.address}:{self.client.port}: {e}")
+
+                # Keep on disk what is submitted until the broker can be tried again
+                retry_at = time.monotonic() + min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+                self._spill(self._take())
+
+                while not self.stopped and time.monotonic() < retry_at:
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.batches or self.stopped, retry_at - time.monotonic())
+
+                    self._spill(self._take())
+
+
+def create_publisher():
+    """
+    Function to create the publisher of the context settings.
+    :return - Publisher object, None if publishing is disabled:
+    """
+    if settings.publish != 'true':
+        return None
+
+    client = MqttClient(settings.mqtt_address, settings.mqtt_port, settings.mqtt_client_id)
+    return Publisher(client, settings.mqtt_topic, settings.publish_queue, settings.publish_policy,
+                     settings.publish_timeout, settings.spill_dir, settings.spill_limit, settings.publish_batch)
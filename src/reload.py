@@ -0,0 +1,425 @@
+import os
+import time
+import struct
+import select
+import threading
+
+from classes import settings
+from model import load_gateway, load_hosts
+from identity import JoinIndex, eui64_key, set_index
+from decode import Decoder, set_decoder
+from changes import ChangeDetector, first_slots, migrate
+
+# inotify events which mean a file in a watched directory was written, replaced or removed
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENT = struct.Struct("iIII")
+
+
+def _inotify():
+    """
+    Function to get the inotify calls of the C library.
+    :return - libc, None where inotify is not available:
+    """
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    return libc
+
+
+class ConfigWatcher():
+    """
+    Class waiting for changes of configuration files. The directories of the files are watched with inotify,
+    which also sees editors replacing a file, and their modification time and size are polled where inotify is not
+    available. A file only counts as changed when its signature differs from the one last seen.
+    """
+    def __init__(self, paths, interval=1.0):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.interval = float(interval)
+        self.signatures = {path: self._signature(path) for path in self.paths}
+        self.fd = None
+
+        libc = _inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+            if fd >= 0:
+                mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                directories = set(os.path.dirname(path) for path in self.paths)
+
+                if all(libc.inotify_add_watch(fd, directory.encode(), mask) >= 0 for directory in directories):
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def wait(self, timeout=None):
+        """
+        Method to wait until a watched file changed.
+        :param timeout - seconds to wait at most, forever if not specified:
+        :return changed - set of the paths which changed, empty if none did before the timeout:
+        """
+        if self.fd is not None:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return set()
+
+            # The events only wake us up, the signatures tell what changed
+            try:
+                while os.read(self.fd, 64 * IN_EVENT.size):
+                    pass
+            except BlockingIOError:
+                pass
+        else:
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+        changed = set()
+        for path in self.paths:
+            signature = self._signature(path)
+
+            if signature != self.signatures[path]:
+                self.signatures[path] = signature
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ConfigDiff():
+    """
+    Class holding the devices affected by a configuration change: devices which started or stopped being polled,
+    devices whose registers or hosts publishers section changed and the hosts publishers sections which were added,
+    removed or changed.
+    """
+    __slots__ = ('added', 'removed', 'changed', 'hosts')
+
+    def __init__(self, added=(), removed=(), changed=(), hosts=()):
+        self.added = set(added)
+        self.removed = set(removed)
+        self.changed = set(changed)
+        self.hosts = set(hosts)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed or self.hosts)
+
+    def __str__(self):
+        return f"{len(self.added)} added, {len(self.removed)} removed and {len(self.changed)} changed devices"
+
+
+def _registers_by_device(registers):
+    devices = {}
+    for reg in registers:
+        devices.setdefault(reg.EUI64, []).append(reg)
+
+    return devices
+
+
+def diff_models(old_registers, old_hosts, registers, hosts):
+    """
+    Function to find the devices affected by a change of the models. Unchanged records keep their identity when
+    a file is parsed again, so comparing identities is enough.
+    :param old_registers - list of RegisterRecord objects before the change:
+    :param old_hosts - dict of Device objects before the change:
+    :param registers - list of RegisterRecord objects after the change:
+    :param hosts - dict of Device objects after the change:
+    :return - ConfigDiff object:
+    """
+    before = _registers_by_device(old_registers)
+    after = _registers_by_device(registers)
+
+    old_devices = {eui64_key(device.section): device for device in old_hosts.values()}
+    devices = {eui64_key(device.section): device for device in hosts.values()}
+
+    changed = set()
+    for eui64 in set(before).intersection(after):
+        same_registers = len(before[eui64]) == len(after[eui64]) and all(
+            a is b for a, b in zip(before[eui64], after[eui64]))
+
+        if not same_registers or old_devices.get(eui64_key(eui64)) is not devices.get(eui64_key(eui64)):
+            changed.add(eui64)
+
+    hosts_changed = [key for key in set(old_devices).union(devices) if old_devices.get(key) is not devices.get(key)]
+
+    return ConfigDiff(set(after) - set(before), set(before) - set(after), changed, hosts_changed)
+
+
+def position_changes(old_registers, registers):
+    """
+    Function to find where the registers which were kept by a change of the models now are.
+    :param old_registers - list of RegisterRecord objects before the change:
+    :param registers - list of RegisterRecord objects after the change:
+    :return - (moved, dropped) dict of the new position of the kept registers which moved indexed by their old
+    position, and set of the old positions of the registers which are gone or changed:
+    """
+    positions = {id(reg): position for position, reg in enumerate(registers)}
+    moved = {}
+    dropped = set()
+
+    for old_position, reg in enumerate(old_registers):
+        position = positions.get(id(reg))
+
+        if position is None:
+            dropped.add(old_position)
+        elif position != old_position:
+            moved[old_position] = position
+
+    return moved, dropped
+
+
+def remap(responses, moved, dropped):
+    """
+    Function to move the responses indexed by register position to the positions of the reloaded models, the
+    responses of the registers which are gone or changed are removed.
+    :param responses - dict of responses indexed by register position:
+    :param moved - dict of new positions indexed by old position, as returned by position_changes:
+    :param dropped - set of old positions, as returned by position_changes:
+    :return - new dict of responses indexed by the new register positions, the given one may have been submitted
+    to the snapshots or served to the other commands and is left as it is:
+    """
+    return {moved.get(position, position): r for position, r in responses.items() if position not in dropped}
+
+
+def combine_positions(old_tables, tables, positions):
+    """
+    Function to combine the position changes of every gateway into those of the registers of all gateways, the
+    positions of a gateway being offset by the registers of the previous ones.
+    :param old_tables - list of GatewayTables before the change:
+    :param tables - list of GatewayTables after the change:
+    :param positions - list of (moved, dropped) of every gateway, as returned by position_changes:
+    :return - (moved, dropped) of the registers of all gateways:
+    """
+    moved = {}
+    dropped = set()
+    old_offset = offset = 0
+
+    for old, new, (gateway_moved, gateway_dropped) in zip(old_tables, tables, positions):
+        for position in range(len(old.registers)):
+            if position in gateway_dropped:
+                dropped.add(old_offset + position)
+            elif old_offset + position != offset + gateway_moved.get(position, position):
+                moved[old_offset + position] = offset + gateway_moved.get(position, position)
+
+        old_offset += len(old.registers)
+        offset += len(new.registers)
+
+    return moved, dropped
+
+
+def carry_runs(old_index, index, moved, dropped):
+    """
+    Function to find the channel slots of the change detector which are kept by a change of the models: the
+    channels of an unchanged register of an unchanged device, merged into contiguous ranges.
+    :param old_index - JoinIndex before the change:
+    :param index - JoinIndex after the change:
+    :param moved - dict of new positions indexed by old position, as returned by position_changes:
+    :param dropped - set of old positions, as returned by position_changes:
+    :return runs - list of [slot, old slot, count]:
+    """
+    old_first = first_slots(old_index)
+    first = first_slots(index)
+    runs = []
+
+    for old_position in range(len(old_index.registers)):
+        position = moved.get(old_position, old_position)
+        count = len(old_index.channels[old_position])
+
+        if old_position in dropped or not count or old_index.devices[old_position] is not index.devices[position]:
+            continue
+
+        slot, old_slot = first[position], old_first[old_position]
+
+        if runs and runs[-1][0] + runs[-1][2] == slot and runs[-1][1] + runs[-1][2] == old_slot:
+            runs[-1][2] += count
+        else:
+            runs.append([slot, old_slot, count])
+
+    return runs
+
+
+class Reload():
+    """
+    Class holding the models of a configuration change together with everything the polling loop needs to
+    switch to them, built in advance by the ConfigReloader.
+    """
+    __slots__ = ('tables', 'registers', 'hosts', 'diff', 'positions', 'gateway_positions', 'index', 'old_index',
+                 'decoder', 'detector', 'runs')
+
+
+class ConfigReloader():
+    """
+    Class reloading the gateway and hosts publishers files in a background thread when they change. The new
+    models are parsed, compared with the current ones and their join index, decoder and change detector are built
+    before the polling loop takes them, so switching costs the loop as much as the change, not the size of the
+    files.
+    """
+    def __init__(self, gateway_files, hosts_file, interval=1.0):
+        self.gateway_files = list(gateway_files)
+        self.hosts_file = hosts_file
+
+        self.tables = [load_gateway(path) for path in self.gateway_files]
+        self.hosts = load_hosts(hosts_file)
+        self.registers = self._concat(self.tables)
+        self.index = JoinIndex(self.registers, self.hosts)
+        set_index(self.registers, self.hosts, self.index)
+
+        self.watcher = ConfigWatcher(self.gateway_files + [hosts_file], interval)
+        self.pending = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._work, name="reloader", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _concat(tables):
+        # Registers of all gateways, the list of the only gateway is kept as it is
+        if len(tables) == 1:
+            return tables[0].registers
+
+        return [reg for table in tables for reg in table.registers]
+
+    def _build(self):
+        # Load the changed models and prepare the switch to them
+        tables = [load_gateway(path) for path in self.gateway_files]
+        hosts = load_hosts(self.hosts_file)
+
+        if hosts is self.hosts and all(new is old for new, old in zip(tables, self.tables)):
+            return None
+
+        reload = Reload()
+        reload.tables = tables
+        reload.hosts = hosts
+        reload.registers = self._concat(tables)
+        reload.diff = diff_models(self.registers, self.hosts, reload.registers, hosts)
+        reload.gateway_positions = [position_changes(old.registers, new.registers)
+                                    for old, new in zip(self.tables, tables)]
+        reload.positions = combine_positions(self.tables, tables, reload.gateway_positions)
+
+        reload.index = JoinIndex(reload.registers, hosts)
+        reload.old_index = self.index
+        reload.decoder = Decoder(reload.index, settings.byte_order, settings.word_order)
+        reload.detector = ChangeDetector(reload.index, settings.integrity_period)
+        reload.runs = carry_runs(self.index, reload.index, *reload.positions)
+
+        return reload
+
+    def _work(self):
+        changed = set()
+
+        while not self.stopped.is_set():
+            changed |= self.watcher.wait(1.0)
+
+            # A reload is only built from the models the polling loop uses
+            if not changed or self.pending is not None:
+                continue
+
+            try:
+                reload = self._build()
+            except (OSError, ValueError, IndexError, KeyError) as e:
+                print(f"Could not reload {', '.join(sorted(changed))}, keeping the current configuration: {e}")
+                changed.clear()
+                continue
+
+            changed.clear()
+            if reload is None:
+                continue
+
+            with self.lock:
+                self.pending = reload
+
+    def take(self):
+        """
+        Method to switch to the models of the last configuration change, called by the polling loop between two
+        cycles. The join index, decoder and change detector are swapped in, the channels which did not change keep
+        their last reported values.
+        :return - Reload object, None if the configuration did not change:
+        """
+        with self.lock:
+            reload = self.pending
+            if reload is None:
+                return None
+
+            set_index(reload.registers, reload.hosts, reload.index)
+            set_decoder(reload.index, settings.byte_order, settings.word_order, reload.decoder)
+            migrate(reload.old_index, reload.index, reload.detector, reload.runs)
+
+            self.tables = reload.tables
+            self.hosts = reload.hosts
+            self.registers = reload.registers
+            self.index = reload.index
+            self.pending = None
+
+        print(f"Reloaded the configuration: {reload.diff}")
+        return reload
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.watcher.close()
+
+
+def apply_schedule(reload, scheduler, tracker, interval):
+    """
+    Function to apply a configuration change to the scheduler and the staleness tracker: new devices are
+    scheduled and tracked, removed ones dropped and changed ones rescheduled only if their timing changed.
+    :param reload - Reload object:
+    :param scheduler - Scheduler with one job per device:
+    :param tracker - StalenessTracker of the hosts publishers devices:
+    :param interval - default period in seconds:
+    """
+    from scheduler import timing
+
+    diff = reload.diff
+    hosts = {eui64_key(device.section): device for device in reload.hosts.values()}
+
+    for eui64 in diff.removed:
+        scheduler.remove(eui64)
+
+    for eui64 in diff.added | diff.changed:
+        period, phase = timing(hosts.get(eui64_key(eui64)), interval)
+        job = scheduler.jobs.get(eui64)
+
+        if job is None or (job.period, job.phase) != (period, phase):
+            scheduler.add(eui64, period, phase, running=True)
+
+    if tracker is not None:
+        for key in diff.hosts:
+            device = hosts.get(key)
+            tracker.set_device(device.section if device else f"{key:016X}", device, interval)
+
+
+def create_reloader(gateway_files, hosts_file):
+    """
+    Function to create the reloader of the configuration files from the context settings.
+    :param gateway_files - gateway configuration files, in the order their registers are positioned:
+    :param hosts_file - hosts publishers configuration file:
+    :return - ConfigReloader object, None if hot reload is disabled:
+    """
+    if settings.hot_reload != 'true':
+        return None
+
+    return ConfigReloader(gateway_files, hosts_file, settings.reload_interval)
@@ -0,0 +1,347 @@
+import os
+import mmap
+import time
+import struct
+
+from classes import settings
+
+# Closed bucket of a channel: bucket start, channel, count, min, max, sum, first value, last value, moments of the
+# first and last values. Times are epoch nanoseconds
+BUCKET = struct.Struct("<qHIdddddqq")
+
+# Open bucket of a channel in the snapshot of the open buckets: resolution in seconds, device, then a BUCKET
+OPEN_BUCKET = struct.Struct(f"<I16s{BUCKET.format[1:]}")
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """
+    Function to convert a duration written as seconds or with a unit, e.g. '90', '15m', '1h' or '1d', to seconds.
+    """
+    value = value.strip().lower()
+
+    if value[-1:] in UNITS:
+        return int(value[:-1]) * UNITS[value[-1]]
+
+    return int(value)
+
+
+def _merge(total, count, low, high, total_sum, first, last, first_time, last_time):
+    # Add the aggregates of a bucket to those of a larger one, [count, min, max, sum, first, last, times]
+    if total[0] == 0:
+        total[:] = [count, low, high, total_sum, first, last, first_time, last_time]
+        return
+
+    total[0] += count
+    total[1] = min(total[1], low)
+    total[2] = max(total[2], high)
+    total[3] += total_sum
+
+    if first_time < total[6]:
+        total[4], total[6] = first, first_time
+    if last_time > total[7]:
+        total[5], total[7] = last, last_time
+
+
+class Rollups():
+    """
+    Class maintaining incrementally the min, max, sum, count, first and last value of every channel over time
+    buckets of several resolutions, e.g. 1 minute and 1 hour. The open bucket of a device is kept in memory and
+    appended to the file of the device and resolution once a value of the next bucket arrives, so the records
+    of a file are in time order and a query only reads the records of its range, found with a binary search.
+    The open buckets are written to a snapshot every flush_interval seconds for the queries of other processes.
+    """
+    def __init__(self, path, resolutions=(60, 3600), flush_interval=5):
+        self.path = path
+        self.resolutions = sorted(int(resolution) for resolution in resolutions)
+        self.flush_interval = float(flush_interval)
+
+        # Open buckets indexed by resolution then device: [bucket start, {channel: aggregates}]
+        self.open = {resolution: {} for resolution in self.resolutions}
+        # Moment of the last value added to every channel, so a response submitted twice is added once
+        self.last_added = {}
+        self.times = {}
+        self.flushed_at = 0.0
+
+        for resolution in self.resolutions:
+            os.makedirs(os.path.join(path, f"{resolution}s"), exist_ok=True)
+
+        self.open_file = os.path.join(path, "open.bin")
+        self._restore()
+
+    def _file(self, resolution, device):
+        return os.path.join(self.path, f"{resolution}s", f"{device}.bin")
+
+    def _restore(self):
+        # Open buckets of the previous run, so the values of a bucket read before a restart are not lost
+        if not os.path.exists(self.open_file):
+            return
+
+        with open(self.open_file, "rb") as f:
+            data = f.read()
+
+        for resolution, name, start, channel, *aggregates in OPEN_BUCKET.iter_unpack(data):
+            if resolution not in self.open:
+                continue
+
+            device = name.rstrip(b"\0").decode()
+            state = self.open[resolution].get(device)
+            if state is None:
+                # The bucket may have been closed after the snapshot was written
+                if start <= self._last_closed(resolution, device):
+                    continue
+                state = self.open[resolution][device] = [start, {}]
+
+            state[1][channel] = aggregates
+
+            key = (device, channel)
+            self.last_added[key] = max(self.last_added.get(key, -1), aggregates[7])
+
+    def _last_closed(self, resolution, device):
+        # Start of the last bucket closed for a device, -1 if none was
+        path = self._file(resolution, device)
+        if not os.path.exists(path) or os.path.getsize(path) < BUCKET.size:
+            return -1
+
+        with open(path, "rb") as f:
+            f.seek(-(os.path.getsize(path) % BUCKET.size) - BUCKET.size, os.SEEK_END)
+            return BUCKET.unpack(f.read(BUCKET.size))[0]
+
+    def add(self, device, channel, timestamp, value):
+        """
+        Method to add a channel value to the open buckets of its device.
+        :param device - EUI64 of the device:
+        :param channel - number of the channel in the device, starting at 1:
+        :param timestamp - moment of the read in epoch nanoseconds:
+        :param value - value of the channel:
+        """
+        key = (device, channel)
+        if self.last_added.get(key, -1) >= timestamp:
+            return
+        self.last_added[key] = timestamp
+
+        for resolution in self.resolutions:
+            start = timestamp - timestamp % (resolution * 10**9)
+
+            state = self.open[resolution].get(device)
+            if state is None:
+                state = self.open[resolution][device] = [start, {}]
+            elif start > state[0]:
+                self._close(resolution, device, state)
+                state[0], state[1] = start, {}
+
+            aggregates = state[1].get(channel)
+            if aggregates is None:
+                state[1][channel] = [1, value, value, value, value, value, timestamp, timestamp]
+            else:
+                aggregates[0] += 1
+                if value < aggregates[1]:
+                    aggregates[1] = value
+                if value > aggregates[2]:
+                    aggregates[2] = value
+                aggregates[3] += value
+                aggregates[5] = value
+                aggregates[7] = timestamp
+
+    def _close(self, resolution, device, state):
+        # Append the buckets of all the channels of the device, so the records of a file stay in time order
+        start, channels = state
+
+        with open(self._file(resolution, device), "ab") as f:
+            f.write(b"".join(BUCKET.pack(start, channel, *channels[channel]) for channel in sorted(channels)))
+
+    def submit(self, resp, devices, registers, updated=None, now=None, decoded=None, timestamp=None):
+        """
+        Method to add the channel values decoded from the responses of a cycle.
+        :param resp - dict of responses as returned by modbus.read_registers:
+        :param devices - dict of Device objects indexed by EUI64:
+        :param registers - list of RegisterRecord objects the responses were read from:
+        :param updated - EUI64 of the devices read during the cycle, every response if not specified:
+        :param now - current time in seconds, used to write the snapshot of the open buckets:
+        :param decoded - responses already decoded, as returned by Decoder.decode, e.g. by the polling workers:
+        :param timestamp - moment of the cycle in epoch nanoseconds, the last_read of every response if not specified.
+        The last_read only counts seconds, a device read twice within a second is then only added once:
+        """
+        from identity import get_index
+        from decode import get_decoder
+        from store import parse_time
+
+        index = get_index(registers, devices)
+        if decoded is None:
+            decoded = get_decoder(index, settings.byte_order, settings.word_order).decode(resp)
+
+        for key, (position, values) in decoded.items():
+            device = index.eui64s[position]
+            if updated is not None and device not in updated:
+                continue
+
+            read_time = timestamp
+            if read_time is None:
+                last_read = resp[key]["last_read"]
+                read_time = self.times.get(last_read)
+                if read_time is None:
+                    if len(self.times) > 4096:
+                        self.times.clear()
+                    read_time = self.times[last_read] = parse_time(last_read)
+
+            for ch_number, value in enumerate(values, 1):
+                self.add(device, ch_number, read_time, value)
+
+        now = time.monotonic() if now is None else now
+        if now - self.flushed_at >= self.flush_interval:
+            self.flush()
+            self.flushed_at = now
+
+    def flush(self):
+        """
+        Method to write the snapshot of the open buckets, replacing the previous one at once.
+        """
+        records = []
+        for resolution, states in self.open.items():
+            for device, (start, channels) in states.items():
+                for channel in sorted(channels):
+                    records.append(OPEN_BUCKET.pack(resolution, device.encode(), start, channel, *channels[channel]))
+
+        temporary = self.open_file + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(records))
+        os.replace(temporary, self.open_file)
+
+    def close(self):
+        """
+        Method to write the snapshot of the open buckets, they are closed by the values of the next buckets.
+        """
+        self.flush()
+
+    def _open_buckets(self, resolution, device):
+        # Open buckets of a device, from memory when written by this process or from the snapshot
+        if self.open[resolution]:
+            state = self.open[resolution].get(device)
+            if state is None:
+                return []
+            return [(state[0], channel, *state[1][channel]) for channel in sorted(state[1])]
+
+        if not os.path.exists(self.open_file):
+            return []
+
+        with open(self.open_file, "rb") as f:
+            data = f.read()
+
+        name = device.encode().ljust(16, b"\0")
+        return [record[2:] for record in OPEN_BUCKET.iter_unpack(data)
+                if record[0] == resolution and record[1] == name]
+
+    def _closed_buckets(self, resolution, device, start, end):
+        # Closed buckets of a device starting in a time range, found with a binary search in its file
+        path = self._file(resolution, device)
+        if not os.path.exists(path) or os.path.getsize(path) < BUCKET.size:
+            return
+
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = len(mm) // BUCKET.size
+
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if struct.unpack_from("<q", mm, middle * BUCKET.size)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            for position in range(low, count):
+                record = BUCKET.unpack_from(mm, position * BUCKET.size)
+                if end is not None and record[0] > end:
+                    break
+
+                yield record
+
+    def query(self, device, bucket, start=0, end=None):
+        """
+        Method to get the aggregates of the channels of a device over time buckets, computed from the rollups of
+        the largest resolution the bucket is a multiple of.
+        :param device - EUI64 of the device:
+        :param bucket - size of the time buckets in seconds:
+        :param start - first moment in epoch nanoseconds:
+        :param end - last moment in epoch nanoseconds, no limit if not specified:
+        :return rows - list of dicts with the bucket start, channel, count, min, max, avg, first, last and rate of
+        change per second of every channel and bucket, in time order:
+        """
+        resolutions = [resolution for resolution in self.resolutions if bucket % resolution == 0]
+        if not resolutions:
+            raise ValueError(f"Buckets of {bucket} s are not a multiple of the rollups of "
+                             f"{', '.join(str(resolution) for resolution in self.resolutions)} s")
+
+        resolution = resolutions[-1]
+        size = bucket * 10**9
+        first = start - start % size
+
+        totals = {}
+        closed = set()
+
+        for record in self._closed_buckets(resolution, device, first, end):
+            closed.add((record[0], record[1]))
+            _merge(totals.setdefault((record[0] - record[0] % size, record[1]), [0] * 8), *record[2:])
+
+        # The snapshot may still hold a bucket which was closed since it was written
+        for record in self._open_buckets(resolution, device):
+            if (record[0], record[1]) in closed or record[0] < first or (end is not None and record[0] > end):
+                continue
+            _merge(totals.setdefault((record[0] - record[0] % size, record[1]), [0] * 8), *record[2:])
+
+        rows = []
+        for (bucket_start, channel), (count, low, high, total, first_value, last_value, first_time,
+                                      last_time) in sorted(totals.items()):
+            rows.append({
+                "bucket": bucket_start,
+                "channel": channel,
+                "count": count,
+                "min": low,
+                "max": high,
+                "avg": total / count,
+                "first": first_value,
+                "last": last_value,
+                "rate": (last_value - first_value) / ((last_time - first_time) / 1e9) if last_time > first_time
+                        else None
+            })
+
+        return rows
+
+    def last(self, device):
+        """
+        Method to get the last value of every channel of a device.
+        :param device - EUI64 of the device:
+        :return - dict of (moment in epoch nanoseconds, value) indexed by channel number:
+        """
+        resolution = self.resolutions[0]
+        values = {}
+
+        for record in self._open_buckets(resolution, device):
+            values[record[1]] = (record[9], record[7])
+
+        # Channels without a value in the open bucket come from the last closed buckets
+        path = self._file(resolution, device)
+        if os.path.exists(path) and os.path.getsize(path) >= BUCKET.size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                count = len(mm) // BUCKET.size
+
+                for position in range(count - 1, max(count - 4096, 0) - 1, -1):
+                    record = BUCKET.unpack_from(mm, position * BUCKET.size)
+                    if record[9] > values.get(record[1], (-1,))[0]:
+                        values[record[1]] = (record[9], record[7])
+
+        return dict(sorted(values.items()))
+
+
+def create_rollups(path=None):
+    """
+    Function to open the rollups configured in the context.
+    :param path - directory of the rollups, the configured rollup_dir if not specified:
+    :return - Rollups object, None if the rollups are disabled and no path is specified:
+    """
+    if path is None and settings.rollups != 'true':
+        return None
+
+    resolutions = [parse_duration(resolution) for resolution in settings.rollup_resolutions.split(',')]
+
+    return Rollups(path or settings.rollup_dir, resolutions, settings.rollup_flush)
@@ -0,0 +1,80 @@
+import os
+import json
+import struct
+
+from classes import settings
+
+# Frame of a message on the socket: kind, length of the JSON body
+FRAME = struct.Struct(">BI")
+REQUEST = 0x01
+REPLY = 0x02
+ERROR = 0x03
+
+# Largest body accepted, a snapshot of the responses of a large gateway fits easily
+MAX_BODY = 64 * 2**20
+
+
+def send(sock, kind, body):
+    """
+    Function to send a message framed by its kind and the length of its JSON body.
+    """
+    data = json.dumps(body, separators=(",", ":")).encode()
+    sock.sendall(FRAME.pack(kind, len(data)) + data)
+
+
+def _receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 2**20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+
+    return bytes(data)
+
+
+def receive(sock):
+    """
+    Function to receive a framed message.
+    :return - (kind, body) of the message:
+    """
+    kind, length = FRAME.unpack(_receive_exactly(sock, FRAME.size))
+    if length > MAX_BODY:
+        raise ConnectionError(f"Message of {length} bytes is too large")
+
+    return kind, json.loads(_receive_exactly(sock, length))
+
+
+def call(method, params=None, path=None, timeout=2.0):
+    """
+    Function to send a request to the running synchronization.
+    :param method - name of the request, e.g. 'rows':
+    :param params - dict of the parameters of the request:
+    :param path - socket of the synchronization, the configured rpc_socket if not specified:
+    :param timeout - seconds to wait for the reply:
+    :return - result of the request, None if no synchronization answered it and the command runs by itself:
+    """
+    path = path or settings.rpc_socket
+    if not os.path.exists(path):
+        return None
+
+    # Only imported when a synchronization may be running, the commands start faster without it
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(path)
+        send(sock, REQUEST, {"method": method, "params": params or {}})
+        kind, body = receive(sock)
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+    if kind == ERROR:
+        print(f"The running synchronization could not answer {method}: {body}")
+        return None
+
+    return body
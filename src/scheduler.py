@@ -0,0 +1,215 @@
+import time
+import heapq
+
+from model import load_hosts
+from identity import eui64_key
+from metrics import CYCLE_OVERRUNS
+
+# Policies for deadlines missed because a previous poll took too long
+CATCH_UP = "catch_up"  # run every missed tick, back to back
+SKIP = "skip"          # drop the missed ticks and continue with the next one on the grid
+
+
+class Job():
+    """
+    Class representing a device polled at a fixed rate, with its own period and phase offset and the
+    statistics of how late its polls started.
+    """
+    def __init__(self, name, period, phase=0.0):
+        self.name = name
+        self.period = float(period)
+        self.phase = float(phase)
+
+        self.runs = 0
+        self.skipped = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def record(self, lateness):
+        """
+        Method to record how late a poll of the job started.
+        :param lateness - seconds between the deadline and the moment the poll was started:
+        """
+        self.runs += 1
+        self.jitter_total += lateness
+        self.jitter_max = max(self.jitter_max, lateness)
+
+
+class Scheduler():
+    """
+    Class scheduling jobs at a fixed rate using a heap of deadlines on the monotonic clock. Deadlines are
+    computed from the start of the scheduler so the period does not drift with the time spent polling.
+    """
+    def __init__(self, policy=SKIP, clock=time.monotonic):
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+
+        self.policy = policy
+        self.clock = clock
+        self.start = clock()
+
+        self.jobs = {}
+        self.heap = []
+        self.seq = 0
+
+    def add(self, name, period, phase=0.0, running=False):
+        """
+        Method to add a job, run at phase seconds from the start of the scheduler and then every period.
+        :param name - name of the job, e.g. the EUI64 of a device:
+        :param period - seconds between two runs of the job:
+        :param phase - offset in seconds of the first run:
+        :param running - True for a job added while the scheduler runs, e.g. by a reload, which first runs at the
+        next tick of its grid instead of at the deadlines missed before it was added:
+        """
+        if float(period) <= 0:
+            raise ValueError(f"Period of {name} must be positive, got {period}")
+
+        job = Job(name, period, phase)
+        self.jobs[name] = job
+
+        deadline = self.start + job.phase
+        now = self.clock()
+        if running and deadline < now:
+            deadline += -((deadline - now) // job.period) * job.period
+
+        self._push(deadline, job)
+
+    def remove(self, name):
+        """
+        Method to stop scheduling a job, its pending deadline is dropped when it comes up.
+        :param name - name of the job:
+        """
+        self.jobs.pop(name, None)
+
+    def _push(self, deadline, job):
+        # The sequence number keeps jobs with the same deadline in insertion order
+        heapq.heappush(self.heap, (deadline, self.seq, job))
+        self.seq += 1
+
+    def delay(self):
+        """
+        Method to get the number of seconds until the next deadline.
+        """
+        if not self.heap:
+            return None
+
+        return max(0.0, self.heap[0][0] - self.clock())
+
+    def pop_due(self):
+        """
+        Method to take all jobs whose deadline has passed and schedule their next run.
+        :return - list of names of the due jobs:
+        """
+        now = self.clock()
+        due = []
+        overrun = False
+
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, job = heapq.heappop(self.heap)
+
+            # The job was removed or added again since this deadline was pushed
+            if self.jobs.get(job.name) is not job:
+                continue
+
+            job.record(now - deadline)
+            due.append(job.name)
+
+            # The previous cycle ran past the next deadline of the job
+            if now - deadline >= job.period:
+                overrun = True
+
+            next_deadline = deadline + job.period
+
+            # Move past the missed ticks when skipping
+            if self.policy == SKIP and next_deadline <= now:
+                missed = int((now - next_deadline) // job.period) + 1
+                job.skipped += missed
+                next_deadline += missed * job.period
+
+            self._push(next_deadline, job)
+
+        if overrun:
+            CYCLE_OVERRUNS.labels().inc()
+
+        return due
+
+    def wait_due(self):
+        """
+        Method to sleep until the next deadline and return the jobs due at that moment.
+        :return - list of names of the due jobs:
+        """
+        delay = self.delay()
+        if delay is None:
+            return []
+
+        time.sleep(delay)
+        return self.pop_due()
+
+    def stats(self):
+        """
+        Method to get the scheduling statistics of every job.
+        :return - dict of statistics indexed by job name:
+        """
+        return {
+            name: {
+                "period": job.period,
+                "runs": job.runs,
+                "skipped": job.skipped,
+                "jitter_mean": job.jitter_total / job.runs if job.runs else 0.0,
+                "jitter_max": job.jitter_max
+            }
+            for name, job in self.jobs.items()
+        }
+
+    def print_stats(self):
+        """
+        Method to print the scheduling statistics as an ASCII table.
+        """
+        import texttable
+
+        table = texttable.Texttable()
+        table.set_cols_align(["c", "c", "c", "c", "c", "c"])
+        table.set_cols_valign(["m", "m", "m", "m", "m", "m"])
+        table.set_cols_dtype(['t', 'f', 'i', 'i', 'f', 'f'])
+        table.set_precision(4)
+
+        rows = [["Device", "Period", "Runs", "Skipped", "Mean jitter", "Max jitter"]]
+        for name, stat in self.stats().items():
+            rows.append([name, stat["period"], stat["runs"], stat["skipped"], stat["jitter_mean"],
+                         stat["jitter_max"]])
+
+        table.add_rows(rows)
+        print(table.draw())
+
+
+def create_scheduler(filename_hosts, devices, interval, policy=SKIP):
+    """
+    Function to create a scheduler with one job per device, polled at the Data_Period and Data_Phase of its
+    concentrator from the hosts publishers file, or at the default interval if the device has no concentrator.
+    :param filename_hosts - hosts publishers configuration file:
+    :param devices - EUI64 of the devices to be scheduled:
+    :param interval - default period in seconds:
+    :param policy - CATCH_UP or SKIP, what to do with missed deadlines:
+    :return scheduler - Scheduler object:
+    """
+    # Get the concentrator of each device
+    hosts = {eui64_key(device.section): device for device in load_hosts(filename_hosts).values()}
+
+    scheduler = Scheduler(policy)
+    for eui64 in devices:
+        scheduler.add(eui64, *timing(hosts.get(eui64_key(eui64)), interval))
+
+    return scheduler
+
+
+def timing(device, interval):
+    """
+    Function to get the period and phase a device is polled at.
+    :param device - Device from the hosts publishers model, None if the device has no concentrator:
+    :param interval - default period in seconds:
+    :return - (period, phase) in seconds:
+    """
+    if device is None or device.concentrator.Data_Period <= 0:
+        return float(interval), 0.0
+
+    return float(device.concentrator.Data_Period), float(device.concentrator.Data_Phase)
@@ -0,0 +1,350 @@
+import os
+import time
+import queue
+import struct
+import asyncio
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+
+import async_poller
+from classes import settings
+from decode import Decoder
+from identity import get_index
+from model import load_gateway, load_hosts
+from store import create_store, format_time
+from metrics import metrics, timer, CYCLE_SECONDS, DECODE_SECONDS
+
+# Slot header: cycle, timestamp in epoch nanoseconds, number of records, size of the records
+SLOT_HEADER = struct.Struct("<qqII")
+
+# Record header: position of the register in the registers of all gateways, word count, number of decoded values.
+# The words are followed by the decoded values, none if the response could not be decoded
+RECORD_HEADER = struct.Struct("<IHH")
+
+# Number of cycles a shard can get ahead of the coordinator before overwriting unread results
+SLOTS = 4
+
+
+class SharedRing():
+    """
+    Class for a ring of fixed size slots in shared memory, written by a polling worker and read by the
+    coordinator. The slot of a cycle is cycle % slots, its header tells which cycle it holds.
+    """
+    def __init__(self, slot_size=0, slots=SLOTS, name=None):
+        self.slot_size = SLOT_HEADER.size + slot_size
+        self.slots = slots
+
+        if name is None:
+            self.memory = SharedMemory(create=True, size=self.slot_size * slots)
+        else:
+            self.memory = SharedMemory(name=name)
+            self.slot_size = self.memory.size // slots
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, cycle, timestamp, records):
+        """
+        Method to write the records of a cycle in its slot.
+        :param cycle - cycle number:
+        :param timestamp - moment of the read in epoch nanoseconds:
+        :param records - list of packed records:
+        """
+        payload = b"".join(records)
+        if SLOT_HEADER.size + len(payload) > self.slot_size:
+            raise ValueError(f"{len(payload)} bytes of cycle {cycle} do not fit in a slot of {self.slot_size} bytes")
+
+        start = (cycle % self.slots) * self.slot_size
+        self.memory.buf[start + SLOT_HEADER.size:start + SLOT_HEADER.size + len(payload)] = payload
+        SLOT_HEADER.pack_into(self.memory.buf, start, cycle, timestamp, len(records), len(payload))
+
+    def read(self, cycle, formats):
+        """
+        Method to read the records written for a cycle.
+        :param cycle - cycle number:
+        :param formats - Struct of the decoded values of every register position, as returned by value_formats:
+        :return - (timestamp, generator of (position, words, values) tuples, values None if the response was not
+        decoded), None if the slot holds another cycle:
+        """
+        start = (cycle % self.slots) * self.slot_size
+        slot_cycle, timestamp, count, size = SLOT_HEADER.unpack_from(self.memory.buf, start)
+
+        if slot_cycle != cycle:
+            return None
+
+        return timestamp, self._records(start + SLOT_HEADER.size, count, formats)
+
+    def _records(self, offset, count, formats):
+        buf = self.memory.buf
+
+        for _ in range(count):
+            position, word_cnt, values_cnt = RECORD_HEADER.unpack_from(buf, offset)
+            offset += RECORD_HEADER.size
+
+            words = list(struct.unpack_from(f"<{word_cnt}H", buf, offset))
+            offset += 2 * word_cnt
+
+            values = None
+            if values_cnt:
+                values = formats[position].unpack_from(buf, offset)
+                offset += formats[position].size
+
+            yield position, words, values
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def partition(gateways, registers, workers):
+    """
+    Function to split the gateways between workers, balancing the number of registers of every worker.
+    :param gateways - list of gateway settings dicts:
+    :param registers - list of the register counts of every gateway:
+    :param workers - number of workers:
+    :return shards - list of the gateway positions of every worker:
+    """
+    shards = [[] for _ in range(min(workers, len(gateways)))]
+    loads = [0] * len(shards)
+
+    for position in sorted(range(len(gateways)), key=lambda position: -registers[position]):
+        shard = loads.index(min(loads))
+        shards[shard].append(position)
+        loads[shard] += registers[position]
+
+    return [sorted(shard) for shard in shards]
+
+
+def value_formats(index):
+    """
+    Function to get the layout of the decoded values of every register in the shared rings, floats as doubles and
+    the other formats as 64 bit integers so the values keep their type.
+    :param index - JoinIndex of the registers:
+    :return - list of Struct objects indexed by register position:
+    """
+    return [struct.Struct("<" + "".join("d" if code == "f" else "q" for _, _, _, code in layout))
+            for layout in index.layouts]
+
+
+def _worker(shard, gateways, offsets, hosts, ring_name, ticks, done):
+    """
+    Function run by a worker process: polls its gateways for every cycle received from the coordinator, decodes
+    and stores the responses and writes them in its shared ring.
+    """
+    asyncio.run(_work(shard, gateways, offsets, hosts, ring_name, ticks, done))
+
+
+async def _work(shard, gateways, offsets, hosts, ring_name, ticks, done):
+    # Only the metrics of the worker are sent back, not those of the coordinator it was forked from
+    metrics.clear()
+
+    ring = SharedRing(name=ring_name)
+    gateways = async_poller.create_gateways(gateways)
+    registers = [reg for gateway in gateways for reg in gateway.registers]
+
+    # The registers of the worker are decoded with their own index, positioned one gateway after the other
+    index = get_index(registers, load_hosts(hosts))
+    decoder = Decoder(index, settings.byte_order, settings.word_order)
+    formats = value_formats(index)
+
+    # Every worker appends its reads to its own store
+    history = create_store(registers, os.path.join(settings.store_dir, f"shard-{shard}"))
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        while True:
+            tick = await loop.run_in_executor(None, ticks.get)
+            if tick is None:
+                break
+
+            cycle, devices = tick
+            await asyncio.gather(*(gateway.poll(devices) for gateway in gateways))
+            timestamp = time.time_ns()
+
+            # Responses read during the cycle, by position in the registers of the worker
+            resp = {}
+            positions = {}
+            local = 0
+            for gateway, offset in zip(gateways, offsets):
+                for position, r in gateway.responses.items():
+                    if r["device"] in gateway.updated:
+                        resp[local + position] = r
+                        positions[local + position] = offset + position
+                local += len(gateway.registers)
+
+            with timer(DECODE_SECONDS.labels()):
+                decoded = decoder.decode(resp)
+
+            records = []
+            for position, r in resp.items():
+                words = r["response"]
+                values = decoded[position][1] if position in decoded else ()
+
+                records.append(RECORD_HEADER.pack(positions[position], len(words), len(values)) +
+                               struct.pack(f"<{len(words)}H", *words) +
+                               (formats[position].pack(*values) if values else b""))
+
+            if history:
+                history.append_responses(resp, set().union(*(gateway.updated for gateway in gateways)), timestamp)
+
+            ring.write(cycle, timestamp, records)
+            done.put((shard, cycle, metrics.state()))
+
+    finally:
+        await asyncio.gather(*(gateway.conn.close() for gateway in gateways))
+        ring.close()
+        if history:
+            history.close()
+
+
+class ShardedPoller():
+    """
+    Class coordinating worker processes which poll, decode and store a share of the gateways each. The words and
+    the decoded values come back through a shared memory ring per worker and are merged into one snapshot per
+    cycle, the metrics of the workers are merged into the metrics of the coordinator.
+    """
+    def __init__(self, gateways, workers, timeout=5, hosts=None):
+        self.timeout = float(timeout)
+        hosts = hosts or settings.in_hosts
+
+        # Registers of all gateways, a register is known by its position in this list
+        tables = [load_gateway(gateway['in_gw']).registers for gateway in gateways]
+        offsets = []
+        self.registers = []
+        self.gateway_names = []
+
+        for gateway, registers in zip(gateways, tables):
+            offsets.append(len(self.registers))
+            self.registers.extend(registers)
+            self.gateway_names.extend([gateway['name']] * len(registers))
+
+        # The values are laid out as the workers decode them, from the same hosts publishers file
+        self.formats = value_formats(get_index(self.registers, load_hosts(hosts)))
+
+        self.responses = {}
+        self.decoded = {}
+        self.updated = set()
+        self.cycle = 0
+        self.done = Queue()
+        self.shards = []
+
+        for shard, positions in enumerate(partition(gateways, [len(table) for table in tables], int(workers))):
+            slot_size = sum(RECORD_HEADER.size + 2 * tables[position][index].word_cnt +
+                            self.formats[offsets[position] + index].size
+                            for position in positions for index in range(len(tables[position])))
+            ring = SharedRing(slot_size)
+            ticks = Queue()
+
+            process = Process(target=_worker, name=f"poller-{shard}",
+                              args=(shard, [gateways[position] for position in positions],
+                                    [offsets[position] for position in positions], hosts, ring.name, ticks,
+                                    self.done))
+            process.start()
+
+            self.shards.append((process, ring, ticks))
+
+    def poll(self, devices=None):
+        """
+        Method to poll the devices on all workers and merge their results. Workers which do not answer within the
+        timeout keep their previous responses in the snapshot.
+        :param devices - EUI64 of the devices to be read, all devices if not specified:
+        :return - responses indexed by register position, in the same structure as modbus.read_registers, their
+        values decoded by the workers are in decoded:
+        """
+        self.cycle += 1
+        self.updated = set()
+
+        for _, _, ticks in self.shards:
+            ticks.put((self.cycle, devices))
+
+        pending = set(range(len(self.shards)))
+        deadline = time.monotonic() + self.timeout
+
+        while pending:
+            try:
+                shard, cycle, state = self.done.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                print(f"Workers {sorted(pending)} did not finish cycle {self.cycle} in {self.timeout}s")
+                break
+
+            metrics.merge(state, shard=str(shard))
+
+            # Results of a cycle which already timed out
+            if cycle != self.cycle:
+                continue
+
+            pending.discard(shard)
+            self._merge(self.shards[shard][1].read(cycle, self.formats))
+
+        self.decoded = dict(sorted(self.decoded.items()))
+        return dict(sorted(self.responses.items()))
+
+    def _merge(self, slot):
+        if slot is None:
+            return
+
+        timestamp, records = slot
+        last_read = format_time(timestamp)
+
+        for position, words, values in records:
+            reg = self.registers[position]
+
+            if values is None:
+                self.decoded.pop(position, None)
+            else:
+                self.decoded[position] = (position, values)
+
+            self.responses[position] = {
+                "table": reg.table,
+                "register": reg.start_addr,
+                "response": words,
+                "device": reg.EUI64,
+                "last_read": last_read,
+                "gateway": self.gateway_names[position]
+            }
+            self.updated.add(reg.EUI64)
+
+    def close(self):
+        """
+        Method to stop the workers and release the shared memory.
+        """
+        for process, ring, ticks in self.shards:
+            ticks.put(None)
+
+        for process, ring, ticks in self.shards:
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+            ring.close(unlink=True)
+
+
+def run(poller, scheduler, tracker=None, callback=None):
+    """
+    Function to poll the devices on the workers when they are due.
+    :param poller - ShardedPoller object:
+    :param scheduler - Scheduler with one job per device:
+    :param tracker - StalenessTracker updated with the devices read successfully:
+    :param callback - function called with the responses after every cycle:
+    """
+    cycle_seconds = CYCLE_SECONDS.labels(poller="sharded")
+
+    try:
+        while True:
+            due = scheduler.wait_due()
+
+            start = time.perf_counter()
+            resp = poller.poll(due)
+            cycle_seconds.observe(time.perf_counter() - start)
+
+            if tracker:
+                for eui64 in poller.updated:
+                    tracker.update(eui64)
+
+            if callback:
+                callback(resp)
+
+    finally:
+        poller.close()
@@ -0,0 +1,259 @@
+import os
+import math
+import time
+import random
+import struct
+import asyncio
+import argparse
+from array import array
+
+from identity import get_index
+from model import load_gateway, load_hosts, TABLES
+
+# MBAP header: transaction id, protocol id, length, unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+
+# MODBUS exception code sent for injected failures: slave device failure
+SLAVE_DEVICE_FAILURE = 0x04
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+
+
+class Simulator():
+    """
+    Class for a local MODBUS TCP slave serving the registers of a gateway configuration, filled with values
+    synthesized from the channel formats of the hosts publishers. Latency, jitter, lost requests and exception
+    responses can be injected to test the pollers.
+    """
+    def __init__(self, registers, devices, latency=0.0, jitter=0.0, loss=0.0, exceptions=0.0, seed=None):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.loss = float(loss)
+        self.exceptions = float(exceptions)
+        self.random = random.Random(seed)
+
+        # Words of the register tables and bits of the bit tables, indexed by function code
+        self.tables = {function: bytearray(65536) if bits else array('H', bytes(2 * 65536))
+                       for function, bits, _ in TABLES.values()}
+        self.limits = {function: max_count for function, _, max_count in TABLES.values()}
+        self.layout = []
+        self.bit_layout = []
+
+        # Place the channels of every device on its registers, bit tables get one value per bit
+        index = get_index(registers, devices)
+        for reg, layout in zip(registers, index.layouts):
+            function, bits, _ = TABLES[reg.table]
+
+            if bits:
+                self.bit_layout.extend((self.tables[function], reg.start_addr + bit) for bit in range(reg.bits))
+                continue
+
+            for ch, first_word, size, code in layout:
+                self.layout.append((self.tables[function], reg.start_addr + first_word, size, code))
+
+        self.requests = 0
+        self.server = None
+        self.connections = set()
+        self.update()
+
+    def update(self, now=None):
+        """
+        Method to give every channel a new value, a slow sine wave shifted for every channel.
+        """
+        if now is None:
+            now = time.time()
+
+        for position, (table, address, size, code) in enumerate(self.layout):
+            value = 50 + 40 * math.sin(now / 60 + position)
+
+            if code != 'f':
+                value = int(value)
+
+            # 8 bit codes are padded with their high byte, so every value packs into whole words
+            words = struct.unpack(f">{size}H", struct.pack(f">{code}", value))
+            table[address:address + size] = array('H', words)
+
+        for position, (table, address) in enumerate(self.bit_layout):
+            table[address] = math.sin(now / 60 + position) > 0
+
+    async def handle(self, reader, writer):
+        """
+        Method serving the requests of a client connection, every request is answered by its own task so replies
+        can overtake each other when jitter is injected.
+        """
+        lock = asyncio.Lock()
+        tasks = set()
+        self.connections.add(asyncio.current_task())
+
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                trans_id, _, length, unit = MBAP_HEADER.unpack(header)
+                pdu = await reader.readexactly(length - 1)
+
+                task = asyncio.create_task(self.respond(writer, lock, trans_id, unit, pdu))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def respond(self, writer, lock, trans_id, unit, pdu):
+        self.requests += 1
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Lost request, the client has to time out
+        if self.random.random() < self.loss:
+            return
+
+        body = self.execute(pdu)
+
+        if self.random.random() < self.exceptions:
+            body = bytes([pdu[0] | 0x80, SLAVE_DEVICE_FAILURE])
+
+        async with lock:
+            writer.write(MBAP_HEADER.pack(trans_id, 0, len(body) + 1, unit) + body)
+            await writer.drain()
+
+    def execute(self, pdu):
+        """
+        Method building the response PDU of a request.
+        :param pdu - request PDU:
+        :return - response PDU:
+        """
+        function = pdu[0]
+
+        table = self.tables.get(function)
+        if table is None:
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+
+        bits = isinstance(table, bytearray)
+        address, count = struct.unpack(">HH", pdu[1:5])
+        if count < 1 or count > self.limits[function] or address + count > 65536:
+            return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+
+        if bits:
+            # Bits are packed 8 to a byte, the first one in the least significant bit
+            data = bytearray((count + 7) // 8)
+            for position in range(count):
+                if table[address + position]:
+                    data[position >> 3] |= 1 << (position & 7)
+        else:
+            data = struct.pack(f">{count}H", *table[address:address + count])
+
+        return bytes([function, len(data)]) + bytes(data)
+
+    async def serve(self, address="127.0.0.1", port=502):
+        """
+        Method to start serving, the returned server is already listening.
+        :return - asyncio Server object:
+        """
+        self.server = await asyncio.start_server(self.handle, address, port)
+        return self.server
+
+    async def close(self):
+        """
+        Method to stop serving and drop the client connections.
+        """
+        if self.server is not None:
+            self.server.close()
+
+        for connection in list(self.connections):
+            connection.cancel()
+
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+
+def synthesize(directory, devices, channels=4, words_per_channel=2, fmt='float'):
+    """
+    Function to write a gateway and a hosts publishers configuration with the specified number of devices,
+    every device mapped on its own consecutive registers.
+    :param directory - directory the files are written to:
+    :param devices - number of devices:
+    :param channels - number of channels of every device:
+    :param words_per_channel - registers used by a channel:
+    :param fmt - format of the channels:
+    :return - (gateway file, hosts publishers file):
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    path_gw = os.path.join(directory, "modbus_gw.ini")
+    path_hosts = os.path.join(directory, "host_publishers.conf")
+
+    word_cnt = channels * words_per_channel
+
+    with open(path_gw, "w") as f_gw, open(path_hosts, "w") as f_hosts:
+        f_gw.write("[INPUT_REGISTERS]\n")
+
+        for index in range(devices):
+            eui64 = f"{0x1000000000000000 + index:016X}"
+            section = ':'.join(eui64[i:i + 4] for i in range(0, 16, 4))
+
+            f_gw.write(f"REGISTER = {index * word_cnt},{word_cnt},{eui64},2,129,5,0,0,0,2\n")
+
+            f_hosts.write(f"[{section}]\n")
+            f_hosts.write(f"CONCENTRATOR = 2, 4, {10 + index % 4 * 5}, 0, 5, 16, 2\n")
+            for ch in range(channels):
+                f_hosts.write(f"CHANNEL = 2, 129, {5 + ch}, 0, 0, '{fmt}', 'ch{ch}', 'unit', 0\n")
+            f_hosts.write("\n")
+
+    return path_gw, path_hosts
+
+
+def create_simulator(filename_gw, filename_hosts, **kwargs):
+    """
+    Function to create a simulator for the registers of a gateway file.
+    :param filename_gw - gateway configuration file:
+    :param filename_hosts - hosts publishers configuration file:
+    :return - Simulator object:
+    """
+    return Simulator(load_gateway(filename_gw).registers, load_hosts(filename_hosts), **kwargs)
+
+
+async def _serve_forever(simulator, address, port, refresh):
+    server = await simulator.serve(address, port)
+    print(f"Simulating {len(simulator.layout)} channels on {address}:{port}")
+
+    async with server:
+        while True:
+            await asyncio.sleep(refresh)
+            simulator.update()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='simulator.py',
+            description='Run a local MODBUS TCP slave serving the registers of the configuration files.')
+    parser.add_argument('--gateway', default='../conf/modbus_gw.ini', help='MODBUS gateway config file')
+    parser.add_argument('--hosts', default='../conf/host_publishers.conf', help='Hosts publishers config file')
+    parser.add_argument('--synthesize', type=int, metavar='DEVICES',
+                        help='Generate configuration files for this many devices in --directory and serve them')
+    parser.add_argument('--directory', default='../out/simulated', help='Directory of the generated files')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=502)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability of not answering a request')
+    parser.add_argument('--exceptions', type=float, default=0.0, help='Probability of an exception response')
+    parser.add_argument('--refresh', type=float, default=1.0, help='Seconds between value updates')
+    options = parser.parse_args()
+
+    gateway, hosts = options.gateway, options.hosts
+    if options.synthesize:
+        gateway, hosts = synthesize(options.directory, options.synthesize)
+
+    simulator = create_simulator(gateway, hosts, latency=options.latency, jitter=options.jitter,
+                                 loss=options.loss, exceptions=options.exceptions)
+
+    try:
+        asyncio.run(_serve_forever(simulator, options.address, options.port, options.refresh))
+    except KeyboardInterrupt:
+        pass
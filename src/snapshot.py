@@ -0,0 +1,73 @@
+import os
+import json
+import queue
+import hashlib
+import threading
+
+
+class SnapshotWriter():
+    """
+    Class exporting JSON snapshots of in-memory data from a background thread, so the polling loop never waits
+    for serialization or disk writes. A file is only rewritten when its content changed.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.digests = {}
+        self.thread = None
+
+    def submit(self, path, data, indent=4, sort_keys=False):
+        """
+        Method to queue data to be written as JSON to the specified path. The data must not be changed
+        after being submitted.
+        :param path - output file:
+        :param data - JSON serializable data:
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work, name="snapshot-writer", daemon=True)
+            self.thread.start()
+
+        self.queue.put((path, data, indent, sort_keys))
+
+    def flush(self):
+        """
+        Method to wait until all the submitted snapshots are written.
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+    def _work(self):
+        while True:
+            path, data, indent, sort_keys = self.queue.get()
+
+            try:
+                self.write(path, data, indent, sort_keys)
+            except Exception as e:
+                print(f"Could not export snapshot {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, data, indent=4, sort_keys=False):
+        """
+        Method to write data as JSON to a file if it differs from what was last written there, replacing the file
+        atomically so readers never see a partial snapshot.
+        :param path - output file:
+        :param data - JSON serializable data:
+        :return - True if the file was written:
+        """
+        content = json.dumps(data, indent=indent, sort_keys=sort_keys).encode()
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+
+        if self.digests.get(path) == digest:
+            return False
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        self.digests[path] = digest
+        return True
+
+
+# Snapshot writer shared by the commands of a process
+snapshots = SnapshotWriter()
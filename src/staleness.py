@@ -0,0 +1,151 @@
+import time
+import heapq
+import calendar
+from array import array
+
+from identity import eui64_key
+
+# Statuses used for data availability
+FRESH = "Fresh"
+STALE = "Stale"
+MISSING = "Missing"
+
+
+def stale_limit(concentrator, interval):
+    """
+    Function to get the age in seconds after which the data of a device is stale: Data_StaleLimit periods.
+    :param concentrator - ConcentratorRecord of the device:
+    :param interval - period in seconds used when the concentrator has no Data_Period:
+    :return - limit in seconds:
+    """
+    period = concentrator.Data_Period if concentrator.Data_Period > 0 else float(interval)
+    return period * max(concentrator.Data_StaleLimit, 1)
+
+
+class StalenessTracker():
+    """
+    Class keeping the last successful read of every device as monotonic nanoseconds in an array, indexed by the
+    position of the device. A heap of deadlines gives the devices which became stale without scanning all of them.
+    """
+    def __init__(self, devices, interval, clock=time.monotonic_ns):
+        self.clock = clock
+
+        self.index = {}
+        self.names = []
+        self.limits = array('q')
+        self.last_read = array('q')
+
+        for position, (eui64, device) in enumerate(devices.items()):
+            self.index[eui64_key(device.section)] = position
+            self.names.append(eui64)
+            self.limits.append(int(stale_limit(device.concentrator, interval) * 1e9))
+            self.last_read.append(0)
+
+        self.deadlines = []
+        self.stale_devices = set()
+        self.missing_devices = set(self.names)
+
+    def set_device(self, eui64, device, interval):
+        """
+        Method to start tracking a device, change its stale limit or stop tracking it, the reads of the tracked
+        devices are kept.
+        :param eui64 - device, in the gateway or the hosts publishers form:
+        :param device - Device from the hosts publishers model, None to stop tracking the device:
+        :param interval - period in seconds used when the concentrator has no Data_Period:
+        """
+        key = eui64_key(eui64)
+        position = self.index.get(key)
+
+        if device is None:
+            if position is not None:
+                del self.index[key]
+                self.stale_devices.discard(self.names[position])
+                self.missing_devices.discard(self.names[position])
+            return
+
+        if position is None:
+            self.index[key] = len(self.names)
+            self.names.append(device.EUI64)
+            self.limits.append(int(stale_limit(device.concentrator, interval) * 1e9))
+            self.last_read.append(0)
+            self.missing_devices.add(device.EUI64)
+        else:
+            self.limits[position] = int(stale_limit(device.concentrator, interval) * 1e9)
+
+    def update(self, eui64, now=None):
+        """
+        Method to record a successful read of a device.
+        :param eui64 - device read, in the gateway or the hosts publishers form:
+        :param now - moment of the read in monotonic nanoseconds, the current time if not specified:
+        """
+        position = self.index.get(eui64_key(eui64))
+        if position is None:
+            return
+
+        if now is None:
+            now = self.clock()
+
+        self.last_read[position] = now
+        self.stale_devices.discard(self.names[position])
+        self.missing_devices.discard(self.names[position])
+
+        heapq.heappush(self.deadlines, (now + self.limits[position], position, now))
+
+    def _expire(self, now):
+        # Move the devices whose deadline passed without a newer read to the stale devices
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, position, read_at = heapq.heappop(self.deadlines)
+
+            # Devices no longer tracked keep their position but not their index entry
+            if self.last_read[position] == read_at and self.index.get(eui64_key(self.names[position])) == position:
+                self.stale_devices.add(self.names[position])
+
+    def status(self, eui64, now=None):
+        """
+        Method to get the status of the data of a device.
+        :param eui64 - device:
+        :return - FRESH, STALE or MISSING:
+        """
+        position = self.index.get(eui64_key(eui64))
+        if position is None or self.last_read[position] == 0:
+            return MISSING
+
+        if now is None:
+            now = self.clock()
+
+        if now - self.last_read[position] > self.limits[position]:
+            return STALE
+
+        return FRESH
+
+    def stale(self, now=None):
+        """
+        Method to get the devices whose data is stale, the cost depends on the number of devices which became
+        stale since the previous call, not on the number of devices.
+        :return - set of EUI64:
+        """
+        self._expire(self.clock() if now is None else now)
+        return set(self.stale_devices)
+
+    def missing(self):
+        """
+        Method to get the devices which were never read.
+        :return - set of EUI64:
+        """
+        return set(self.missing_devices)
+
+
+def status_from_time(last_read, concentrator, interval):
+    """
+    Function to get the status of a response from the time it was read, used when no tracker is running.
+    :param last_read - UTC time of the read as written in the response, '%Y-%m-%d %H:%M:%S':
+    :param concentrator - ConcentratorRecord of the device:
+    :param interval - period in seconds used when the concentrator has no Data_Period:
+    :return - FRESH, STALE or MISSING:
+    """
+    if not last_read:
+        return MISSING
+
+    age = time.time() - calendar.timegm(time.strptime(last_read, "%Y-%m-%d %H:%M:%S"))
+
+    return STALE if age > stale_limit(concentrator, interval) else FRESH
@@ -0,0 +1,294 @@
+import os
+import mmap
+import json
+import time
+import struct
+import calendar
+
+from classes import settings
+from model import TABLES
+
+# Segment header: magic, format version, number of words of every record
+HEADER = struct.Struct("<4sHH")
+MAGIC = b"MBTS"
+
+# Timestamp at the start of every record
+TIMESTAMP = struct.Struct("<q")
+VERSION = 2
+
+# Records of the first version have no table, all their reads were from the input registers
+RECORD_FORMATS = {1: "<qIHH{}H", 2: "<qIBHH{}H"}
+
+# Tables of the records by the function code reading them
+TABLE_NAMES = {code: table for table, (code, _, _) in TABLES.items()}
+
+
+def parse_time(value):
+    """
+    Function to convert an UTC time as written in the responses, '%Y-%m-%d %H:%M:%S', to epoch nanoseconds.
+    """
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d %H:%M:%S")) * 10**9
+
+
+def format_time(timestamp):
+    """
+    Function to convert epoch nanoseconds to an UTC time as written in the responses.
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp // 10**9))
+
+
+class Store():
+    """
+    Class for an append-only store of the poll results. Every read is a fixed width record (timestamp, device
+    index, table, register, word count, raw words) appended to the current segment file; segments are rotated by size,
+    removed by age and memory-mapped when queried.
+    """
+    def __init__(self, path, words=8, segment_size=16 * 2**20, retention=7 * 86400, create=True):
+        self.path = path
+        self.words = int(words)
+        self.segment_size = int(segment_size)
+        self.retention = int(retention)
+
+        # timestamp, device index, function code of the table, register, word count, words
+        self.record = struct.Struct(RECORD_FORMATS[VERSION].format(self.words))
+
+        # Stores opened for a query are only read
+        if create:
+            os.makedirs(path, exist_ok=True)
+
+        # Devices are stored by index, the index of a device never changes
+        self.devices_file = os.path.join(path, "devices.json")
+        self.devices = []
+        if os.path.exists(self.devices_file):
+            with open(self.devices_file, "r") as f:
+                self.devices = json.load(f)
+        self.device_index = {eui64: index for index, eui64 in enumerate(self.devices)}
+
+        self.segment = None
+
+    def segments(self):
+        """
+        Method to get the segment files of the store, oldest first.
+        :return - list of paths:
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        names = sorted(name for name in os.listdir(self.path) if name.startswith("seg-") and name.endswith(".bin"))
+        return [os.path.join(self.path, name) for name in names]
+
+    def _index(self, eui64):
+        # Register new devices before their first record
+        if eui64 not in self.device_index:
+            self.device_index[eui64] = len(self.devices)
+            self.devices.append(eui64)
+
+            with open(self.devices_file, "w") as f:
+                json.dump(self.devices, f)
+
+        return self.device_index[eui64]
+
+    def _open_segment(self, timestamp):
+        if self.segment is not None:
+            self.segment.close()
+
+        path = os.path.join(self.path, f"seg-{timestamp:020d}.bin")
+        self.segment = open(path, "ab")
+
+        if self.segment.tell() == 0:
+            self.segment.write(HEADER.pack(MAGIC, VERSION, self.words))
+
+    def append(self, eui64, table, register, words, timestamp=None):
+        """
+        Method to append the words read from a register.
+        :param eui64 - device the register belongs to:
+        :param table - table the register was read from, e.g. 'INPUT_REGISTERS':
+        :param register - start address of the register:
+        :param words - list of register values, at most the number of words of the store:
+        :param timestamp - moment of the read in epoch nanoseconds, the current time if not specified:
+        """
+        if timestamp is None:
+            timestamp = time.time_ns()
+
+        if len(words) > self.words:
+            raise ValueError(f"Cannot store {len(words)} words of {eui64} in records of {self.words} words")
+
+        if self.segment is None or self.segment.tell() >= self.segment_size:
+            self._open_segment(timestamp)
+            self.enforce_retention(timestamp)
+
+        padded = list(words) + [0] * (self.words - len(words))
+        self.segment.write(self.record.pack(timestamp, self._index(eui64), TABLES[table][0], register, len(words),
+                                            *padded))
+
+    def append_responses(self, resp, devices, timestamp=None):
+        """
+        Method to append the responses of the devices read in the last cycle.
+        :param resp - dict of responses as returned by modbus.read_registers:
+        :param devices - EUI64 of the devices read in the last cycle:
+        :param timestamp - moment of the read in epoch nanoseconds, the current time if not specified:
+        """
+        if timestamp is None:
+            timestamp = time.time_ns()
+
+        for r in resp.values():
+            # Registers widened by a configuration reload do not fit in the records of the store
+            if r["device"] in devices and len(r["response"]) <= self.words:
+                self.append(r["device"], r.get("table", "INPUT_REGISTERS"), r["register"], r["response"], timestamp)
+
+        self.flush()
+
+    def flush(self):
+        """
+        Method to flush the records written to the current segment.
+        """
+        if self.segment is not None:
+            self.segment.flush()
+
+    def close(self):
+        """
+        Method to close the current segment.
+        """
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def enforce_retention(self, now=None):
+        """
+        Method to remove the segments which only hold records older than the retention period. A segment ends
+        where the next one starts, so the current segment is never removed.
+        :param now - current time in epoch nanoseconds:
+        """
+        if now is None:
+            now = time.time_ns()
+
+        limit = now - self.retention * 10**9
+        segments = self.segments()
+
+        for segment, following in zip(segments, segments[1:]):
+            if int(os.path.basename(following)[4:-4]) <= limit:
+                os.remove(segment)
+
+    def query(self, eui64, start=0, end=None):
+        """
+        Method to get the records of a device in a time range, reading only the segments overlapping the range
+        through a memory map.
+        :param eui64 - device:
+        :param start - first moment in epoch nanoseconds:
+        :param end - last moment in epoch nanoseconds, no limit if not specified:
+        :return - generator of (timestamp, table, register, words) tuples:
+        """
+        device = self.device_index.get(eui64)
+        if device is None:
+            return
+
+        for timestamp, _, table, register, words in self._records(device, start, end):
+            yield timestamp, table, register, words
+
+    def records(self, start=0, end=None):
+        """
+        Method to get the records of all the devices in a time range, in the order they were appended.
+        :param start - first moment in epoch nanoseconds:
+        :param end - last moment in epoch nanoseconds, no limit if not specified:
+        :return - generator of (timestamp, eui64, table, register, words) tuples:
+        """
+        for timestamp, index, table, register, words in self._records(None, start, end):
+            yield timestamp, self.devices[index], table, register, words
+
+    def _records(self, device, start, end):
+        self.flush()
+        segments = self.segments()
+
+        for position, segment in enumerate(segments):
+            first = int(os.path.basename(segment)[4:-4])
+            following = int(os.path.basename(segments[position + 1])[4:-4]) if position + 1 < len(segments) else None
+
+            # Skip segments outside the range
+            if (end is not None and first > end) or (following is not None and following < start):
+                continue
+
+            yield from self._scan(segment, device, start, end)
+
+    def _scan(self, segment, device, start, end):
+        with open(segment, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= HEADER.size:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                _, version, words = HEADER.unpack_from(mm)
+                if version == VERSION and words == self.words:
+                    record = self.record
+                else:
+                    record = struct.Struct(RECORD_FORMATS[version].format(words))
+                count = (len(mm) - HEADER.size) // record.size
+
+                # Records are appended in time order, find the first one in the range with a binary search
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if TIMESTAMP.unpack_from(mm, HEADER.size + middle * record.size)[0] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+
+                for position in range(low, count):
+                    fields = record.unpack_from(mm, HEADER.size + position * record.size)
+                    if version == 1:
+                        fields = fields[:2] + (TABLES['INPUT_REGISTERS'][0],) + fields[2:]
+                    timestamp, index, code, register, word_cnt, *values = fields
+
+                    if end is not None and timestamp > end:
+                        break
+
+                    # All the devices when none is specified
+                    if device is None or index == device:
+                        yield timestamp, index, TABLE_NAMES[code], register, values[:word_cnt]
+
+
+def create_store(registers, path=None):
+    """
+    Function to open the store configured in the context, with records large enough for every register.
+    :param registers - list of RegisterRecord objects which will be stored:
+    :param path - directory of the store, the configured store_dir if not specified:
+    :return - Store object, None if the store is disabled:
+    """
+    if settings.store != 'true':
+        return None
+
+    words = max([reg.word_cnt for reg in registers] + [1])
+
+    return Store(path or settings.store_dir, words, int(settings.segment_size), int(settings.retention))
+
+
+def check_store(history, registers):
+    """
+    Function to warn about the registers of reloaded models which are too wide to be stored, the records of a store
+    keep the width they were created with.
+    :param history - Store object, None if the store is disabled:
+    :param registers - list of RegisterRecord objects of the reloaded models:
+    """
+    if history is None:
+        return
+
+    wide = sorted(set(reg.EUI64 for reg in registers if reg.word_cnt > history.words))
+    if wide:
+        print(f"Reads of {', '.join(wide)} are not stored, their registers are wider than the {history.words} "
+              f"words of the store records")
+
+
+def open_stores(path):
+    """
+    Function to open for querying a store and the stores of the polling workers in its shard directories.
+    :param path - directory of the store:
+    :return - list of Store objects, none if nothing was stored yet:
+    """
+    if not os.path.isdir(path):
+        return []
+
+    stores = [Store(path, create=False)]
+
+    for name in sorted(os.listdir(path)):
+        if name.startswith("shard-") and os.path.isdir(os.path.join(path, name)):
+            stores.append(Store(os.path.join(path, name), create=False))
+
+    return stores
@@ -0,0 +1,88 @@
+import re
+
+# 'KEY = value' or 'KEY: value', split at the first delimiter like configparser does
+ENTRY = re.compile(r"(?P<key>.*?)\s*[=:]\s*(?P<value>.*)$")
+COMMENTS = ('#', ';')
+
+
+class ConfigError(ValueError):
+    """
+    Class for an error in a configuration file, reported with the file and line it was found at.
+    """
+    def __init__(self, filename, lineno, message):
+        super().__init__(f"{filename}:{lineno}: {message}")
+        self.filename = filename
+        self.lineno = lineno
+        self.message = message
+
+
+def read_entries(filename):
+    """
+    Function to read a .conf/.ini file one line at a time, so only the current line is held in memory. Keys are
+    upper case, comments and empty lines are skipped.
+    :param filename - configuration file:
+    :return - generator of (line number, section, key, value) tuples, key and value being None for the line
+    opening a section:
+    """
+    section = None
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+
+            if not line or line.startswith(COMMENTS):
+                continue
+
+            if line.startswith('['):
+                if not line.endswith(']') or len(line) < 3:
+                    raise ConfigError(filename, lineno, f"Invalid section header {line!r}")
+
+                section = line[1:-1].strip()
+                yield lineno, section, None, None
+                continue
+
+            match = ENTRY.match(line)
+            if match is None or not match.group('key'):
+                raise ConfigError(filename, lineno, f"Expected 'KEY = value', found {line!r}")
+
+            if section is None:
+                raise ConfigError(filename, lineno, "Entry found before the first [section]")
+
+            yield lineno, section, match.group('key').upper(), match.group('value')
+
+
+def read_sections(filename):
+    """
+    Function to read a configuration file one section at a time, so at most one section is held in memory.
+    :param filename - configuration file:
+    :return - generator of (line number, section, entries) tuples with the list of (line number, key, value)
+    entries of the section:
+    """
+    current = None
+
+    for lineno, section, key, value in read_entries(filename):
+        if key is None:
+            if current is not None:
+                yield current
+
+            current = (lineno, section, [])
+        else:
+            current[2].append((lineno, key, value))
+
+    if current is not None:
+        yield current
+
+
+def section_names(filename):
+    """
+    Function to get the sections of a configuration file without keeping its entries.
+    :param filename - configuration file:
+    :return - list of section names, in the order they first appear:
+    """
+    names = {}
+
+    for _, section, key, _ in read_entries(filename):
+        if key is None:
+            names.setdefault(section, None)
+
+    return list(names)
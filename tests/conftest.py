@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# The modules import each other by name and read context.ini and the configuration files relative to src
+sys.path.insert(0, SRC)
+
+
+@pytest.fixture(autouse=True)
+def in_src(monkeypatch):
+    monkeypatch.chdir(SRC)
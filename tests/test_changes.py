@@ -0,0 +1,59 @@
+from changes import ChangeDetector, migrate, get_detector
+from identity import JoinIndex, get_index
+from model import load_gateway, load_hosts
+from classes import settings
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def index():
+    # 1020000000000061 has a deadband of 0.5, 0022FF0000021F11 one of 2 %
+    return get_index(load_gateway(settings.in_gw).registers, load_hosts(settings.in_hosts))
+
+
+def test_values_are_reported_past_their_deadband():
+    clock = FakeClock()
+    detector = ChangeDetector(index(), integrity_period=60, clock=clock)
+
+    assert detector.detect({0: (0, [20.0]), 1: (1, [50.0])}) == {(0, 0): 20.0, (1, 0): 50.0}
+    assert detector.integrity
+
+    clock.now = 1
+    assert detector.detect({0: (0, [20.5]), 1: (1, [51.0])}) == {}
+    assert not detector.integrity
+
+    clock.now = 2
+    assert detector.detect({0: (0, [20.6]), 1: (1, [51.1])}) == {(0, 0): 20.6, (1, 0): 51.1}
+
+    # Small moves do not add up, the reference is the last reported value
+    clock.now = 3
+    assert detector.detect({0: (0, [20.2]), 1: (1, [50.2])}) == {}
+
+
+def test_everything_is_reported_at_the_integrity_snapshots():
+    clock = FakeClock()
+    detector = ChangeDetector(index(), integrity_period=60, clock=clock)
+    detector.detect({0: (0, [20.0])})
+
+    clock.now = 60
+    assert detector.detect({0: (0, [20.0])}) == {(0, 0): 20.0}
+    assert detector.integrity
+
+
+def test_migrate_keeps_the_reported_values():
+    old_index = index()
+    old = get_detector(old_index)
+    old.detect({0: (0, [20.0]), 1: (1, [50.0])})
+
+    new_index = JoinIndex(old_index.registers[::-1], load_hosts(settings.in_hosts))
+    detector = ChangeDetector(new_index)
+    migrate(old_index, new_index, detector, [[0, 1, 1], [1, 0, 1]])
+
+    assert get_detector(new_index) is detector
+    assert list(detector.previous) == [50.0, 20.0]
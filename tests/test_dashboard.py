@@ -0,0 +1,35 @@
+import io
+import os
+import pty
+import sys
+import time
+import termios
+
+from dashboard import Dashboard
+
+
+def test_stop_restores_the_terminal(monkeypatch):
+    master, slave = pty.openpty()
+    terminal = os.fdopen(slave, "r")
+    monkeypatch.setattr(sys, "stdin", terminal)
+
+    before = termios.tcgetattr(slave)
+    dashboard = Dashboard(["Device", "Value"], [18, 12], refresh_rate=20, out=io.StringIO())
+    dashboard.update({("0", 0): ["1020000000000061", 1.0]})
+    dashboard.start()
+
+    assert not termios.tcgetattr(slave)[3] & termios.ECHO
+
+    os.write(master, b"/1020\r")
+    deadline = time.monotonic() + 2
+    while dashboard.filter != "1020" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert dashboard.filter == "1020"
+
+    dashboard.stop()
+
+    assert not dashboard.keys.is_alive()
+    assert termios.tcgetattr(slave) == before
+
+    terminal.close()
+    os.close(master)
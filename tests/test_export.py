@@ -0,0 +1,134 @@
+import os
+import csv
+
+import pytest
+
+from export import CSV, PARQUET, ColumnarExporter
+
+DAY = 86400 * 10**9
+START = 20000 * DAY
+
+
+def devices(count):
+    return [f"{device:016X}" for device in range(count)]
+
+
+def part_files(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, _, names in os.walk(path) for name in names)
+
+
+def test_csv_partitions(tmp_path):
+    exporter = ColumnarExporter(str(tmp_path), CSV, ("day", "device"), row_group=4)
+    for day in range(2):
+        for device in devices(2):
+            exporter.add(device, 1, START + day * DAY, 1.5, "Fresh")
+    exporter.close()
+
+    files = part_files(str(tmp_path))
+    assert files == [os.path.join(f"day=2024-10-{day}", f"device={device}", "part-0.csv")
+                     for day in ("04", "05") for device in devices(2)]
+
+    with open(os.path.join(str(tmp_path), files[0]), newline="") as f:
+        assert list(csv.reader(f)) == [["device", "channel", "timestamp", "value", "status"],
+                                       ["0000000000000000", "1", "2024-10-04 00:00:00", "1.5", "Fresh"]]
+    assert exporter.exported == 4
+
+
+class RecordedPart():
+    def __init__(self, key, written):
+        self.key = key
+        self.written = written
+
+    def write(self, batch):
+        self.written.append((self.key, len(batch)))
+
+
+def test_memory_pressure_writes_the_large_buffers_in_one_pass(tmp_path):
+    exporter = ColumnarExporter(str(tmp_path), CSV, ("device",), row_group=1000, max_rows=100, min_rows=10)
+    written = []
+    exporter._part = lambda key: RecordedPart(key, written)
+
+    # One large partition and many small ones
+    for row in range(60):
+        exporter.add("00000000000000FF", 1, START + row, 1.0, "Fresh")
+    for device in devices(39):
+        exporter.add(device, 1, START, 1.0, "Fresh")
+    assert written == []
+
+    exporter.add("00000000000000FF", 1, START + 60, 1.0, "Fresh")
+
+    assert written == [("device=00000000000000FF", 61)]
+    assert exporter.buffered == 39
+
+
+def test_memory_pressure_writes_small_buffers_when_needed(tmp_path):
+    exporter = ColumnarExporter(str(tmp_path), CSV, ("device",), row_group=1000, max_rows=10, min_rows=5)
+    for device in devices(10):
+        exporter.add(device, 1, START, 1.0, "Fresh")
+
+    assert exporter.buffered == 5
+    assert exporter.exported == 5
+
+
+def test_parquet_partition_written_twice_stays_in_one_file(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    exporter = ColumnarExporter(str(tmp_path), PARQUET, ("device",), row_group=2)
+    for row in range(4):
+        for device in devices(3):
+            exporter.add(device, 1, START + row * 10**9, float(row), "Fresh")
+    exporter.close()
+
+    files = part_files(str(tmp_path))
+    assert len(files) == 3
+
+    table = pq.read_table(os.path.join(str(tmp_path), files[0]))
+    assert pq.ParquetFile(os.path.join(str(tmp_path), files[0])).num_row_groups == 2
+    assert table.column("value").to_pylist() == [0.0, 1.0, 2.0, 3.0]
+    assert "device" not in table.column_names
+
+
+def test_memory_pressure_writes_every_buffer_of_min_rows(tmp_path):
+    exporter = ColumnarExporter(str(tmp_path), CSV, ("device",), row_group=1000, max_rows=100, min_rows=10)
+    for device in devices(4):
+        for row in range(25):
+            exporter.add(device, 1, START + row, 1.0, "Fresh")
+
+    assert exporter.exported == 100
+    assert exporter.buffered == 0
+
+
+def test_history_keeps_the_table_of_the_reads(tmp_path):
+    from export import export_history
+    from model import load_gateway, load_hosts
+    from store import Store
+
+    # An input register and coils of the same device at the same address
+    path_gw, path_hosts = tmp_path / "gateway.ini", tmp_path / "hosts.conf"
+    path_gw.write_text("[INPUT_REGISTERS]\nREGISTER = 10,2,1020000000000061,2,129,5,0,0,0,2\n"
+                       "[COILS]\nREGISTER = 10,16,1020000000000061,2,129,5,0,0,0,2\n")
+    path_hosts.write_text("[1020:0000:0000:0061]\nCONCENTRATOR = 2, 4, 15, 0, 5, 16, 2\n"
+                          "CHANNEL = 2, 129, 5, 0, 0, 'int16', 'A', 'ampere', 0\n"
+                          "CHANNEL = 2, 129, 5, 0, 1, 'int16', 'B', 'ampere', 0\n")
+
+    store = Store(str(tmp_path / "store"), 2)
+    store.append("1020000000000061", "INPUT_REGISTERS", 10, [300, 7], START)
+    store.append("1020000000000061", "COILS", 10, [5], START)
+    assert [read[2:] for read in store.records()] == [("INPUT_REGISTERS", 10, [300, 7]), ("COILS", 10, [5])]
+
+    exporter = ColumnarExporter(str(tmp_path / "export"), CSV, ())
+    assert export_history([store], load_hosts(str(path_hosts)), load_gateway(str(path_gw)).registers, exporter) == 3
+    exporter.close()
+
+    with open(os.path.join(str(tmp_path / "export"), "part-0.csv"), newline="") as f:
+        assert [row[1:4:2] for row in csv.reader(f)][1:] == [["1", "300.0"], ["2", "7.0"], ["1", "5.0"]]
+
+
+def test_querying_a_missing_store_creates_nothing(tmp_path):
+    from store import Store, open_stores
+
+    path = str(tmp_path / "store")
+    assert open_stores(path) == []
+    assert list(Store(path, create=False).records()) == []
+    assert not os.path.exists(path)
@@ -0,0 +1,127 @@
+import json
+import math
+import struct
+import asyncio
+import threading
+
+import pytest
+
+from async_poller import parse_response
+from decode import FORMATS, Decoder
+from broker import StandInBroker
+from model import load_gateway, load_hosts
+from publisher import MqttClient, _packet
+from identity import JoinIndex
+from simulator import Simulator, synthesize
+
+
+@pytest.mark.parametrize("length, encoded", [(0, b"\x00"), (127, b"\x7f"), (128, b"\x80\x01"),
+                                             (16383, b"\xff\x7f"), (16384, b"\x80\x80\x01")])
+def test_mqtt_remaining_length(length, encoded):
+    packet = _packet(0x30, bytes(length))
+
+    assert packet[0] == 0x30
+    assert packet[1:1 + len(encoded)] == encoded
+    assert len(packet) == 1 + len(encoded) + length
+
+
+@pytest.fixture
+def broker():
+    loop = asyncio.new_event_loop()
+    broker = StandInBroker()
+    server = loop.run_until_complete(broker.serve("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield broker, server.sockets[0].getsockname()[1]
+
+    asyncio.run_coroutine_threadsafe(broker.close(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+def test_mqtt_client_publishes_to_the_broker(broker):
+    broker, port = broker
+    client = MqttClient("127.0.0.1", port, timeout=5)
+    client.connect()
+
+    client.publish([("modbus", json.dumps([1, 2]).encode()), ("modbus", json.dumps([3]).encode())])
+    client.ping()
+    client.close()
+
+    assert broker.messages == 2
+    assert broker.readings == 3
+
+
+def simulator():
+    from classes import settings
+
+    return Simulator(load_gateway(settings.in_gw).registers, load_hosts(settings.in_hosts))
+
+
+def test_register_responses_round_trip():
+    server = simulator()
+    server.tables[4][10:13] = server.tables[4][10:13].__class__('H', [1, 2, 65535])
+
+    body = server.execute(struct.pack(">BHH", 4, 10, 3))
+    assert body[:2] == bytes([4, 6])
+    assert parse_response(4, 3, body) == [1, 2, 65535]
+
+
+def test_bit_responses_round_trip():
+    server = simulator()
+    bits = [1, 0, 1, 1, 0, 0, 0, 0, 1, 1]
+    server.tables[2][100:110] = bytes(bits)
+
+    body = server.execute(struct.pack(">BHH", 2, 100, 10))
+    assert body[:2] == bytes([2, 2])
+    assert parse_response(2, 10, body) == bits
+
+
+def test_exception_responses():
+    server = simulator()
+
+    assert server.execute(struct.pack(">BHH", 4, 0, 126)) == bytes([0x84, 0x02])
+    assert server.execute(struct.pack(">BHH", 0x10, 0, 1)) == bytes([0x90, 0x01])
+    with pytest.raises(ValueError):
+        parse_response(4, 126, bytes([0x84, 0x02]))
+
+
+@pytest.mark.parametrize("function, count, body", [
+    (3, 2, bytes([4, 4, 0, 1, 0, 2])),
+    (4, 2, bytes([4, 2, 0, 1])),
+    (4, 2, bytes([4, 4, 0, 1, 0])),
+    (4, 2, bytes([4, 4, 0, 1, 0, 2, 0, 3])),
+    (1, 10, bytes([1, 1, 0xFF])),
+    (4, 2, bytes([4])),
+])
+def test_responses_which_do_not_answer_the_request(function, count, body):
+    with pytest.raises(ValueError):
+        parse_response(function, count, body)
+
+
+@pytest.mark.parametrize("fmt", sorted(FORMATS))
+def test_simulated_values_decode_in_every_format(tmp_path, fmt):
+    size = FORMATS[fmt][0]
+    gateway, hosts = synthesize(str(tmp_path), 2, channels=3, words_per_channel=size, fmt=fmt)
+    registers, devices = load_gateway(gateway).registers, load_hosts(hosts)
+
+    server = Simulator(registers, devices)
+    server.update(now=0.0)
+
+    resp = {}
+    for position, reg in enumerate(registers):
+        body = server.execute(struct.pack(">BHH", 4, reg.start_addr, reg.word_cnt))
+        resp[position] = {"device": reg.EUI64, "register": reg.start_addr,
+                          "response": parse_response(4, reg.word_cnt, body)}
+
+    decoded = Decoder(JoinIndex(registers, devices)).decode(resp)
+
+    for position in range(2):
+        for channel, value in enumerate(decoded[position][1]):
+            expected = 50 + 40 * math.sin(3 * position + channel)
+            if fmt == 'float':
+                assert value == pytest.approx(expected, rel=1e-6)
+            else:
+                assert value == int(expected)
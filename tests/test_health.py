@@ -0,0 +1,62 @@
+from health import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, GatewayHealth, RttEstimator
+
+
+def test_timeout_follows_the_round_trip_times():
+    rtt = RttEstimator(min_timeout=0.05, max_timeout=3.0)
+    assert rtt.timeout() == 3.0
+
+    rtt.observe(0.1)
+    assert rtt.timeout() == 0.1 + 4 * 0.05
+
+    for _ in range(100):
+        rtt.observe(0.01)
+    assert rtt.timeout() == 0.05
+
+
+def test_timeout_is_doubled_after_a_timeout():
+    rtt = RttEstimator(min_timeout=0.0, max_timeout=3.0)
+    rtt.observe(0.2)
+    rtt.backoff()
+
+    assert rtt.srtt == 0.4
+    assert rtt.timeout() == 0.4 + 4 * 0.1
+
+
+def test_breaker_opens_after_the_threshold_and_probes():
+    breaker = CircuitBreaker(threshold=3, probe_interval=30, max_probe_interval=100)
+
+    assert not breaker.failure(0)
+    assert not breaker.failure(0)
+    assert breaker.failure(0)
+    assert breaker.state == OPEN
+    assert not breaker.allow(29)
+
+    assert breaker.allow(30)
+    assert breaker.state == HALF_OPEN
+
+    # A failed probe doubles the interval up to its maximum
+    assert not breaker.failure(30)
+    assert breaker.probe_at == 90
+    breaker.allow(90)
+    breaker.failure(90)
+    assert breaker.probe_at == 190
+
+    breaker.allow(190)
+    breaker.success()
+    assert breaker.state == CLOSED
+    assert breaker.interval == 30
+
+
+def test_gateway_skips_the_devices_of_open_breakers():
+    now = [0.0]
+    health = GatewayHealth("test", threshold=2, probe_interval=10, clock=lambda: now[0])
+
+    health.failure({"A", "B"})
+    health.success({"B"}, 0.01)
+    health.failure({"A", "B"}, timed_out=True)
+
+    assert health.open() == ["A"]
+    assert health.allowed({"A", "B"}) == {"B"}
+
+    now[0] = 10
+    assert health.allowed({"A", "B"}) == {"A", "B"}
@@ -0,0 +1,94 @@
+from model import RegisterRecord
+from modbus import isolate, pack_bits, plan_reads, split_block
+
+
+def record(line, table="INPUT_REGISTERS"):
+    return RegisterRecord(line, table)
+
+
+def spans(blocks):
+    return [(block["table"], block["start_addr"], block["word_cnt"], [index for index, _ in block["registers"]])
+            for block in blocks]
+
+
+def test_adjacent_registers_are_read_in_one_block():
+    registers = [record("13,3,0022FF0000021F11,2,7,1,0,0,0,2"), record("10,3,1020000000000061,2,129,5,0,0,0,2")]
+
+    assert spans(plan_reads(registers)) == [("INPUT_REGISTERS", 10, 6, [1, 0])]
+
+
+def test_gaps_are_merged_up_to_max_gap():
+    registers = [record("10,2,A,2,129,5,0,0,0,2"), record("16,2,B,2,129,5,0,0,0,2")]
+
+    assert spans(plan_reads(registers, max_gap=3)) == [("INPUT_REGISTERS", 10, 2, [0]),
+                                                       ("INPUT_REGISTERS", 16, 2, [1])]
+    assert spans(plan_reads(registers, max_gap=4)) == [("INPUT_REGISTERS", 10, 8, [0, 1])]
+
+
+def test_blocks_fit_in_a_request():
+    registers = [record(f"{start},50,A,2,129,5,0,0,0,2") for start in (0, 50, 100)]
+
+    assert spans(plan_reads(registers)) == [("INPUT_REGISTERS", 0, 100, [0, 1]), ("INPUT_REGISTERS", 100, 50, [2])]
+
+
+def test_tables_are_planned_apart():
+    registers = [record("0,16,A,2,129,5,0,0,0,2", "COILS"), record("0,2,A,2,129,5,0,0,0,2", "HOLDING_REGISTERS"),
+                 record("16,8,B,2,129,5,0,0,0,2", "COILS"), record("2,2,B,2,129,5,0,0,0,2")]
+
+    assert spans(plan_reads(registers)) == [("INPUT_REGISTERS", 2, 2, [3]), ("HOLDING_REGISTERS", 0, 2, [1]),
+                                            ("COILS", 0, 24, [0, 2])]
+
+
+def test_devices_filter_the_plan():
+    registers = [record("10,3,A,2,129,5,0,0,0,2"), record("13,3,B,2,7,1,0,0,0,2")]
+
+    assert spans(plan_reads(registers, devices={"B"})) == [("INPUT_REGISTERS", 13, 3, [1])]
+
+
+def test_isolate_splits_a_block_by_device():
+    registers = [record("10,2,B,2,129,5,0,0,0,2"), record("12,2,A,2,129,5,0,0,0,2"),
+                 record("14,2,B,2,129,5,0,0,0,2")]
+    block, = plan_reads(registers, max_gap=4)
+
+    assert spans(isolate(block, max_gap=0)) == [("INPUT_REGISTERS", 12, 2, [1]), ("INPUT_REGISTERS", 10, 2, [0]),
+                                                ("INPUT_REGISTERS", 14, 2, [2])]
+
+
+def test_split_block_gives_every_register_its_values():
+    registers = [record("10,2,A,2,129,5,0,0,0,2"), record("13,1,B,2,129,5,0,0,0,2"),
+                 record("0,18,A,2,129,5,0,0,0,2", "DISCRETE_INPUTS")]
+    words, bits = plan_reads(registers, max_gap=1)
+
+    assert [(index, values) for index, _, values in split_block(words, [1, 2, 3, 4])] == [(0, [1, 2]), (1, [4])]
+    assert [(index, values) for index, _, values in split_block(bits, [1] + [0] * 16 + [1])] == [(2, [1, 2])]
+
+
+def test_pack_bits():
+    assert pack_bits([1, 0, 1]) == [5]
+    assert pack_bits([0] * 16 + [1]) == [0, 1]
+
+
+def test_pooled_connection_closed_by_the_gateway_is_not_healthy():
+    import socket
+    from pool import PooledConnection
+
+    class Client():
+        def __init__(self, sock):
+            self.socket = sock
+
+        def is_socket_open(self):
+            return self.socket is not None
+
+    ours, gateway = socket.socketpair()
+    conn = PooledConnection("127.0.0.1", 502, 0)
+    conn.client = Client(ours)
+    assert conn.is_healthy()
+
+    # Bytes of a late response are not read as the next response
+    gateway.send(b"\x00")
+    assert not conn.is_healthy()
+    ours.recv(1)
+
+    gateway.close()
+    assert not conn.is_healthy()
+    ours.close()
@@ -0,0 +1,158 @@
+import asyncio
+
+import modbus
+from async_poller import Gateway, poll_all, run
+from model import load_gateway, load_hosts
+from scheduler import Scheduler
+from simulator import create_simulator, synthesize
+from staleness import StalenessTracker
+
+
+def serve(simulator, check):
+    # Run a check against the simulator served on a free local port
+    async def main():
+        server = await simulator.serve("127.0.0.1", 0)
+        try:
+            return await check(server.sockets[0].getsockname()[1])
+        finally:
+            await simulator.close()
+
+    return asyncio.run(main())
+
+
+def expected(simulator, registers):
+    return {position: list(simulator.tables[4][reg.start_addr:reg.start_addr + reg.word_cnt])
+            for position, reg in enumerate(registers)}
+
+
+def test_poll_reads_the_simulated_registers(tmp_path):
+    path_gw, path_hosts = synthesize(str(tmp_path), 20)
+    simulator = create_simulator(path_gw, path_hosts)
+
+    async def check(port):
+        gateway = Gateway("sim", "127.0.0.1", port, path_gw, timeout=2)
+        try:
+            return await gateway.poll(), gateway.updated
+        finally:
+            await gateway.conn.close()
+
+    responses, updated = serve(simulator, check)
+    registers = load_gateway(path_gw).registers
+
+    assert {position: r["response"] for position, r in responses.items()} == expected(simulator, registers)
+    assert updated == set(reg.EUI64 for reg in registers)
+    assert all(r["gateway"] == "sim" for r in responses.values())
+
+
+def test_pipelined_replies_out_of_order(tmp_path):
+    path_gw, path_hosts = synthesize(str(tmp_path), 200)
+    simulator = create_simulator(path_gw, path_hosts, jitter=0.01, seed=1)
+
+    async def check(port):
+        gateway = Gateway("sim", "127.0.0.1", port, path_gw, timeout=2, max_concurrency=8)
+        try:
+            # Blocks of a few devices each, so replies can overtake each other
+            gateway.plan = lambda devices=None: [block for sub in Gateway.plan(gateway, devices)
+                                                 for block in modbus.isolate(sub)]
+            return await gateway.poll()
+        finally:
+            await gateway.conn.close()
+
+    responses = serve(simulator, check)
+
+    assert {position: r["response"] for position, r in responses.items()} == \
+        expected(simulator, load_gateway(path_gw).registers)
+
+
+def test_gateways_are_merged_by_position(tmp_path):
+    path_gw, path_hosts = synthesize(str(tmp_path), 3)
+    simulator = create_simulator(path_gw, path_hosts)
+
+    async def check(port):
+        gateways = [Gateway(name, "127.0.0.1", port, path_gw, timeout=2) for name in ("first", "second")]
+        try:
+            return await poll_all(gateways)
+        finally:
+            for gateway in gateways:
+                await gateway.conn.close()
+
+    responses = serve(simulator, check)
+
+    assert [r["gateway"] for r in responses.values()] == ["first"] * 3 + ["second"] * 3
+
+
+def test_dead_devices_trip_their_breaker(tmp_path):
+    path_gw, path_hosts = synthesize(str(tmp_path), 2)
+    simulator = create_simulator(path_gw, path_hosts, loss=1.0)
+
+    async def check(port):
+        gateway = Gateway("sim", "127.0.0.1", port, path_gw, timeout=0.05)
+        gateway.health.retries = 0
+        try:
+            for _ in range(int(gateway.health.threshold)):
+                assert await gateway.poll() == {}
+            return gateway.health.open()
+        finally:
+            await gateway.conn.close()
+
+    assert serve(simulator, check) == sorted(reg.EUI64 for reg in load_gateway(path_gw).registers)
+
+
+def test_timeouts_are_counted_without_printing(tmp_path, capsys):
+    from metrics import READ_TIMEOUTS
+
+    path_gw, path_hosts = synthesize(str(tmp_path), 1)
+    simulator = create_simulator(path_gw, path_hosts, loss=1.0)
+
+    # Created outside of the event loop, as by the synchronization command
+    gateway = Gateway("silent", "127.0.0.1", 0, path_gw, timeout=0.05)
+    gateway.health.retries = 0
+    timeouts = READ_TIMEOUTS.labels(gateway="silent").value
+
+    async def check(port):
+        gateway.conn.port = port
+        try:
+            return await gateway.poll()
+        finally:
+            await gateway.conn.close()
+
+    assert serve(simulator, check) == {}
+    assert READ_TIMEOUTS.labels(gateway="silent").value == timeouts + 1
+    assert capsys.readouterr().out == ""
+
+
+def test_default_gateway_uses_the_working_context(tmp_path, monkeypatch):
+    from classes import Context
+
+    # The gateway sections of the configuration are removed
+    with open("context.ini") as f:
+        text = f.read().split("\n[gateway:")[0]
+    text = text.replace("unit = 0", "unit = 7").replace("max_timeout = 3", "max_timeout = 1.5")
+    (tmp_path / "context.ini").write_text(text)
+    monkeypatch.chdir(tmp_path)
+
+    context = Context()
+    assert context.gateways == [{'name': context.address, 'address': context.address, 'port': context.port,
+                                 'in_gw': context.in_gw, 'unit': '7', 'timeout': '1.5', 'max_concurrency': '1'}]
+
+
+def test_run_polls_the_due_devices(tmp_path):
+    path_gw, path_hosts = synthesize(str(tmp_path), 4)
+    simulator = create_simulator(path_gw, path_hosts)
+    cycles = []
+
+    async def check(port):
+        gateway = Gateway("sim", "127.0.0.1", port, path_gw, timeout=2)
+        scheduler = Scheduler()
+        for eui64 in sorted(gateway.devices):
+            scheduler.add(eui64, 0.05)
+        tracker = StalenessTracker(load_hosts(path_hosts), 1)
+
+        await run([gateway], scheduler, tracker, cycles=3, callback=cycles.append)
+        return tracker
+
+    tracker = serve(simulator, check)
+
+    assert len(cycles) == 3
+    assert len(cycles[-1]) == 4
+    assert set(tracker.status(reg.EUI64) for reg in load_gateway(path_gw).registers) == {"Fresh"}
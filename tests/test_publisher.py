@@ -0,0 +1,72 @@
+import os
+import json
+import threading
+
+from publisher import BLOCK, Publisher
+
+
+class FakeClient():
+    address = "127.0.0.1"
+    port = 1883
+    keepalive = 60
+
+    def __init__(self):
+        self.connected = True
+        self.published = []
+
+    def connect(self):
+        self.connected = True
+
+    def publish(self, messages):
+        self.published.extend(json.loads(payload) for _, payload in messages)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.connected = False
+
+
+def test_spill_is_trimmed_to_the_limit(tmp_path):
+    publisher = Publisher(FakeClient(), spill_dir=str(tmp_path), spill_limit=6)
+    for batch in range(5):
+        publisher._spill([[batch]])
+
+    assert [json.load(open(path)) for path in publisher._spilled()] == [[3], [4]]
+
+
+def test_trim_ignores_files_replayed_meanwhile(tmp_path, monkeypatch):
+    publisher = Publisher(FakeClient(), spill_dir=str(tmp_path), spill_limit=0)
+    listed = publisher._spilled
+    monkeypatch.setattr(publisher, "_spilled", lambda: [str(tmp_path / "spill-0.json")] + listed())
+
+    publisher._spill([[1]])
+
+    assert listed() == []
+
+
+def test_spills_while_the_sender_replays(tmp_path):
+    client = FakeClient()
+    publisher = Publisher(client, queue_size=1, policy=BLOCK, queue_timeout=0, spill_dir=str(tmp_path),
+                          spill_limit=200)
+    errors = []
+
+    def spill():
+        try:
+            for batch in range(300):
+                publisher._spill([[batch]])
+        except Exception as e:
+            errors.append(e)
+
+    spillers = [threading.Thread(target=spill) for _ in range(2)]
+    for thread in spillers:
+        thread.start()
+    for batch in range(300):
+        publisher.submit([batch])
+    for thread in spillers:
+        thread.join()
+    publisher.close()
+
+    assert errors == []
+    assert publisher.thread is not None and not publisher.thread.is_alive()
+    assert all(os.path.basename(path).startswith("spill-") for path in publisher._spilled())
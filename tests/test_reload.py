@@ -0,0 +1,98 @@
+from model import load_gateway, load_hosts
+from identity import JoinIndex
+from reload import carry_runs, combine_positions, diff_models, position_changes, remap
+
+GATEWAY = """[INPUT_REGISTERS]
+REGISTER = 10,2,1020000000000061,2,129,5,0,0,0,2
+REGISTER = 12,2,0022FF0000021F11,2,5,1,0,0,0,2
+REGISTER = 14,2,1060000000000061,2,129,5,0,0,0,2
+"""
+
+HOSTS = """[{section}]
+CONCENTRATOR = 2, 4, {period}, 0, 5, 16, 2
+CHANNEL = {channel}, 'float', 'C', 'degree Celsius', 0
+"""
+
+
+def write_hosts(path, period=15):
+    with open(path, "w") as f:
+        f.write(HOSTS.format(section="1020:0000:0000:0061", period=period, channel="2, 129, 5, 0, 0"))
+        f.write(HOSTS.format(section="0022:FF00:0002:1F11", period=10, channel="2, 5, 1, 0, 0"))
+        f.write(HOSTS.format(section="1060:0000:0000:0061", period=60, channel="2, 129, 5, 0, 0"))
+
+
+def models(tmp_path, gateway=GATEWAY, period=15):
+    path_gw, path_hosts = tmp_path / "gateway.ini", tmp_path / "hosts.conf"
+    path_gw.write_text(gateway)
+    write_hosts(path_hosts, period)
+
+    return load_gateway(str(path_gw)), load_hosts(str(path_hosts))
+
+
+def test_unchanged_files_keep_their_records(tmp_path):
+    tables, hosts = models(tmp_path)
+    same_tables, same_hosts = models(tmp_path)
+
+    assert not diff_models(tables.registers, hosts, same_tables.registers, same_hosts)
+    assert position_changes(tables.registers, same_tables.registers) == ({}, set())
+
+
+def test_diff_of_a_changed_gateway_file(tmp_path):
+    tables, hosts = models(tmp_path)
+    old = list(tables.registers)
+
+    # The first register is removed, the second changed and a register is added at the end
+    changed = GATEWAY.replace("REGISTER = 10,2,1020000000000061,2,129,5,0,0,0,2\n", "")
+    changed = changed.replace("12,2,0022FF0000021F11", "12,1,0022FF0000021F11")
+    new_tables, new_hosts = models(tmp_path, changed + "REGISTER = 20,2,1030000000000061,2,129,5,0,0,0,2\n")
+
+    diff = diff_models(old, hosts, new_tables.registers, new_hosts)
+    assert diff.added == {"1030000000000061"}
+    assert diff.removed == {"1020000000000061"}
+    assert diff.changed == {"0022FF0000021F11"}
+    assert diff.hosts == set()
+
+    moved, dropped = position_changes(old, new_tables.registers)
+    assert moved == {2: 1}
+    assert dropped == {0, 1}
+
+    responses = {0: "a", 1: "b", 2: "c"}
+    assert remap(responses, moved, dropped) == {1: "c"}
+
+
+def test_remap_leaves_the_submitted_responses_unchanged():
+    responses = {0: "a", 1: "b", 2: "c"}
+
+    # Only dropped registers, nothing moved
+    remapped = remap(responses, {}, {1})
+    assert remapped == {0: "a", 2: "c"}
+    assert remapped is not responses
+    assert responses == {0: "a", 1: "b", 2: "c"}
+
+
+def test_diff_of_a_changed_hosts_file(tmp_path):
+    tables, hosts = models(tmp_path)
+    new_tables, new_hosts = models(tmp_path, period=30)
+
+    diff = diff_models(tables.registers, hosts, new_tables.registers, new_hosts)
+    assert diff.changed == {"1020000000000061"}
+    assert diff.hosts == {0x1020000000000061}
+
+
+def test_positions_of_several_gateways(tmp_path):
+    tables, _ = models(tmp_path)
+    shorter, _ = models(tmp_path, GATEWAY.replace("REGISTER = 12,2,0022FF0000021F11,2,5,1,0,0,0,2\n", ""))
+
+    # The second gateway reads the same file and lost the same register, the first one is unchanged
+    positions = [({}, set()), position_changes(tables.registers, shorter.registers)]
+    assert combine_positions([tables, tables], [tables, shorter], positions) == ({5: 4}, {4})
+
+
+def test_carry_runs_keep_the_unchanged_channels(tmp_path):
+    tables, hosts = models(tmp_path)
+    old_index = JoinIndex(tables.registers, hosts)
+
+    new_tables, new_hosts = models(tmp_path, period=30)
+    index = JoinIndex(new_tables.registers, new_hosts)
+
+    assert carry_runs(old_index, index, {}, set()) == [[1, 1, 2]]
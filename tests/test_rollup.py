@@ -0,0 +1,90 @@
+from rollup import Rollups, parse_duration
+
+DEVICE = "1020000000000061"
+HOUR = 3600 * 10**9
+MINUTE = 60 * 10**9
+
+
+def add_minutes(rollups, first, count, value=1.0):
+    for minute in range(first, first + count):
+        rollups.add(DEVICE, 1, HOUR + minute * MINUTE, value + minute)
+
+
+def test_parse_duration():
+    assert parse_duration("90") == 90
+    assert parse_duration("15m") == 900
+    assert parse_duration("1h") == 3600
+    assert parse_duration(" 1D ") == 86400
+
+
+def test_query_aggregates_closed_and_open_buckets(tmp_path):
+    rollups = Rollups(str(tmp_path), (60, 3600))
+    add_minutes(rollups, 0, 61)
+
+    rows = rollups.query(DEVICE, 3600)
+    assert [(row["bucket"], row["count"]) for row in rows] == [(HOUR, 60), (2 * HOUR, 1)]
+    assert rows[0]["min"] == 1.0
+    assert rows[0]["max"] == 60.0
+    assert rows[0]["avg"] == sum(range(1, 61)) / 60
+    assert rows[0]["first"] == 1.0 and rows[0]["last"] == 60.0
+    assert rows[0]["rate"] == 1 / 60
+
+    assert len(rollups.query(DEVICE, 300)) == 13
+    assert rollups.last(DEVICE) == {1: (HOUR + 60 * MINUTE, 61.0)}
+
+
+def test_values_are_added_once(tmp_path):
+    rollups = Rollups(str(tmp_path), (60,))
+    rollups.add(DEVICE, 1, HOUR, 1.0)
+    rollups.add(DEVICE, 1, HOUR, 1.0)
+
+    assert rollups.query(DEVICE, 60)[0]["count"] == 1
+
+
+def test_open_buckets_survive_a_restart(tmp_path):
+    rollups = Rollups(str(tmp_path), (60, 3600))
+    add_minutes(rollups, 0, 30)
+    rollups.close()
+
+    restarted = Rollups(str(tmp_path), (60, 3600))
+    add_minutes(restarted, 30, 31)
+    restarted.close()
+
+    rows = Rollups(str(tmp_path), (60, 3600)).query(DEVICE, 3600)
+    assert [(row["bucket"], row["count"]) for row in rows] == [(HOUR, 60), (2 * HOUR, 1)]
+    assert rows[0]["first"] == 1.0 and rows[0]["last"] == 60.0
+
+
+def test_restart_skips_buckets_closed_after_the_snapshot(tmp_path):
+    rollups = Rollups(str(tmp_path), (60,))
+    add_minutes(rollups, 0, 1)
+    rollups.flush()
+
+    # The first bucket is closed but the process stops before the next snapshot, the second one is lost
+    add_minutes(rollups, 1, 1)
+
+    restarted = Rollups(str(tmp_path), (60,))
+    add_minutes(restarted, 2, 1)
+
+    rows = restarted.query(DEVICE, 60)
+    assert [(row["bucket"], row["count"]) for row in rows] == [(HOUR, 1), (HOUR + 2 * MINUTE, 1)]
+
+
+def test_reads_within_the_same_second_are_all_added(tmp_path):
+    from model import load_gateway, load_hosts
+
+    path_gw, path_hosts = tmp_path / "gateway.ini", tmp_path / "hosts.conf"
+    path_gw.write_text(f"[INPUT_REGISTERS]\nREGISTER = 10,1,{DEVICE},2,129,5,0,0,0,2\n")
+    path_hosts.write_text("[1020:0000:0000:0061]\nCONCENTRATOR = 2, 4, 1, 0, 5, 16, 2\n"
+                          "CHANNEL = 2, 129, 5, 0, 0, 'uint16', 'A', 'ampere', 0\n")
+    registers, hosts = load_gateway(str(path_gw)).registers, load_hosts(str(path_hosts))
+
+    rollups = Rollups(str(tmp_path / "rollups"), (60,))
+    for value, timestamp in ((1, HOUR), (2, HOUR + 10**8), (2, HOUR + 10**8)):
+        resp = {0: {"table": "INPUT_REGISTERS", "register": 10, "response": [value], "device": DEVICE,
+                    "last_read": "1970-01-01 01:00:00"}}
+        rollups.submit(resp, hosts, registers, {DEVICE}, timestamp=timestamp)
+
+    # The same cycle submitted twice is still added once
+    row = rollups.query(DEVICE, 60)[0]
+    assert (row["count"], row["avg"]) == (2, 1.5)
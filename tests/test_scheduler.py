@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+from metrics import CYCLE_OVERRUNS
+from reload import ConfigDiff, apply_schedule
+from scheduler import CATCH_UP, SKIP, Scheduler
+
+
+class FakeClock():
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_jobs_run_on_their_grid():
+    clock = FakeClock()
+    scheduler = Scheduler(SKIP, clock)
+    scheduler.add("a", 10, 2)
+
+    clock.now += 1
+    assert scheduler.pop_due() == []
+    clock.now += 1
+    assert scheduler.pop_due() == ["a"]
+    assert scheduler.delay() == 10
+
+
+def test_jobs_added_at_creation_run_at_their_phase():
+    clock = FakeClock()
+    scheduler = Scheduler(SKIP, clock)
+
+    # Loading the models takes a while before the devices are added
+    clock.now += 0.2
+    scheduler.add("a", 10)
+    scheduler.add("b", 10, 5)
+
+    assert scheduler.pop_due() == ["a"]
+    assert abs(scheduler.delay() - 4.8) < 1e-9
+
+
+def test_skip_drops_missed_ticks():
+    clock = FakeClock()
+    scheduler = Scheduler(SKIP, clock)
+    scheduler.add("a", 10)
+    scheduler.pop_due()
+
+    clock.now += 35
+    assert scheduler.pop_due() == ["a"]
+    assert scheduler.jobs["a"].skipped == 2
+    assert scheduler.delay() == 5
+
+
+def test_catch_up_runs_missed_ticks():
+    clock = FakeClock()
+    scheduler = Scheduler(CATCH_UP, clock)
+    scheduler.add("a", 10)
+    scheduler.pop_due()
+
+    clock.now += 35
+    assert scheduler.pop_due() == ["a", "a", "a"]
+    assert scheduler.pop_due() == []
+
+
+def test_removed_jobs_are_not_due():
+    clock = FakeClock()
+    scheduler = Scheduler(SKIP, clock)
+    scheduler.add("a", 10)
+    scheduler.remove("a")
+
+    assert scheduler.pop_due() == []
+
+
+def reload_device(scheduler):
+    clock = scheduler.clock
+    scheduler.add("a", 10)
+    scheduler.pop_due()
+
+    # An hour later the device is added by a reload
+    clock.now += 3600 + 3
+    scheduler.pop_due()
+    overruns = CYCLE_OVERRUNS.labels().value
+
+    reload = SimpleNamespace(diff=ConfigDiff(added=["1020000000000061"]), hosts={})
+    apply_schedule(reload, scheduler, None, 10)
+
+    assert scheduler.pop_due() == []
+    assert scheduler.delay() == 7
+
+    clock.now += 7
+    assert sorted(scheduler.pop_due()) == ["1020000000000061", "a"]
+    assert scheduler.jobs["1020000000000061"].jitter_max == 0
+    assert CYCLE_OVERRUNS.labels().value == overruns
+
+
+def test_reload_after_a_long_uptime_skip():
+    reload_device(Scheduler(SKIP, FakeClock()))
+
+
+def test_reload_after_a_long_uptime_catch_up():
+    reload_device(Scheduler(CATCH_UP, FakeClock()))
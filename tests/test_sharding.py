@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+import pytest
+
+from classes import settings
+from decode import Decoder
+from identity import JoinIndex
+from metrics import metrics
+from model import load_gateway, load_hosts
+from sharding import ShardedPoller
+from simulator import create_simulator, synthesize
+
+
+@pytest.fixture
+def simulated(tmp_path, monkeypatch):
+    # Simulator served from a thread, the workers are separate processes
+    path_gw, path_hosts = synthesize(str(tmp_path), 6, fmt='int16', words_per_channel=1)
+    simulator = create_simulator(path_gw, path_hosts)
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(simulator.serve("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(settings, "store", "false")
+
+    yield path_gw, path_hosts, server.sockets[0].getsockname()[1]
+
+    asyncio.run_coroutine_threadsafe(simulator.close(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+def test_workers_send_back_decoded_values(simulated):
+    path_gw, path_hosts, port = simulated
+    gateways = [{'name': name, 'address': "127.0.0.1", 'port': port, 'in_gw': path_gw, 'timeout': 2}
+                for name in ("first", "second")]
+
+    poller = ShardedPoller(gateways, 2, timeout=10, hosts=path_hosts)
+    try:
+        resp = poller.poll()
+    finally:
+        poller.close()
+
+    registers = load_gateway(path_gw).registers
+    assert len(resp) == 2 * len(registers)
+    assert [r["gateway"] for r in resp.values()] == ["first"] * len(registers) + ["second"] * len(registers)
+
+    # The coordinator gets the values the workers decoded, typed as their channels
+    expected = Decoder(JoinIndex(poller.registers, load_hosts(path_hosts))).decode(resp)
+    assert poller.decoded == expected
+    assert all(isinstance(value, int) for _, values in poller.decoded.values() for value in values)
+
+    # The reads of the workers are counted in the metrics of the coordinator
+    series = metrics.snapshot()["modbus_read_seconds"]["series"]
+    shards = {entry["labels"]["shard"]: entry["count"] for entry in series if "shard" in entry["labels"]}
+    assert sorted(shards) == ["0", "1"]
+    assert all(count > 0 for count in shards.values())
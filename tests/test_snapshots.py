@@ -0,0 +1,56 @@
+import pytest
+
+import file_parser
+from classes import settings
+from model import load_gateway, load_hosts
+
+
+@pytest.fixture
+def submitted(monkeypatch, tmp_path):
+    from snapshot import snapshots
+
+    files = []
+    monkeypatch.setattr(settings, "export_snapshots", "true")
+    monkeypatch.setattr(settings, "out_gateway", str(tmp_path / "gateway.json"))
+    monkeypatch.setattr(settings, "out_hosts", str(tmp_path / "hosts.json"))
+    monkeypatch.setattr(settings, "output_file", str(tmp_path / "response.json"))
+    monkeypatch.setattr(snapshots, "submit", lambda path, data, **kwargs: files.append((path, data)))
+
+    return files
+
+
+def test_models_are_only_exported_when_they_change(submitted):
+    tables = load_gateway(settings.in_gw)
+    hosts = load_hosts(settings.in_hosts)
+
+    file_parser.export_snapshots(tables, hosts, {0: {}})
+    file_parser.export_snapshots(tables, hosts, {0: {}})
+
+    assert [path for path, _ in submitted] == [settings.out_gateway, settings.out_hosts, settings.output_file,
+                                                settings.output_file]
+    assert submitted[0][1] == file_parser.gateway_to_json(tables)
+
+
+def test_every_gateway_is_exported(submitted):
+    tables = load_gateway(settings.in_gw)
+    hosts = load_hosts(settings.in_hosts)
+
+    file_parser.export_snapshots({"first": tables, "second": tables}, hosts, {})
+
+    mapped = file_parser.gateway_to_json(tables)
+    assert submitted[0] == (settings.out_gateway, {"first": mapped, "second": mapped})
+
+
+def test_hosts_rows_join_by_canonical_eui64(tmp_path):
+    path_gw, path_hosts = tmp_path / "gateway.ini", tmp_path / "hosts.conf"
+    path_gw.write_text("[INPUT_REGISTERS]\n"
+                       "REGISTER = 10,2,0022ff0000021f11,2,5,1,0,0,0,2\n"
+                       "REGISTER = 12,2,1090000000000061,2,129,5,0,0,0,2\n")
+    path_hosts.write_text("[0022:FF00:0002:1F11]\n"
+                          "CONCENTRATOR = 2, 4, 10, 0, 5, 16, 2\n"
+                          "CHANNEL = 2, 5, 1, 0, 0, 'float', 'C', 'degree Celsius', 0\n")
+
+    rows = file_parser.hosts_rows(load_hosts(str(path_hosts)), load_gateway(str(path_gw)).registers)
+
+    # The register written in lower case is joined, the one without a device is left out
+    assert rows == [["0022ff0000021f11", 1, 1, 0, 0, 5, 2, "float", "C", "degree Celsius", 0]]
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+# Runs a script with the command line arguments and reports the modules imported, nothing runs without a script
+PROBE = """
+import sys, json, runpy
+script, sys.argv = sys.argv[1], ['arg_parser.py'] + sys.argv[2:]
+if script:
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+print(json.dumps(sorted(sys.modules)), file=sys.stderr)
+"""
+
+
+def imported(script, command, cwd):
+    src = os.getcwd()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([src] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    result = subprocess.run([sys.executable, "-c", PROBE, script, *command], cwd=cwd, env=env, capture_output=True,
+                            text=True, timeout=30)
+
+    return set(json.loads(result.stderr.strip().splitlines()[-1]))
+
+
+@pytest.fixture
+def context(tmp_path):
+    # No metrics exported and no synchronization running
+    with open("context.ini") as f:
+        text = f.read()
+
+    text = text.replace("../out/metrics.json", str(tmp_path / "metrics.json"))
+    text = text.replace("../out/modbus-iot-cli.sock", str(tmp_path / "rpc.sock"))
+    (tmp_path / "context.ini").write_text(text)
+
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("command, unwanted", [
+    (["--help"], {"classes", "configparser", "texttable", "socket", "shutil"}),
+    (["--stats"], {"texttable", "socket", "socketserver", "shutil", "model"}),
+    (["--display_gateway_conf", os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "conf",
+                                                             "modbus_gw.ini"))],
+     {"configparser", "socket", "shutil", "modbus", "pymodbus"}),
+])
+def test_commands_only_import_what_they_use(context, command, unwanted):
+    # Modules of a bare interpreter are not counted
+    used = imported(os.path.abspath("arg_parser.py"), command, context) - imported("", [], context)
+
+    assert "argparse" in used
+    assert not used & unwanted